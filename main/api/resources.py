@@ -1,13 +1,14 @@
 import json
 import base64
-import hashlib  # fix(clean): remove?
+import hashlib
+import logging
 import zipfile
 import datetime
 from io import BytesIO
 
 
 # external imports
-from flask import request, abort, make_response
+from flask import request, abort, make_response, Response, stream_with_context
 from sqlalchemy import not_
 from sqlalchemy.orm.exc import NoResultFound
 from flask_restful import Resource as ApiResource
@@ -15,17 +16,25 @@ from flask_login import current_user
 
 
 # internal imports
-from main.app import db
+from main.app import db, message_queue, thumbnail_queue
 from main.users.models import User
 from main.users.permissions import access_level, ACCESS_LEVEL_READ, ACCESS_LEVEL_WRITE
-from main.util import parse_json_datetime
-from main.resources.models import Resource, ResourceRevision, ResourceView, ControllerStatus, Thumbnail
+from main.util import parse_json_datetime, not_modified_response, set_cache_validators
+from main.resources.models import Resource, ResourceRevision, ResourceView, ControllerStatus
 from main.resources.resource_util import find_resource, read_resource, add_resource_revision, _create_file, update_sequence_value, \
-    resource_type_number, _create_folders, create_sequence, delete_resource
-from main.resources.file_conversion import convert_csv_to_xls, convert_xls_to_csv, convert_new_lines, compute_thumbnail
+    resource_type_number, _create_folders, create_sequence, delete_resource, read_pending_thumbnail, read_resources_prefetched, \
+    add_resource_revision_chunks, revision_etag, _update_file_attributes
+from main.resources.thumbnails import read_sprite_sheet
+from main.resources.blob_storage import release_revision_blobs
+from main.resources.storage_manager import CHUNK_SIZE
+from main.resources.file_conversion import convert_xls_to_csv, convert_new_lines
+from main.resources.conversions import can_convert, read_converted_resource
 from main.users.auth import find_key  # fix(clean): remove?
 
 
+logger = logging.getLogger(__name__)
+
+
 class ResourceRecord(ApiResource):
 
     # get the current value or meta data of a resource
@@ -106,6 +115,27 @@ class ResourceRecord(ApiResource):
                     except ValueError:
                         abort(400, 'Invalid date/time.')
 
+                # get a sprite sheet (or its offset map) combining the thumbnails in a range of revisions
+                sprite = request.values.get('sprite')
+                if sprite:
+                    if json.loads(r.system_attributes).get('data_type') != Resource.IMAGE_SEQUENCE:
+                        abort(400, 'Sprite sheets are only available for image sequences.')
+                    try:
+                        first_rev = int(request.values['first_rev'])
+                        last_rev = int(request.values['last_rev'])
+                    except (KeyError, ValueError):
+                        abort(400, 'Expected first_rev and last_rev.')
+                    (sprite_data, offsets, complete) = read_sprite_sheet(r, first_rev, last_rev)
+                    if sprite == 'map':
+                        result = make_response(json.dumps(offsets))
+                        result.headers['Content-Type'] = 'application/json'
+                    else:
+                        result = make_response(sprite_data)
+                        result.headers['Content-Type'] = 'image/jpeg'
+                    if not complete:
+                        result.headers['Cache-Control'] = 'no-store'  # some thumbnails are still being computed
+                    return result
+
                 # if filters specified, assume we want a sequence of values
                 if text or start_timestamp or end_timestamp or count > 1:
 
@@ -113,8 +143,8 @@ class ResourceRecord(ApiResource):
                     if int(request.values.get('summary', False)):
                         return sequence_value_summary(r.id)
 
-                    # get preliminary set of values
-                    resource_revisions = ResourceRevision.query.filter(ResourceRevision.resource_id == r.id)
+                    # get preliminary set of values (skipping revisions without data, e.g. thumbnails that are still being computed)
+                    resource_revisions = ResourceRevision.query.filter(ResourceRevision.resource_id == r.id, ResourceRevision.data.isnot(None))
 
                     # apply filters (if any)
                     if text:
@@ -151,10 +181,23 @@ class ResourceRecord(ApiResource):
                     rev = request.values.get('rev')
                     if rev:
                         rev = int(rev)  # fix(soon): safe int conversion
+                    etag = revision_etag(r, rev)
+                    if etag:
+                        response = not_modified_response(etag)
+                        if response:
+                            return response
                     value = read_resource(r, revision_id=rev)
+                    pending_thumbnail = False
+                    if value is None and r.name.startswith('thumbnail-') and (rev or r.last_revision_id):
+                        value = read_pending_thumbnail(r, rev or r.last_revision_id)  # serve full image until thumbnail is computed
+                        pending_thumbnail = value is not None
                     if value is None:
                         value = ''  # if the sequence doesn't yet have any values, return an empty value (rather than a 400 or 404)
                     result = make_response(value)
+                    if pending_thumbnail:
+                        result.headers['Cache-Control'] = 'no-store'  # don't let the browser cache the placeholder
+                    elif etag:
+                        set_cache_validators(result, etag)
                     data_type = json.loads(r.system_attributes)['data_type']
                     if data_type == Resource.IMAGE_SEQUENCE:
                         result.headers['Content-Type'] = 'image/jpeg'
@@ -163,14 +206,24 @@ class ResourceRecord(ApiResource):
 
             # if file, return file data/contents
             else:
-                data = read_resource(r)
+                convert_to = request.values.get('convert_to', request.values.get('convertTo', ''))
+                if convert_to and not can_convert(r, convert_to):
+                    convert_to = ''
+                etag = revision_etag(r, variant=convert_to)
+                if etag:
+                    response = not_modified_response(etag)
+                    if response:
+                        return response
+                name = r.name
+                if convert_to:
+                    data = read_converted_resource(r, convert_to)
+                    name = name.rsplit('.', 1)[0] + '.' + convert_to
+                else:
+                    data = read_resource(r)
                 if not data:
                     abort(404)
-                name = r.name
-                if request.values.get('convert_to', request.values.get('convertTo', '')) == 'xls' and r.name.endswith('csv'):
-                    data = convert_csv_to_xls(data)
-                    name = name.replace('csv', 'xls')
                 result = make_response(data)
+                set_cache_validators(result, etag)
                 result.headers['Content-Type'] = 'application/octet-stream'
                 if request.values.get('download', False):
                     result.headers['Content-Disposition'] = 'attachment; filename=' + name
@@ -184,6 +237,7 @@ class ResourceRecord(ApiResource):
         if access_level(r.query_permissions()) < ACCESS_LEVEL_WRITE:
             abort(403)
         if request.values.get('data_only', False):
+            release_revision_blobs(ResourceRevision.resource_id == r.id)
             ResourceRevision.query.filter(ResourceRevision.resource_id == r.id).delete()
             # fix(later): support delete_min_timestamp and delete_max_timestamp to delete subsets
         else:
@@ -323,6 +377,8 @@ class ResourceRecord(ApiResource):
             else:
                 add_resource_revision(r, timestamp, data)  # this can be binary
                 r.modification_timestamp = timestamp
+                file_data = data if isinstance(data, bytes) else data.encode()
+                _update_file_attributes(r, hashlib.sha1(file_data).hexdigest(), len(file_data))  # used by ETags and the storage scrubber
         db.session.commit()
         return {'status': 'ok', 'id': r.id}
 
@@ -431,8 +487,11 @@ class ResourceList(ApiResource):
         # handle sub-types
         if resource_type == Resource.FILE:
 
-            # get file contents (if any) from request
-            if file:
+            # get file contents (if any) from request; uploaded files that don't need to be converted are streamed to storage below
+            stream_upload = file and not (name.endswith('xls') or name.endswith('xlsx') or name.endswith('csv') or name.endswith('txt'))
+            if stream_upload:
+                data = None
+            elif file:
                 stream = BytesIO()
                 file.save(stream)
                 data = stream.getvalue()
@@ -449,11 +508,12 @@ class ResourceList(ApiResource):
                 data = convert_new_lines(data.decode()).encode()
 
             # compute other file attributes
-            system_attributes = {
-                'hash': hashlib.sha1(data).hexdigest(),
-                'size': len(data),
-            }
-            r.system_attributes = json.dumps(system_attributes)
+            if data is not None:
+                system_attributes = {
+                    'hash': hashlib.sha1(data).hexdigest(),
+                    'size': len(data),
+                }
+                r.system_attributes = json.dumps(system_attributes)
         elif resource_type == Resource.SEQUENCE:
             new_system_attributes = json.loads(args['system_attributes'])
             new_system_attributes.update(args)
@@ -493,23 +553,18 @@ class ResourceList(ApiResource):
 
         # save file contents (after we have resource ID) and compute thumbnail if needed
         if resource_type == Resource.FILE:
-            add_resource_revision(r, r.creation_timestamp, data)  # we assume data is already binary/encoded
+            if stream_upload:  # hash and write the file in chunks, so we don't need to hold it in memory
+                chunks = iter(lambda: file.stream.read(CHUNK_SIZE), b'')
+                (_, size, digest) = add_resource_revision_chunks(r, r.creation_timestamp, chunks)
+                r.system_attributes = json.dumps({'hash': digest, 'size': size})
+            else:
+                add_resource_revision(r, r.creation_timestamp, data)  # we assume data is already binary/encoded
             r.deleted = False  # now that have sucessfully created revision, we can make the resource live
             db.session.commit()
 
-            # compute thumbnail
-            # fix(soon): recompute thumbnail on resource update
-            if name.endswith('.png') or name.endswith('.jpg'):  # fix(later): handle more types, capitalizations
-                for width in [120]:  # fix(later): what will be our standard sizes?
-                    # fix(later): if this returns something other than requested width, we'll keep missing the cache
-                    (thumbnail_contents, thumbnail_width, thumbnail_height) = compute_thumbnail(data, width)
-                    thumbnail = Thumbnail()
-                    thumbnail.resource_id = r.id
-                    thumbnail.width = thumbnail_width
-                    thumbnail.height = thumbnail_height
-                    thumbnail.format = 'jpg'
-                    thumbnail.data = thumbnail_contents
-                    db.session.add(thumbnail)
+            # compute thumbnail (in the background); other sizes are computed when first requested
+            if data is not None and (name.endswith('.png') or name.endswith('.jpg')):  # fix(later): handle more types, capitalizations
+                thumbnail_queue.add_file_thumbnail(r.id, r.last_revision_id, data, 120)
 
         # handle the case of creating a controller; requires creating some additional records
         elif resource_type == Resource.CONTROLLER_FOLDER:
@@ -592,25 +647,26 @@ class ResourceList(ApiResource):
             items = sorted(items)  # sort by keys so we can re-use folder lookup and permission check between items in same folder
             folder_resource = None
             folder_name = None
-            for (full_name, value) in items:
-                item_folder_name = full_name.rsplit('/', 1)[0]
-                if item_folder_name != folder_name:  # if this folder doesn't match the folder resource record we have
-                    folder_name = item_folder_name
-                    folder_resource = find_resource(folder_name)
-                    if folder_resource and access_level(folder_resource.query_permissions()) < ACCESS_LEVEL_WRITE:
-                        folder_resource = None  # don't have write access
-                if folder_resource:
-                    seq_name = full_name.rsplit('/', 1)[1]
-                    try:
-                        resource = (
-                            Resource.query
-                            .filter(Resource.parent_id == folder_resource.id, Resource.name == seq_name, not_(Resource.deleted))
-                            .one()
-                        )
-                        update_sequence_value(resource, full_name, timestamp, str(value), emit_message=True)  # fix(later): revisit emit_message
-                    except NoResultFound:
-                        pass
-            db.session.commit()
+            with message_queue.buffered():  # sequence_update messages are inserted with the final commit (not one commit per sequence)
+                for (full_name, value) in items:
+                    item_folder_name = full_name.rsplit('/', 1)[0]
+                    if item_folder_name != folder_name:  # if this folder doesn't match the folder resource record we have
+                        folder_name = item_folder_name
+                        folder_resource = find_resource(folder_name)
+                        if folder_resource and access_level(folder_resource.query_permissions()) < ACCESS_LEVEL_WRITE:
+                            folder_resource = None  # don't have write access
+                    if folder_resource:
+                        seq_name = full_name.rsplit('/', 1)[1]
+                        try:
+                            resource = (
+                                Resource.query
+                                .filter(Resource.parent_id == folder_resource.id, Resource.name == seq_name, not_(Resource.deleted))
+                                .one()
+                            )
+                            update_sequence_value(resource, full_name, timestamp, str(value), emit_message=True)  # fix(later): revisit emit_message
+                        except NoResultFound:
+                            pass
+                db.session.commit()
 
 
 # update resource record system attributes using a dictionary of new system attributes (send via REST API)
@@ -686,41 +742,72 @@ def sequence_value_summary(resource_id):
     return [(lcp, count) for (count, lcp) in counts]
 
 
-# add a file or folder (recursively) to the zip file; uncompressed_size is a single-element list to allow modification inside function
-def add_to_zip(zip_file, resource, path_prefix, uncompressed_size):
+# add a file or folder (recursively) to a list of (name, file resource) zip file entries
+def add_to_zip(entries, resource, path_prefix):
     name = (path_prefix + '/' + resource.name) if path_prefix else resource.name
 
-    # add file contents
+    # add file
     if resource.type == Resource.FILE:
-
-        # read data
-        data = read_resource(resource)
-        if not data:
-            abort(404)
-        uncompressed_size[0] += len(data)
-        if uncompressed_size[0] >= 500 * 1024 * 1024:
-            abort(400, 'Batch download only supported if total file size is less than 500MB.')  # fix(later): friendlier error handling
-
-        # add to zip file
-        zip_file.writestr(name, data)
+        entries.append((name, resource))
 
     # add folder contents
     elif resource.type == Resource.BASIC_FOLDER:
         resources = Resource.query.filter(Resource.parent_id == resource.id, not_(Resource.deleted))
         for r in resources:
-            add_to_zip(zip_file, r, name, uncompressed_size)  # fix(soon): should we check permissions on each resource?
+            add_to_zip(entries, r, name)  # fix(soon): should we check permissions on each resource?
+
+
+# a write-only file object for a zipfile.ZipFile; collects the zip file data so that it can be sent to the client as it is generated
+class ZipStream(object):
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    # get the data written since the last call
+    def drain(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+# generate the contents of a zip file containing the given (name, file resource) entries; file contents are prefetched from
+# bulk storage (or read in chunks, for large files) and compressed as they are sent, so memory use doesn't depend on the size of the files
+def generate_zip(entries):
+    zip_stream = ZipStream()
+    zip_file = zipfile.ZipFile(zip_stream, 'w', zipfile.ZIP_DEFLATED)
+    names = {resource.id: name for (name, resource) in entries}
+    for (resource, chunks) in read_resources_prefetched([resource for (_, resource) in entries]):
+        name = names[resource.id]
+        zip_info = zipfile.ZipInfo(name, date_time=datetime.datetime.now().timetuple()[:6])
+        zip_info.compress_type = zipfile.ZIP_DEFLATED
+        zip_info.external_attr = 0o600 << 16
+        zip_info.create_system = 0  # make sure permissions are ok in Linux
+        with zip_file.open(zip_info, 'w', force_zip64=True) as entry:  # we don't know the size in advance, so allow large files
+            size = 0
+            for chunk in chunks:
+                entry.write(chunk)
+                size += len(chunk)
+                yield zip_stream.drain()
+            if not size:
+                logger.warning('generate_zip: no data read (resource: %d, path: %s)', resource.id, name)
+        yield zip_stream.drain()
+    zip_file.close()
+    yield zip_stream.drain()
 
 
 # download the a set of resources (from within a single folder) as a zip file
 # fix(later): doesn't include empty folders
 def batch_download(parent_folder, ids):
 
-    # create zip file
-    zip_buffer = BytesIO()
-    zip_file = zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED, False)
-    uncompressed_size = [0]
-
-    # loop over IDs
+    # loop over IDs; find all the files (and check permissions) before we start sending data
+    entries = []
     for resource_id in ids:
 
         # get resource
@@ -735,17 +822,10 @@ def batch_download(parent_folder, ids):
 
         # only process files and folders (for now)
         if r.type == Resource.FILE or r.type == Resource.BASIC_FOLDER:
-            add_to_zip(zip_file, r, '', uncompressed_size)
-
-    # make sure permissions are ok in Linux
-    for zf in zip_file.filelist:
-        zf.create_system = 0
+            add_to_zip(entries, r, '')
 
-    # return zip file contents
-    zip_file.close()
-    zip_buffer.seek(0)
-    data = zip_buffer.read()
-    result = make_response(data)
+    # stream zip file contents
+    result = Response(stream_with_context(generate_zip(entries)))
     result.headers['Content-Type'] = 'application/octet-stream'
     result.headers['Content-Disposition'] = 'attachment; filename=' + parent_folder.name + '_files.zip'
     return result
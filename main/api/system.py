@@ -9,7 +9,7 @@ from flask_login import current_user, login_required
 
 
 # internal imports
-from main.app import db
+from main.app import db, storage_manager, storage_spool
 from main.users.models import User
 from main.messages.models import Message
 from main.resources.models import Resource, ResourceRevision, Thumbnail
@@ -23,10 +23,15 @@ class SystemStats(ApiResource):
         if current_user.role != current_user.SYSTEM_ADMIN:
             abort(403)
         s = db.session
-        return {
+        stats = {
             'user_count': s.query(func.count(User.id)).scalar(),
             'resource_count': s.query(func.count(Resource.id)).scalar(),
             'thumbnail_count': s.query(func.count(Thumbnail.id)).scalar(),
             'resource_revision_count': s.query(func.count(ResourceRevision.id)).scalar(),
             'message_count': s.query(func.count(Message.id)).scalar(),
         }
+        if hasattr(storage_manager, 'stats') and storage_manager is not storage_spool:  # local storage cache (for this process)
+            stats['storage_cache'] = storage_manager.stats()
+        if storage_spool:  # write-behind uploads (for this process)
+            stats['storage_spool'] = storage_spool.stats()
+        return stats
@@ -0,0 +1,163 @@
+# standard python imports
+import uuid
+import datetime
+
+
+# external imports
+from flask import request, abort
+from flask_restful import Resource as ApiResource
+from sqlalchemy.orm.exc import NoResultFound
+
+
+# internal imports
+from main.app import db, storage_manager
+from main.users.permissions import access_level, ACCESS_LEVEL_WRITE
+from main.resources.models import FileUpload, FileUploadPart
+from main.resources.resource_util import find_resource, create_file_from_chunks
+
+
+# max size of a single part of a resumable upload
+MAX_PART_SIZE = 16 * 1024 * 1024
+
+
+# get the path of an upload part in the bulk storage system
+def upload_part_storage_path(upload_id, offset):
+    return 'uploads/%s/%d' % (upload_id, offset)
+
+
+# get an integer request parameter; aborts with a 400 error if missing or not an integer
+def request_int(args, name):
+    try:
+        return int(args[name])
+    except (KeyError, ValueError):
+        abort(400)
+
+
+# get an upload record and make sure the current user/controller can write to the folder containing the file
+def find_upload(upload_id):
+    try:
+        upload = FileUpload.query.filter(FileUpload.id == upload_id).one()
+    except NoResultFound:
+        abort(404)
+    check_upload_access(upload.path)
+    return upload
+
+
+# make sure the current user/controller can write to the folder that will contain the given file
+def check_upload_access(path):
+    folder = find_resource(path.rsplit('/', 1)[0]) if path.startswith('/') and path.count('/') > 1 else None
+    if not folder:
+        abort(400)
+    if access_level(folder.query_permissions()) < ACCESS_LEVEL_WRITE:
+        abort(403)
+
+
+# delete the parts of an upload (and the upload record); outside code must commit
+def delete_upload(upload):
+    parts = FileUploadPart.query.filter(FileUploadPart.upload_id == upload.id)
+    if storage_manager:
+        for part in parts:
+            if part.data is None:
+                storage_manager.delete(upload_part_storage_path(upload.id, part.offset))
+    parts.delete()
+    db.session.delete(upload)
+
+
+# Resumable uploads let a client (e.g. a controller on an unreliable network connection) send a file in parts. The client creates
+# an upload (POST /api/v1/uploads), sends parts (PUT /api/v1/uploads/<id> with an offset parameter and the raw part data as the
+# request body), and then completes the upload (POST /api/v1/uploads/<id>). If the connection is lost, the client can get the
+# current offset (GET /api/v1/uploads/<id>) and continue from there.
+class FileUploadList(ApiResource):
+
+    # start a new upload
+    def post(self):
+        args = request.values
+        path = args.get('path', '')
+        check_upload_access(path)
+        upload = FileUpload()
+        upload.id = uuid.uuid4().hex
+        upload.path = path
+        upload.size = request_int(args, 'size') if args.get('size') else None
+        upload.received = 0
+        upload.creation_timestamp = datetime.datetime.utcnow()
+        upload.modification_timestamp = upload.creation_timestamp
+        db.session.add(upload)
+        db.session.commit()
+        return {'status': 'ok', 'id': upload.id, 'offset': 0}
+
+
+# fix(later): add a worker to remove uploads that are never completed
+class FileUploadRecord(ApiResource):
+
+    # get the current state of an upload; the client should send the next part starting at this offset
+    def get(self, upload_id):
+        upload = find_upload(upload_id)
+        return {'status': 'ok', 'id': upload.id, 'offset': upload.received, 'size': upload.size}
+
+    # add a part to an upload; the offset must match the number of bytes received so far (otherwise returns a 409 with
+    # the current offset, e.g. if the client is retrying a part that we already received)
+    def put(self, upload_id):
+        upload = find_upload(upload_id)
+        offset = request_int(request.values, 'offset')
+        if offset != upload.received:
+            return {'status': 'error', 'message': 'Offset does not match.', 'offset': upload.received}, 409
+        if request.content_length and request.content_length > MAX_PART_SIZE:
+            abort(413)
+        data = request.get_data()
+        if data:
+
+            # claim this part of the upload; the update only succeeds if no other request (e.g. a retry of the same part) has
+            # added a part at this offset since we checked above (the row stays locked until we commit)
+            claimed = (
+                FileUpload.query
+                .filter(FileUpload.id == upload.id, FileUpload.received == offset)
+                .update({
+                    FileUpload.received: FileUpload.received + len(data),
+                    FileUpload.modification_timestamp: datetime.datetime.utcnow(),
+                }, synchronize_session=False)
+            )
+            if not claimed:
+                db.session.rollback()
+                upload = find_upload(upload_id)
+                return {'status': 'error', 'message': 'Offset does not match.', 'offset': upload.received}, 409
+
+            part = FileUploadPart()
+            part.upload_id = upload.id
+            part.offset = offset
+            part.size = len(data)
+            if storage_manager:
+                storage_manager.write(upload_part_storage_path(upload.id, offset), data)
+            else:
+                part.data = data
+            db.session.add(part)
+            db.session.commit()
+            return {'status': 'ok', 'offset': offset + len(data)}
+        return {'status': 'ok', 'offset': upload.received}
+
+    # complete an upload: assemble the parts into a new file revision (streaming them from storage)
+    def post(self, upload_id):
+        upload = find_upload(upload_id)
+        if upload.size is not None and upload.size != upload.received:
+            return {'status': 'error', 'message': 'Upload is not complete.', 'offset': upload.received}, 400
+        parts = FileUploadPart.query.filter(FileUploadPart.upload_id == upload.id).order_by(FileUploadPart.offset).all()
+
+        def part_chunks():
+            for part in parts:
+                if part.data is not None:
+                    yield part.data
+                else:
+                    for chunk in storage_manager.read_chunks(upload_part_storage_path(upload.id, part.offset)):
+                        yield chunk
+
+        timestamp = datetime.datetime.utcnow()
+        resource = create_file_from_chunks(upload.path, timestamp, timestamp, part_chunks())
+        delete_upload(upload)
+        db.session.commit()
+        return {'status': 'ok', 'id': resource.id}
+
+    # cancel an upload
+    def delete(self, upload_id):
+        upload = find_upload(upload_id)
+        delete_upload(upload)
+        db.session.commit()
+        return {'status': 'ok'}
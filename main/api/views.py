@@ -22,6 +22,7 @@ from .messages import MessageList
 from .resources import ResourceRecord, ResourceList
 from .pins import PinRecord, PinList
 from .system import SystemStats
+from .uploads import FileUploadList, FileUploadRecord
 
 
 # API resources
@@ -38,6 +39,8 @@ api_.add_resource(PinList, '/api/v1/pins')
 api_.add_resource(PinRecord, '/api/v1/pins/<int:pin>')
 api_.add_resource(SystemStats, '/api/v1/system/stats')
 api_.add_resource(MessageList, '/api/v1/messages')
+api_.add_resource(FileUploadList, '/api/v1/uploads')
+api_.add_resource(FileUploadRecord, '/api/v1/uploads/<string:upload_id>')
 
 
 # endpoint for creating a new websocket connect
@@ -9,6 +9,7 @@ from .config import init_flask_config
 from .messages.socket_sender import SocketSender
 from .messages.message_queue_basic import MessageQueueBasic
 from .messages.message_sender import MessageSender
+from .resources.thumbnail_queue import ThumbnailQueue
 from .util import prep_logging
 
 # Create and configure the application. Default config values may be overridden by a config file,
@@ -37,18 +38,43 @@ if app.config.get('S3_STORAGE_BUCKET'):
     from .resources.s3_storage_manager import S3StorageManager
     print('using S3 storage manager')
     storage_manager = S3StorageManager(app.config)
+elif app.config.get('FILE_SYSTEM_STORAGE_PATH') and app.config['STORAGE_SEGMENT_SIZE']:
+    from .resources.segment_storage_manager import SegmentStorageManager
+    print('using file system storage manager with segment files')
+    storage_manager = SegmentStorageManager(app.config)
 elif app.config.get('FILE_SYSTEM_STORAGE_PATH'):
     from .resources.file_system_storage_manager import FileSystemStorageManager
     print('using file system storage manager')
     storage_manager = FileSystemStorageManager(app.config)
 else:
     storage_manager = None
+storage_spool = None
+if storage_manager and app.config['STORAGE_SPOOL_PATH']:
+    from .resources.spool_storage_manager import SpoolStorageManager
+    print('using write-behind storage spool')
+    storage_manager = storage_spool = SpoolStorageManager(storage_manager, app.config)
+    storage_spool.start()
+if storage_manager and app.config['STORAGE_CACHE_PATH']:
+    from .resources.caching_storage_manager import CachingStorageManager
+    print('using local storage cache')
+    storage_manager = CachingStorageManager(storage_manager, app.config)
+
+# create a queue for computing image thumbnails in the background
+thumbnail_queue = ThumbnailQueue(app.config)
+thumbnail_queue.start()
 
 # create a static file manager
 static_manager = {}
 
 # create a message queue that will be used to handle messages to/from clients
-message_queue = MessageQueueBasic()
+if app.config['MESSAGE_QUEUE'] == 'notify':
+    from .messages.message_queue_notify import MessageQueueNotify
+    message_queue = MessageQueueNotify()
+elif app.config['MESSAGE_QUEUE'] == 'memory' and not os.environ.get('RHIZO_WORKER_PROCESS'):  # (see run_worker.py)
+    from .messages.message_queue_memory import MessageQueueMemory
+    message_queue = MessageQueueMemory(app.config)
+else:
+    message_queue = MessageQueueBasic()
 
 # prepare MQTT message sender
 if app.config['MQTT_HOST']:
@@ -12,6 +12,8 @@ def defaults():
     """
     return {
         'AUTOLOAD_EXTENSIONS': False,
+        'CONTENT_ADDRESSED_STORAGE': False,
+        'CONVERSION_CACHE_SIZE': 16 * 1024 * 1024,
         'CSRF_ENABLED': True,
         'CSRF_SESSION_KEY': '[Random String Here]',
         'DATABASE_CONNECT_OPTIONS': {},
@@ -19,9 +21,14 @@ def defaults():
         'DEBUG_MESSAGING': False,
         'DISCLAIMER': '',
         'DOC_FILE_PREFIX': '',
+        'DOC_PAGE_CACHE_SIZE': 4 * 1024 * 1024,
+        'DOC_PAGE_STORE_RENDERED': False,
         'EXTENSIONS': [],
         'EXTRA_NAV_ITEMS': '',
         'KEY_PREFIX': 'RHIZO',
+        'MESSAGE_QUEUE': 'basic',
+        'MESSAGE_QUEUE_LOG_FILE': '',
+        'MESSAGE_QUEUE_MEMORY_SIZE': 10000,
         'MESSAGE_TOKEN_SALT': '[Random String Here]',
         'MESSAGING_LOG_PATH': '',
         'MQTT_HOST': '',
@@ -41,11 +48,37 @@ def defaults():
         'SQLALCHEMY_DATABASE_URI': 'sqlite:///rhizo.db',
         'SQLALCHEMY_TRACK_MODIFICATIONS': False,
         'SSL': False,
+        'STORAGE_CACHE_PATH': '',
+        'STORAGE_CACHE_SIZE': 1024 * 1024 * 1024,
+        'STORAGE_GC_DRY_RUN': True,
+        'STORAGE_GC_ENABLED': False,
+        'STORAGE_GC_MIN_AGE': 24,
+        'STORAGE_GC_RATE': 100,
+        'STORAGE_INLINE_MAX_SIZE': 1000,
+        'STORAGE_PREFETCH_COUNT': 8,
+        'STORAGE_PREFETCH_SIZE': 64 * 1024 * 1024,
+        'STORAGE_SCRUB_ENABLED': False,
+        'STORAGE_SCRUB_RATE': 10 * 1024 * 1024,
+        'STORAGE_SCRUB_THREADS': 4,
+        'STORAGE_SEGMENT_MAX_OBJECT_SIZE': 256 * 1024,
+        'STORAGE_SEGMENT_SIZE': 0,
+        'STORAGE_SPOOL_PATH': '',
+        'STORAGE_SPOOL_UPLOADERS': 4,
+        'STORAGE_TIERING_BATCH_SIZE': 100,
+        'STORAGE_TIERING_INLINE_MAX_AGE': 0,
+        'STORAGE_TIERING_MIN_SIZE': 100,
         'SYSTEM_NAME': 'Rhizo Server',
         'TEXT_FROM_PHONE_NUMBER': '',
         'THREADS_PER_PAGE': 8,
+        'THUMBNAIL_CACHE_SIZE': 16 * 1024 * 1024,
+        'THUMBNAIL_QUEUE_SIZE': 100,
+        'THUMBNAIL_THREADS': 2,
+        'THUMBNAIL_WIDTHS': [60, 120, 240, 480, 960],
         'TWILIO_ACCOUNT_SID': '',
         'TWILIO_AUTH_TOKEN': '',
+        'WEB_SOCKET_RATE_BURST': 1000,
+        'WEB_SOCKET_RATE_LIMIT': 200,
+        'WEB_SOCKET_SEND_QUEUE_SIZE': 1000,
     }
 
 
@@ -1,3 +1,6 @@
+from contextlib import contextmanager
+
+
 # The MessageQueue class provides an interface to be implemented by classes that store messages.
 class MessageQueue(object):
 
@@ -5,6 +8,17 @@ class MessageQueue(object):
     def add(self, folder_id, folder_path, message_type, parameters=None, sender_controller_id=None, sender_user_id=None, timestamp=None):
         pass
 
+    # add a list of messages to the queue; each message is a dictionary of add() arguments
+    def add_many(self, messages):
+        for message in messages:
+            self.add(**message)
+
+    # a context manager that lets an implementation collect the messages added within it (by the current greenlet) and store
+    # them together; by default messages are added immediately
+    @contextmanager
+    def buffered(self):
+        yield
+
     # returns a list of message objects once some are ready
     def receive(self):
         pass
@@ -1,51 +1,113 @@
 import json
 import datetime
+from contextlib import contextmanager
 import gevent
+from sqlalchemy import event
 from .message_queue import MessageQueue
 
 
 # A basic message queue using a message table in the primary database.
+# Within a buffered() block, added messages are held until the database session commits and are then inserted (using a single
+# multi-row INSERT) as part of that commit; e.g. a request that updates many sequences stores all of its sequence_update
+# messages along with the new values, rather than committing once per message.
 class MessageQueueBasic(MessageQueue):
 
     def __init__(self):
         self._last_message_id = None
         self._start_timestamp = datetime.datetime.utcnow()
+        self._buffers = {}  # greenlet -> list of message row values waiting for a commit
 
-    # add a single message to the queue
+    # add a single message to the queue; note that (unless buffered) this commits the database session
     def add(self, folder_id, folder_path, message_type, parameters=None, sender_controller_id=None, sender_user_id=None, timestamp=None):
-        # fix(soon): add warning if type is too long
-        from main.messages.models import Message  # would like to do at top, but creates import loop in __init__
+        self.add_many([{
+            'folder_id': folder_id,
+            'folder_path': folder_path,
+            'message_type': message_type,
+            'parameters': parameters,
+            'sender_controller_id': sender_controller_id,
+            'sender_user_id': sender_user_id,
+            'timestamp': timestamp,
+        }])
+
+    # add a list of messages to the queue (each a dictionary of add() arguments); note that (unless buffered) this commits the
+    # database session
+    def add_many(self, messages):
+        from main.app import db  # would like to do at top, but creates import loop in __init__
+        rows = [self.message_values(**message) for message in messages]
+        buffer = self._buffers.get(gevent.getcurrent())
+        if buffer is not None:
+            buffer.extend(rows)
+        elif rows:
+            self.insert_messages(db.session, rows)
+            db.session.commit()
+
+    # within this block, messages added by the current greenlet are inserted when the database session commits; any messages
+    # still waiting at the end of the block are inserted (and committed) then; if the block raises an exception, they are discarded
+    @contextmanager
+    def buffered(self):
         from main.app import db  # would like to do at top, but creates import loop in __init__
-        if not timestamp:
-            timestamp = datetime.datetime.utcnow()
-        message_record = Message()
-        message_record.timestamp = timestamp
-        # the ID of the controller that created the message (if it was not created by a human/browser)
-        message_record.sender_controller_id = sender_controller_id
-        message_record.sender_user_id = sender_user_id
-        message_record.folder_id = folder_id
-        message_record.type = message_type
-        message_record.parameters = json.dumps(parameters) if parameters else '{}'
-        db.session.add(message_record)
-        db.session.commit()
+        key = gevent.getcurrent()
+        if key in self._buffers:  # already buffering (e.g. nested blocks)
+            yield
+            return
+        buffer = self._buffers[key] = []
+        session = db.session()
+
+        def insert_buffered_messages(session):
+            if buffer:
+                self.insert_messages(session, list(buffer))
+                del buffer[:]
+
+        event.listen(session, 'before_commit', insert_buffered_messages)
+        try:
+            yield
+        finally:
+            event.remove(session, 'before_commit', insert_buffered_messages)
+            del self._buffers[key]
+        if buffer:
+            self.insert_messages(db.session, buffer)
+            db.session.commit()
+
+    # insert message rows into the messages table using a single multi-row INSERT
+    def insert_messages(self, session, rows):
+        from main.messages.models import Message  # would like to do at top, but creates import loop in __init__
+        session.execute(Message.__table__.insert().values(rows))
 
     # returns a list of message objects once some are ready
     def receive(self):
-        from main.messages.models import Message  # would like to do at top, but creates import loop in __init__
         while True:
 
             # sleep for a bit; don't want to overload the database
             gevent.sleep(0.5)
 
-            # fix(soon): is there a good way to avoid losing messages while server is restarting? could go back 5 minutes, but then we'd get
-            # duplicates. it would be nice if each web/worker process could remember where it was across restarts
-            if self._last_message_id:
-                messages = Message.query.filter(Message.id > self._last_message_id).order_by('id')
-            else:
-                messages = Message.query.filter(Message.timestamp > self._start_timestamp).order_by('id')
-            if messages.count():
-                try:
-                    self._last_message_id = messages[-1].id  # fix(soon): check that this works
-                except IndexError:
-                    pass
+            messages = self.new_messages()
+            if messages:
                 return messages
+
+    # get the values of a message table row
+    def message_values(self, folder_id, folder_path, message_type, parameters=None, sender_controller_id=None, sender_user_id=None, timestamp=None):
+        # pylint: disable=unused-argument
+        # fix(soon): add warning if type is too long
+        return {
+            'timestamp': timestamp or datetime.datetime.utcnow(),
+            # the ID of the controller that created the message (if it was not created by a human/browser)
+            'sender_controller_id': sender_controller_id,
+            'sender_user_id': sender_user_id,
+            'folder_id': folder_id,
+            'type': message_type,
+            'parameters': json.dumps(parameters) if parameters else '{}',
+        }
+
+    # get a list of the messages added since the last message we returned (using a single query)
+    def new_messages(self):
+        from main.messages.models import Message  # would like to do at top, but creates import loop in __init__
+
+        # fix(soon): is there a good way to avoid losing messages while server is restarting? could go back 5 minutes, but then we'd get
+        # duplicates. it would be nice if each web/worker process could remember where it was across restarts
+        if self._last_message_id:
+            messages = Message.query.filter(Message.id > self._last_message_id).order_by(Message.id).all()
+        else:
+            messages = Message.query.filter(Message.timestamp > self._start_timestamp).order_by(Message.id).all()
+        if messages:
+            self._last_message_id = messages[-1].id
+        return messages
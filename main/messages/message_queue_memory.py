@@ -0,0 +1,145 @@
+import os
+import json
+import time
+import logging
+import datetime
+import itertools
+import collections
+import gevent.event
+from main.util import parse_json_datetime
+from .message_queue import MessageQueue
+from .message_queue_basic import MessageQueueBasic
+
+
+logger = logging.getLogger(__name__)
+
+
+# number of seconds between checks of the messages table for messages added by other processes (e.g. the worker);
+# the same interval MessageQueueBasic uses, so worker messages aren't delayed relative to the 'basic' queue
+TABLE_POLL_INTERVAL = 0.5
+
+
+# A message queue that holds recent messages in an in-memory ring buffer, for installations that run a single web process
+# (messages are not shared between processes). Receivers are woken with a gevent event as soon as a message is added, and no
+# database writes are needed. If MESSAGE_QUEUE_LOG_FILE is set, messages (and the position of the receiver) are also appended
+# to a log file, so that messages that hadn't been sent when the server stopped are sent after it restarts. Other processes
+# (e.g. the worker process) use MessageQueueBasic (see main.app), so the receiver also polls the messages table for their
+# messages. Unlike MessageQueueBasic, messages are not part of the caller's database transaction: add() makes a message
+# available to receivers immediately (and buffered() doesn't hold it), so a message is still sent if the request that added
+# it later rolls back.
+class MessageQueueMemory(MessageQueue):
+
+    def __init__(self, app_config):
+        self.messages = collections.deque(maxlen=app_config['MESSAGE_QUEUE_MEMORY_SIZE'])  # Message objects with consecutive IDs
+        self.ready = gevent.event.Event()  # set when a message is added
+        self.next_message_id = 1
+        self.last_sent_id = 0  # ID of the last message returned by receive()
+        self.log_file_name = app_config['MESSAGE_QUEUE_LOG_FILE']
+        self.log_file = None
+        self.log_record_count = 0
+        self.table_queue = MessageQueueBasic()  # used to receive messages from other processes
+        self.last_table_check = 0
+        if self.log_file_name:
+            self.load_log()
+            self.rewrite_log()  # start with a compact log (and open it for appending)
+
+    # add a single message to the queue; the message is sent even if the caller's database transaction is rolled back
+    def add(self, folder_id, folder_path, message_type, parameters=None, sender_controller_id=None, sender_user_id=None, timestamp=None):
+        from main.messages.models import Message  # would like to do at top, but creates import loop in __init__
+        message = Message(
+            id=self.next_message_id,
+            timestamp=timestamp or datetime.datetime.utcnow(),
+            sender_controller_id=sender_controller_id,
+            sender_user_id=sender_user_id,
+            folder_id=folder_id,
+            type=message_type,
+            parameters=json.dumps(parameters) if parameters else '{}',
+        )
+        self.next_message_id += 1
+        if len(self.messages) == self.messages.maxlen and self.messages[0].id > self.last_sent_id:
+            logger.warning('message queue full; dropping unsent message %d', self.messages[0].id)
+        self.messages.append(message)
+        if self.log_file:
+            self.write_log_record(message_record(message))
+        self.ready.set()
+
+    # returns a list of message objects once some are ready
+    def receive(self):
+        while True:
+            self.ready.wait(TABLE_POLL_INTERVAL)
+            self.ready.clear()
+            messages = self.unsent_messages()
+            if messages:
+                self.last_sent_id = messages[-1].id
+                if self.log_file:
+                    self.write_log_record({'sent': self.last_sent_id})
+            if time.monotonic() - self.last_table_check >= TABLE_POLL_INTERVAL:
+                self.last_table_check = time.monotonic()
+                messages += self.table_queue.new_messages()
+            if messages:
+                return messages
+
+    # get the messages in the buffer that haven't been returned by receive() yet
+    def unsent_messages(self):
+        if not self.messages:
+            return []
+        start = max(self.last_sent_id + 1 - self.messages[0].id, 0)  # message IDs are consecutive, so we can find the position
+        return list(itertools.islice(self.messages, start, None))
+
+    # append a record to the log file; we don't fsync, so a crash could lose the last few records (but a restart won't);
+    # the log is rewritten once it has many more records than the buffer
+    def write_log_record(self, record):
+        self.log_file.write(json.dumps(record) + '\n')
+        self.log_file.flush()
+        self.log_record_count += 1
+        if self.log_record_count > 2 * self.messages.maxlen + 100:
+            self.rewrite_log()
+
+    # load messages and the receiver position from the log file (if any)
+    def load_log(self):
+        from main.messages.models import Message  # would like to do at top, but creates import loop in __init__
+        if not os.path.exists(self.log_file_name):
+            return
+        with open(self.log_file_name, encoding='utf-8') as log_file:
+            for line in log_file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    logger.warning('ignoring invalid message log record')  # e.g. partially written before a crash
+                    continue
+                if 'sent' in record:
+                    self.last_sent_id = record['sent']
+                else:
+                    record['timestamp'] = parse_json_datetime(record['timestamp'])
+                    self.messages.append(Message(**record))
+                    self.next_message_id = record['id'] + 1
+        unsent_count = len(self.unsent_messages())
+        if unsent_count:
+            logger.info('%d unsent messages loaded from message log', unsent_count)
+            self.ready.set()
+
+    # replace the log file with one that contains only the messages currently in the buffer and the receiver position
+    def rewrite_log(self):
+        if self.log_file:
+            self.log_file.close()
+        temp_file_name = self.log_file_name + '.tmp'
+        with open(temp_file_name, 'w', encoding='utf-8') as temp_file:
+            for message in self.messages:
+                temp_file.write(json.dumps(message_record(message)) + '\n')
+            temp_file.write(json.dumps({'sent': self.last_sent_id}) + '\n')
+        os.replace(temp_file_name, self.log_file_name)
+        self.log_file = open(self.log_file_name, 'a', encoding='utf-8')  # pylint: disable=consider-using-with
+        self.log_record_count = len(self.messages) + 1
+
+
+# get a JSON-ready dictionary representing a message (for the message log)
+def message_record(message):
+    return {
+        'id': message.id,
+        'timestamp': message.timestamp.isoformat() + 'Z',
+        'sender_controller_id': message.sender_controller_id,
+        'sender_user_id': message.sender_user_id,
+        'folder_id': message.folder_id,
+        'type': message.type,
+        'parameters': message.parameters,
+    }
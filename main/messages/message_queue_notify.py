@@ -0,0 +1,92 @@
+import logging
+import gevent
+import gevent.select
+from sqlalchemy import text
+from .message_queue_basic import MessageQueueBasic
+
+
+logger = logging.getLogger(__name__)
+
+
+# the PostgreSQL notification channel used to announce new messages
+NOTIFY_CHANNEL = 'rhizo_messages'
+
+# number of seconds between checks for new messages when notifications aren't available (e.g. on SQLite)
+POLL_INTERVAL = 0.5
+
+# maximum number of seconds to wait for a notification before checking for new messages anyway
+# (in case a notification is lost, e.g. while reconnecting)
+LISTEN_TIMEOUT = 10
+
+
+# A message queue using the message table in the primary database along with PostgreSQL LISTEN/NOTIFY: each added message
+# sends a notification (delivered when the transaction commits) and receivers wait on a dedicated listening connection, so they
+# wake up immediately rather than polling the table. Receivers then fetch only the rows after the last message they returned.
+# On other databases (e.g. SQLite for development/tests), this falls back to polling.
+class MessageQueueNotify(MessageQueueBasic):
+
+    def __init__(self):
+        super().__init__()
+        self._listen_conn = None  # DBAPI connection (not part of the SQLAlchemy pool) used to LISTEN for notifications
+
+    # insert message rows into the messages table and notify receivers (the notification is delivered when the transaction commits)
+    def insert_messages(self, session, rows):
+        super().insert_messages(session, rows)
+        if session.get_bind().dialect.name == 'postgresql':
+            session.execute(text('NOTIFY %s' % NOTIFY_CHANNEL))
+
+    # returns a list of message objects once some are ready
+    def receive(self):
+        from main.app import db  # would like to do at top, but creates import loop in __init__
+        use_notify = db.engine.dialect.name == 'postgresql'
+        while True:
+            if use_notify:
+                self.listen()  # start listening before we check for messages, so we don't miss any notifications
+
+            messages = self.new_messages()
+            if messages:
+                return messages
+            db.session.rollback()  # end the transaction so we don't sit idle in it while waiting
+
+            if use_notify and self._listen_conn:
+                self.wait_for_notification()
+            else:
+                gevent.sleep(POLL_INTERVAL)
+
+    # open a dedicated connection that listens for message notifications (if not already open)
+    def listen(self):
+        from main.app import db  # would like to do at top, but creates import loop in __init__
+        if self._listen_conn:
+            return
+        try:
+            pool_conn = db.engine.raw_connection()
+            pool_conn.detach()  # this connection stays open for the life of the process, so take it out of the pool
+            conn = pool_conn.connection
+            conn.autocommit = True  # notifications are only delivered outside of transactions
+            cursor = conn.cursor()
+            cursor.execute('LISTEN %s' % NOTIFY_CHANNEL)
+            cursor.close()
+            self._listen_conn = conn
+        # handle all exceptions because we can fall back to polling until the database is available again
+        # pylint: disable=broad-except
+        except Exception:
+            logger.exception('unable to listen for message notifications')
+
+    # wait until a notification arrives (or a timeout passes); uses gevent's select so other greenlets can run while we wait
+    def wait_for_notification(self):
+        conn = self._listen_conn
+        try:
+            if not conn.notifies:
+                gevent.select.select([conn], [], [], LISTEN_TIMEOUT)
+            conn.poll()
+            del conn.notifies[:]  # we fetch all new messages, so we don't need to look at individual notifications
+        # handle all exceptions (e.g. the connection was closed by the database) so that we can reconnect
+        # pylint: disable=broad-except
+        except Exception:
+            logger.exception('error waiting for message notifications; will reconnect')
+            self._listen_conn = None
+            try:
+                conn.close()
+            except Exception:  # pylint: disable=broad-except
+                pass
+            gevent.sleep(POLL_INTERVAL)
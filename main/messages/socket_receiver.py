@@ -14,7 +14,8 @@ from sqlalchemy.orm.exc import NoResultFound
 
 
 # internal imports
-from main.app import db, socket_sender, message_queue
+from main.app import app, db, socket_sender, message_queue
+from main.util import TokenBucket
 from main.users.auth import find_key
 from main.users.permissions import ACCESS_LEVEL_READ, ACCESS_LEVEL_WRITE
 from main.messages.outgoing_messages import handle_send_email, handle_send_text_message
@@ -88,21 +89,25 @@ def manage_web_socket(ws):
     # register this socket to receive outgoing messages
     socket_sender.register(ws_conn)
 
-    # process incoming messages
-    while not ws_conn.ws.closed:
-        message = ws_conn.ws.receive()
-        if message:
-            try:
-                message_struct = json.loads(message)
-            except json.JSONDecodeError:
-                break  # if client sends bad message; close this connection
-            process_web_socket_message(message_struct, ws_conn)
-        gevent.sleep(0.05)  # sleep to let other stuff run
-
-    # websocket has been closed
-    ws_conn.log_disconnect()
-    socket_sender.unregister(ws_conn)
-    db.session.close()
+    # process incoming messages; receive() waits (letting other greenlets run) until a message arrives, so we don't need to
+    # sleep between messages; a burst of messages is limited by the connection's inbound rate limit rather than a fixed delay
+    rate_limit = TokenBucket(app.config['WEB_SOCKET_RATE_LIMIT'], app.config['WEB_SOCKET_RATE_BURST'])
+    try:
+        while not ws_conn.ws.closed:
+            message = ws_conn.ws.receive()
+            if message:
+                try:
+                    message_struct = json.loads(message)
+                except json.JSONDecodeError:
+                    break  # if client sends bad message; close this connection
+                process_web_socket_message(message_struct, ws_conn)
+                gevent.sleep(rate_limit.take())  # (a zero sleep still yields, in case the messages are already buffered)
+
+    # websocket has been closed (or message handling failed); make sure the writer greenlet and subscriptions are cleaned up
+    finally:
+        ws_conn.log_disconnect()
+        socket_sender.unregister(ws_conn)
+        db.session.close()
 
 
 # handle a message received from a websocket
@@ -155,7 +160,7 @@ def process_web_socket_message(message_struct, ws_conn):
             if ws_conn.access_level(folder_id) >= ACCESS_LEVEL_READ:
                 if message_debug:
                     print('subscribe folder: %s (%d), message type: %s' % (folder_path, folder_id, message_type))
-                ws_conn.subscriptions.append(MessageSubscription(folder_id, message_type, include_children=include_children))
+                socket_sender.subscribe(ws_conn, MessageSubscription(folder_id, message_type, include_children=include_children))
 
     # fix(soon): remove this case after clients are updated
     elif message_type == 'setNode' or message_type == 'updateSequence' or message_type == 'update_sequence':
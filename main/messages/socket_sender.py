@@ -14,16 +14,42 @@ class SocketSender(object):
     def __init__(self):
         logger.info('init socket sender')
         self.connections = []  # list of WebSocketConnection objects
+        self.routes = {}  # folder ID -> set of (WebSocketConnection, message type or None for any type) subscribed to that folder
 
-    # register a client (possible message recipient)
+    # register a client (possible message recipient) and start a greenlet that sends its messages
     def register(self, ws_conn):
         logger.info('client registered (%s)', ws_conn)
         self.connections.append(ws_conn)
+        gevent.spawn(self.write_messages, ws_conn)
 
-    # unregister a client (e.g. after it has been closed
+    # unregister a client (e.g. after it has been closed; also removes its subscriptions from the routing index
     def unregister(self, ws_conn):
         logger.info('client unregistered (%s)', ws_conn)
         self.connections.remove(ws_conn)
+        ws_conn.closing = True
+        ws_conn.send_ready.set()  # let the writer greenlet exit
+        for subscription in ws_conn.subscriptions:
+            for folder_id in subscription.folder_ids:
+                routes = self.routes.get(folder_id)
+                if routes:
+                    routes.discard((ws_conn, subscription.message_type))
+                    if not routes:
+                        del self.routes[folder_id]
+
+    # add a subscription for a client and add it to the routing index
+    def subscribe(self, ws_conn, subscription):
+        ws_conn.subscriptions.append(subscription)
+        for folder_id in subscription.folder_ids:
+            self.routes.setdefault(folder_id, set()).add((ws_conn, subscription.message_type))
+
+    # get the set of clients that should receive a message (based on their current subscriptions); uses the routing index,
+    # so this only looks at subscriptions to the message's folder
+    def subscribers(self, message):
+        ws_conns = set()
+        for (ws_conn, message_type) in self.routes.get(message.folder_id, ()):
+            if (message_type is None or message_type == message.type) and not is_own_message(message, ws_conn):
+                ws_conns.add(ws_conn)
+        return ws_conns
 
     # send a message to a specific client (using websocket connection specified in ws_conn)
     def send(self, ws_conn, message):
@@ -54,7 +80,7 @@ class SocketSender(object):
 
             # get all messages since the last message we processed
             messages = message_queue.receive()
-            logger.debug('received %d messages from message queue', messages.count())
+            logger.debug('received %d messages from message queue', len(messages))
             for message in messages:
                 logger.debug('message type: %s, folder: %s', message.type, message.folder_id)
 
@@ -62,21 +88,42 @@ class SocketSender(object):
                 if message.type == 'requestProcessStatus':
                     self.send_process_status()
 
-                # all other messages are passed to clients managed by this process
+                # all other messages are passed to clients managed by this process; each message is serialized once and
+                # the same payload is queued for all of its recipients
                 else:
-                    for ws_conn in self.connections:
-                        if client_is_subscribed(message, ws_conn, False):
-                            message_struct = {
-                                'type': message.type,
-                                'timestamp': message.timestamp.isoformat() + 'Z',
-                                'parameters': json.loads(message.parameters)
-                            }
-                            gevent.spawn(self.send, ws_conn, json.dumps(message_struct))
-                            if ws_conn.controller_id:
+                    ws_conns = self.subscribers(message)
+                    if ws_conns:
+                        payload = message_payload(message)
+                        coalesce_key = message_coalesce_key(message)
+                        for ws_conn in ws_conns:
+                            if not ws_conn.queue_message(payload, coalesce_key):
+                                self.disconnect(ws_conn)
+                            elif ws_conn.controller_id:
                                 logger.debug('sending message to controller; type: %s', message.type)
                             else:
                                 logger.debug('sending message to browser; type: %s', message.type)
 
+    # this function sits in a loop, sending the messages queued for a client (in order) until the connection is closed
+    def write_messages(self, ws_conn):
+        while not ws_conn.closing and not ws_conn.ws.closed:
+            ws_conn.send_ready.wait()
+            ws_conn.send_ready.clear()
+            while ws_conn.send_queue and not ws_conn.closing and not ws_conn.ws.closed:
+                (payload, _) = ws_conn.send_queue.popleft()
+                self.send(ws_conn, payload)
+                ws_conn.sent_count += 1
+
+    # close the connection to a client that isn't keeping up with its messages
+    def disconnect(self, ws_conn):
+        ws_conn.dropped_count += len(ws_conn.send_queue)
+        ws_conn.send_queue.clear()
+        if not ws_conn.ws.closed:  # may already be closed if we have more messages before the connection is unregistered
+            logger.warning('disconnecting client with full send queue (%s): %s', ws_conn, ws_conn.queue_stats())
+            try:
+                ws_conn.ws.close()
+            except WebSocketError:
+                pass
+
     # spawn a greenlet that sends messages to clients
     def start(self):
         gevent.spawn(self.send_messages)
@@ -98,6 +145,7 @@ class SocketSender(object):
                 'auth_method': ws_conn.auth_method,
                 'process_id': process_id,
                 'subscriptions': [s.as_dict() for s in ws_conn.subscriptions],
+                'send_queue': ws_conn.queue_stats(),
             })
         parameters = {
             'process_id': process_id,
@@ -109,22 +157,30 @@ class SocketSender(object):
         message_queue.add(system_folder_id, '/system', 'processStatus', parameters)
 
 
-# returns True if the given message should be sent to the given client (based on its current subscriptions)
-# fix(clean): move into wsConn?
-def client_is_subscribed(message, ws_conn, debug_mode):
+# get the text sent to clients for a message record; the parameters are already stored as JSON, so we insert them directly
+# rather than decoding and re-encoding them
+def message_payload(message):
+    return '{"type": %s, "timestamp": %s, "parameters": %s}' % (
+        json.dumps(message.type),
+        json.dumps(message.timestamp.isoformat() + 'Z'),
+        message.parameters or '{}',
+    )
+
+
+# get the key used to coalesce queued messages: a client that falls behind only needs the latest update for each sequence
+def message_coalesce_key(message):
+    if message.type == 'sequence_update':
+        return json.loads(message.parameters).get('id')
+    return None
+
+
+# returns True if the given message was sent by the given client (we don't bounce messages back to their senders)
+def is_own_message(message, ws_conn):
     if message.sender_controller_id:
         if ws_conn.controller_id and message.sender_controller_id == ws_conn.controller_id:
-            return False  # don't bounce messages back to controller sender
+            return True  # controller sender
         if ws_conn.user_id and message.sender_user_id == ws_conn.user_id:
-            return False  # don't bounce messages back to user sender (note this prevents sending message from one browser tab to another)
-    for subscription in ws_conn.subscriptions:
-        if subscription.matches(message):
-            if debug_mode:
-                print('    client subscription matches; folders: %s, type: %s' % (subscription.folder_ids, subscription.message_type))
-            return True
-        else:
-            if debug_mode:
-                print('    client subscription does not match; folders: %s, type: %s' % (subscription.folder_ids, subscription.message_type))
+            return True  # user sender (note this prevents sending message from one browser tab to another)
     return False
 
 
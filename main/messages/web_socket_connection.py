@@ -1,12 +1,17 @@
+import collections
+import gevent.event
 from sqlalchemy import not_
 from sqlalchemy.orm.exc import NoResultFound
-from main.app import db
+from main.app import app, db
 from main.users.permissions import access_level, ACCESS_LEVEL_NONE
 from main.resources.models import Resource, ControllerStatus
 
 
 # The WebSocketConnection class represents a connection to a client controller or browser.
-# It is a wrapper for a flask_socket websocket object.
+# It is a wrapper for a flask_socket websocket object. Outgoing messages are placed in a bounded queue that is sent by a single
+# writer greenlet (see SocketSender.write_messages), so a slow client can't tie up more than one greenlet. If the queue
+# overflows, older sequence_update messages for the same sequence are dropped (keeping the latest value); if that isn't
+# enough, the client is too far behind and should be disconnected.
 class WebSocketConnection(object):
 
     # create connection with a new/live flask_socket websocket object
@@ -16,6 +21,13 @@ class WebSocketConnection(object):
         self.user_id = None
         self.controller_id = None
         self.auth_method = None
+        self.send_queue = collections.deque()  # (message payload, coalesce key or None) waiting to be sent
+        self.send_queue_size = app.config['WEB_SOCKET_SEND_QUEUE_SIZE']
+        self.send_ready = gevent.event.Event()  # set when the send queue has messages (or the connection is closing)
+        self.closing = False  # set when the connection is unregistered; tells the writer greenlet to exit
+        self.max_queue_depth = 0
+        self.sent_count = 0
+        self.dropped_count = 0  # messages removed by coalescing or discarded on disconnect
 
     # a string representation of the identity of this websocket connection (possibly not unique)
     def __repr__(self):
@@ -38,6 +50,41 @@ class WebSocketConnection(object):
             pass
         return client_access_level
 
+    # add a message payload to the send queue; messages with the same coalesce key (e.g. updates for the same sequence) may be
+    # replaced by later ones if the queue overflows; returns False if the queue is still full (the client should be disconnected)
+    def queue_message(self, payload, coalesce_key=None):
+        self.send_queue.append((payload, coalesce_key))
+        if len(self.send_queue) > self.send_queue_size:
+            self.coalesce()
+            if len(self.send_queue) > self.send_queue_size:
+                return False
+        self.max_queue_depth = max(self.max_queue_depth, len(self.send_queue))
+        self.send_ready.set()
+        return True
+
+    # remove queued messages that have been superseded by later messages with the same coalesce key
+    def coalesce(self):
+        seen_keys = set()
+        kept = []
+        for (payload, coalesce_key) in reversed(self.send_queue):
+            if coalesce_key is not None:
+                if coalesce_key in seen_keys:
+                    self.dropped_count += 1
+                    continue
+                seen_keys.add(coalesce_key)
+            kept.append((payload, coalesce_key))
+        kept.reverse()
+        self.send_queue = collections.deque(kept)
+
+    # get information about this connection's send queue
+    def queue_stats(self):
+        return {
+            'queue_depth': len(self.send_queue),
+            'max_queue_depth': self.max_queue_depth,
+            'sent': self.sent_count,
+            'dropped': self.dropped_count,
+        }
+
     # returns True if connected
     def connected(self):
         return not self.ws.closed
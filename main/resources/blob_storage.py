@@ -0,0 +1,100 @@
+# standard python imports
+import hashlib
+import datetime
+
+
+# external imports
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+
+
+# internal imports
+from main.app import app, db, storage_manager
+from main.resources.models import ResourceRevision, StorageBlob, RevisionBlob
+
+
+# whether any revisions have content-addressed blobs (once we've checked; set when we add one); see revision_storage_path
+_revision_blobs = {}
+
+
+# get the path of a content-addressed object in the bulk storage system
+def blob_storage_path(digest):
+    return 'blobs/%s/%s/%s' % (digest[:2], digest[2:4], digest)
+
+
+# get the path of the bulk storage object holding the data for a resource revision; revisions written while
+# CONTENT_ADDRESSED_STORAGE was enabled keep their blobs after it is turned off, so we only skip the blob lookup
+# if the setting is off and there are no blob references at all (in which case new ones won't be added by any process)
+def revision_storage_path(resource, revision_id):
+    if not app.config['CONTENT_ADDRESSED_STORAGE']:
+        if 'exist' not in _revision_blobs:
+            _revision_blobs['exist'] = db.session.query(RevisionBlob.query.exists()).scalar()
+        if not _revision_blobs['exist']:
+            return resource.storage_path(revision_id)
+    digest = (
+        db.session.query(StorageBlob.digest)
+        .join(RevisionBlob, RevisionBlob.blob_id == StorageBlob.id)
+        .filter(RevisionBlob.revision_id == revision_id)
+        .scalar()
+    )
+    return blob_storage_path(digest) if digest else resource.storage_path(revision_id)
+
+
+# store the data for a (flushed) resource revision as a content-addressed blob; if we already have a blob with the same contents,
+# we just add a reference to it (without writing to bulk storage); as with add_resource_revision, outside code must commit
+def add_revision_blob(resource_revision, data):
+    digest = hashlib.sha1(data).hexdigest()
+    add_revision_blob_chunks(resource_revision, digest, len(data), lambda: [data])
+
+
+# store the data for a (flushed) resource revision as a content-addressed blob, given the digest and size of the data and
+# a function that returns the data as a sequence of chunks (only called if we need to write a new blob)
+def add_revision_blob_chunks(resource_revision, digest, size, get_chunks):
+    blob = StorageBlob.query.filter(StorageBlob.digest == digest).first()
+    if not blob or not _add_blob_reference(blob.id):  # the blob could be deleted after we find it
+        # if another process is storing the same data, it will write the same contents
+        storage_manager.write_chunks(blob_storage_path(digest), get_chunks())
+        blob = StorageBlob(digest=digest, size=size, ref_count=1, creation_timestamp=datetime.datetime.utcnow())
+        try:
+            with db.session.begin_nested():
+                db.session.add(blob)
+        except IntegrityError:  # another process added the same blob
+            blob = StorageBlob.query.filter(StorageBlob.digest == digest).one()
+            _add_blob_reference(blob.id)
+    db.session.add(RevisionBlob(revision_id=resource_revision.id, blob_id=blob.id))
+    _revision_blobs['exist'] = True
+
+
+# release the blobs (if any) used by the revisions matching the given filter criteria; this should be called before the revisions are deleted;
+# blobs that are no longer used are left in place for delete_unused_blobs; as with add_resource_revision, outside code must commit
+def release_revision_blobs(*criteria):
+    revision_ids = db.session.query(ResourceRevision.id).filter(*criteria)
+    blob_counts = (
+        db.session.query(RevisionBlob.blob_id, func.count(RevisionBlob.revision_id))
+        .filter(RevisionBlob.revision_id.in_(revision_ids))
+        .group_by(RevisionBlob.blob_id)
+        .all()
+    )
+    if blob_counts:
+        RevisionBlob.query.filter(RevisionBlob.revision_id.in_(revision_ids)).delete(synchronize_session=False)
+        for (blob_id, count) in blob_counts:
+            StorageBlob.query.filter(StorageBlob.id == blob_id).update({'ref_count': StorageBlob.ref_count - count}, synchronize_session=False)
+
+
+# remove blobs that are no longer used by any revisions from the database and bulk storage; commits; returns the number of blobs removed
+# fix(later): there is a small window in which a concurrent upload of the same contents could write the object just before we delete it
+def delete_unused_blobs():
+    delete_count = 0
+    for blob in StorageBlob.query.filter(StorageBlob.ref_count <= 0).all():
+        (blob_id, digest) = (blob.id, blob.digest)
+        if StorageBlob.query.filter(StorageBlob.id == blob_id, StorageBlob.ref_count <= 0).delete(synchronize_session=False):
+            db.session.commit()  # once the record is gone, new revisions with the same contents will create a new blob
+            storage_manager.delete(blob_storage_path(digest))
+            delete_count += 1
+    db.session.commit()
+    return delete_count
+
+
+# increment the reference count of a blob (in the database, so that concurrent updates aren't lost); returns False if the blob no longer exists
+def _add_blob_reference(blob_id):
+    return StorageBlob.query.filter(StorageBlob.id == blob_id).update({'ref_count': StorageBlob.ref_count + 1}, synchronize_session=False) > 0
@@ -0,0 +1,194 @@
+import os
+import time
+import logging
+import tempfile
+from main.util import LRUCache
+from .storage_manager import StorageManager, CHUNK_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+
+# The CachingStorageManager class wraps another storage manager (e.g. S3StorageManager) with a size-bounded local disk cache.
+# Objects are added to the cache when written or read and the least recently used objects are removed once the cache exceeds
+# STORAGE_CACHE_SIZE bytes. Cache files mirror the bulk storage paths and are written atomically (to a temp file that is then renamed),
+# so other processes sharing the cache directory never see partial files. Each process keeps its own LRU index (loaded from the cache
+# directory on startup), so a file may be evicted by another process, in which case we just treat it as a miss. The index is an
+# LRUCache (mapping data paths to sizes), which is thread-safe, since storage reads may come from thread pools.
+class CachingStorageManager(StorageManager):
+
+    def __init__(self, storage_manager, app_config):
+        self.storage_manager = storage_manager
+        self.cache_path = app_config['STORAGE_CACHE_PATH']
+        self.max_bytes = app_config['STORAGE_CACHE_SIZE']
+        self.index = LRUCache(self.max_bytes, on_evict=self.evicted)  # data path -> size
+        if not os.path.exists(self.cache_path):
+            os.makedirs(self.cache_path)
+        self.load_index()
+
+    # write data to bulk storage (and the cache)
+    def write(self, data_path, data):
+        self.storage_manager.write(data_path, data)
+        self.add_to_cache(data_path, data)
+
+    # write data provided as a sequence of chunks to bulk storage (and the cache)
+    def write_chunks(self, data_path, chunks):
+        self.storage_manager.write_chunks(data_path, self.cache_chunks(data_path, chunks))
+
+    # read data from the cache or (if not cached) from bulk storage
+    def read(self, data_path):
+        if self.index.get(data_path) is not None:
+            try:
+                with open(self.cache_file_name(data_path), 'rb') as cache_file:
+                    return cache_file.read()
+            except FileNotFoundError:  # evicted by another process
+                self.index.discard(data_path)
+        data = self.storage_manager.read(data_path)
+        if data is not None:
+            self.add_to_cache(data_path, data)
+        return data
+
+    # read data as a sequence of chunks from the cache or (if not cached) from bulk storage; objects read from bulk storage
+    # are added to the cache as they are read
+    def read_chunks(self, data_path, chunk_size=CHUNK_SIZE):
+        if self.index.get(data_path) is not None:
+            try:
+                cache_file = open(self.cache_file_name(data_path), 'rb')
+            except FileNotFoundError:  # evicted by another process
+                self.index.discard(data_path)
+            else:
+                with cache_file:
+                    for chunk in iter(lambda: cache_file.read(chunk_size), b''):
+                        yield chunk
+                return
+        for chunk in self.cache_chunks(data_path, self.storage_manager.read_chunks(data_path, chunk_size)):
+            yield chunk
+
+    # read part of an object from the cache or (if not cached) from bulk storage; partial reads don't add objects to the cache
+    def read_range(self, data_path, start, end):
+        cache_file = self.open_file(data_path)
+        if cache_file:
+            with cache_file:
+                cache_file.seek(start)
+                return cache_file.read(max(end - start, 0))
+        return self.storage_manager.read_range(data_path, start, end)
+
+    # returns the size of an object in bulk storage (or None if not found)
+    def size(self, data_path):
+        size = self.index.peek(data_path)
+        if size is not None:
+            return size
+        return self.storage_manager.size(data_path)
+
+    # returns a binary file object for reading a cached object (or the underlying storage manager's file object if not cached)
+    def open_file(self, data_path):
+        if self.index.get(data_path) is not None:
+            try:
+                return open(self.cache_file_name(data_path), 'rb')
+            except FileNotFoundError:  # evicted by another process
+                self.index.discard(data_path)
+        return self.storage_manager.open_file(data_path)
+
+    # returns true if object exists in bulk storage
+    def exists(self, data_path):
+        return data_path in self.index or self.storage_manager.exists(data_path)
+
+    # delete an object from bulk storage (and the cache)
+    def delete(self, data_path):
+        self.storage_manager.delete(data_path)
+        self.remove_from_cache(data_path)
+
+    # delete a batch of objects from bulk storage (and the cache)
+    def delete_many(self, data_paths):
+        self.storage_manager.delete_many(data_paths)
+        for data_path in data_paths:
+            self.remove_from_cache(data_path)
+
+    # list the objects in bulk storage
+    def list_paths(self, prefix=''):
+        return self.storage_manager.list_paths(prefix)
+
+    # total size of the cached objects
+    @property
+    def total_size(self):
+        return self.index.total_size
+
+    # get information about cache usage
+    def stats(self):
+        index_stats = self.index.stats()
+        return {
+            'size': index_stats['bytes'],
+            'max_size': self.max_bytes,
+            'count': index_stats['items'],
+            'hits': index_stats['hits'],
+            'misses': index_stats['misses'],
+            'evictions': index_stats['evictions'],
+            'hit_ratio': index_stats['hit_ratio'],
+        }
+
+    # get the name of the cache file for an object in bulk storage
+    def cache_file_name(self, data_path):
+        assert not data_path.startswith('/') and '..' not in data_path
+        return os.path.join(self.cache_path, data_path)
+
+    # add an object to the cache
+    def add_to_cache(self, data_path, data):
+        for _ in self.cache_chunks(data_path, [data]):
+            pass
+
+    # write a sequence of chunks to the cache; this is a generator that yields the chunks as they are written, so that data can be
+    # cached while it is streamed; objects larger than the whole cache are not cached
+    def cache_chunks(self, data_path, chunks):
+        size = 0
+        (fd, temp_file_name) = tempfile.mkstemp(dir=self.cache_path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in chunks:
+                    if size + len(chunk) <= self.max_bytes:
+                        temp_file.write(chunk)
+                    size += len(chunk)
+                    yield chunk
+            if size <= self.max_bytes:
+                file_name = self.cache_file_name(data_path)
+                os.makedirs(os.path.dirname(file_name), exist_ok=True)
+                os.replace(temp_file_name, file_name)  # atomic, so readers never see partial files
+                self.index.put(data_path, size, size)  # may evict other objects
+        finally:
+            self.remove_file(temp_file_name)
+
+    # remove the file of an object evicted from the LRU index
+    def evicted(self, data_path, size):
+        # pylint: disable=unused-argument
+        self.remove_file(self.cache_file_name(data_path))
+
+    # remove an object from the cache
+    def remove_from_cache(self, data_path):
+        self.index.discard(data_path)
+        self.remove_file(self.cache_file_name(data_path))
+
+    # remove a file, ignoring files that have already been removed (e.g. by another process)
+    def remove_file(self, file_name):
+        try:
+            os.unlink(file_name)
+        except FileNotFoundError:
+            pass
+
+    # build the LRU index from the files in the cache directory (using modification times as an approximation of last use);
+    # also removes partial files left by processes that stopped while writing to the cache
+    def load_index(self):
+        files = []
+        for (dir_name, _, file_names) in os.walk(self.cache_path):
+            for file_name in file_names:
+                path = os.path.join(dir_name, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if dir_name == self.cache_path and file_name.endswith('.tmp'):
+                    if stat.st_mtime < time.time() - 60 * 60:  # if recent, could still be in use by another process
+                        logger.info('removing partial cache file: %s', file_name)
+                        self.remove_file(path)
+                else:
+                    files.append((stat.st_mtime, os.path.relpath(path, self.cache_path), stat.st_size))
+        for (_, data_path, size) in sorted(files):
+            self.index.put(data_path, size, size)  # (oldest first, so the most recently used files are kept)
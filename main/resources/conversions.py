@@ -0,0 +1,80 @@
+# standard python imports
+import logging
+
+
+# internal imports
+from main.app import app, storage_manager
+from main.util import LRUCache
+from main.resources.file_conversion import convert_csv_to_xls, process_doc_page
+from main.resources.resource_util import read_resource, read_resource_chunks
+
+
+logger = logging.getLogger(__name__)
+
+
+# conversions we can provide for downloads: (source file extension, target format) -> function that converts a sequence of chunks
+CONVERTERS = {
+    ('csv', 'xls'): convert_csv_to_xls,
+}
+
+
+# recently used conversion results, keyed by (resource ID, revision ID, target format)
+conversion_cache = LRUCache(app.config['CONVERSION_CACHE_SIZE'])
+
+
+# recently rendered doc pages (HTML strings), keyed by (resource ID, revision ID)
+doc_page_cache = LRUCache(app.config['DOC_PAGE_CACHE_SIZE'])
+
+
+# get the path of a conversion result in the bulk storage system (stored next to the source revision, so it is removed along
+# with the revision by the storage garbage collector)
+def conversion_storage_path(resource, revision_id, target_format):
+    return '%s.converted.%s' % (resource.storage_path(revision_id), target_format)
+
+
+# returns true if we can convert the given file to the given format
+def can_convert(resource, target_format):
+    return (resource.name.rsplit('.', 1)[-1].lower(), target_format) in CONVERTERS
+
+
+# get the current revision of a file converted to the given format; results are cached in memory and in bulk storage, so the
+# conversion only runs once per revision (per server, if there is no storage manager); returns None if the file has no data
+def read_converted_resource(resource, target_format):
+    revision_id = resource.last_revision_id
+    if not revision_id:
+        return None
+    key = (resource.id, revision_id, target_format)
+    data = conversion_cache.get(key)
+    if data is None and storage_manager:
+        data = storage_manager.read(conversion_storage_path(resource, revision_id, target_format))
+    if data is None:
+        converter = CONVERTERS[(resource.name.rsplit('.', 1)[-1].lower(), target_format)]
+        data = converter(read_resource_chunks(resource, revision_id))  # the source is parsed as it is read
+        if storage_manager:
+            storage_manager.write(conversion_storage_path(resource, revision_id, target_format), data)
+    conversion_cache.put(key, data)
+    return data
+
+
+# get the current revision of a markdown file rendered as HTML; the result is cached in memory (and, if DOC_PAGE_STORE_RENDERED
+# is set, in bulk storage), so pages are only parsed when a new revision is written; returns None if the file has no data
+def read_doc_page_html(resource, check_timing=False):
+    revision_id = resource.last_revision_id
+    if not revision_id:
+        return None
+    key = (resource.id, revision_id)
+    html = doc_page_cache.get(key)
+    store_rendered = storage_manager and app.config['DOC_PAGE_STORE_RENDERED']
+    if html is None and store_rendered:
+        data = storage_manager.read(conversion_storage_path(resource, revision_id, 'html'))
+        if data is not None:
+            html = data.decode()
+    if html is None:
+        contents = read_resource(resource, revision_id, check_timing=check_timing)
+        if contents is None:
+            return None
+        html = process_doc_page(contents.decode())
+        if store_rendered:
+            storage_manager.write(conversion_storage_path(resource, revision_id, 'html'), html.encode())
+    doc_page_cache.put(key, html)
+    return html
@@ -1,5 +1,6 @@
 from io import BytesIO, StringIO
 import csv
+import codecs
 import markdown
 import xlwt
 import xlrd
@@ -13,12 +14,34 @@ def compute_thumbnail(image_data, width, output_format='JPEG'):
     max_height = width * 10
     in_stream = BytesIO(image_data)
     image = Image.open(in_stream)
+    if output_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')  # JPEG doesn't support alpha channels or palettes
     image.thumbnail((max_width, max_height), Image.ANTIALIAS)
     out_stream = BytesIO()
     image.save(out_stream, format=output_format, quality=80)
     return (out_stream.getvalue(), image.size[0], image.size[1])
 
 
+# returns a buffer containing a single JPEG image with the given images (provided as buffers) stacked vertically,
+# along with an (x, y, width, height) box for each image within the combined image
+def compose_sprite_sheet(images_data):
+    images = [Image.open(BytesIO(image_data)) for image_data in images_data]
+    width = max([image.size[0] for image in images] + [1])
+    height = sum([image.size[1] for image in images]) or 1
+    sprite_sheet = Image.new('RGB', (width, height))
+    boxes = []
+    y = 0
+    for image in images:
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        sprite_sheet.paste(image, (0, y))
+        boxes.append((0, y, image.size[0], image.size[1]))
+        y += image.size[1]
+    out_stream = BytesIO()
+    sprite_sheet.save(out_stream, format='JPEG', quality=80)
+    return (out_stream.getvalue(), boxes)
+
+
 # convert markdown to HTML, handling some custom extensions
 # fix(clean): move elsewhere?
 def process_doc_page(markdown_source):
@@ -45,12 +68,15 @@ def process_doc_page(markdown_source):
     return '\n'.join(output_lines)
 
 
-# convert a CSV file to an XLS file; input is data contents; output is data contents
+# convert a CSV file to an XLS file; input is data contents (a string or bytes) or a sequence of binary chunks (which are
+# decoded and parsed a row at a time, so the CSV text doesn't need to be held in memory); output is data contents
 def convert_csv_to_xls(data):
 
     # create CSV reader for the data
-    in_stream = StringIO(data)
-    reader = csv.reader(in_stream)
+    if isinstance(data, str):
+        reader = csv.reader(StringIO(data))
+    else:
+        reader = csv.reader(text_lines([data] if isinstance(data, bytes) else data))
 
     # create Excel workbook
     wb = xlwt.Workbook()
@@ -67,6 +93,20 @@ def convert_csv_to_xls(data):
     return out_stream.getvalue()
 
 
+# decode a sequence of UTF-8 binary chunks into a sequence of lines (including line endings)
+def text_lines(chunks):
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    partial_line = ''
+    for chunk in chunks:
+        lines = (partial_line + decoder.decode(chunk)).split('\n')
+        partial_line = lines.pop()  # (empty if the chunk ended with a line ending)
+        for line in lines:
+            yield line + '\n'
+    partial_line += decoder.decode(b'', final=True)
+    if partial_line:
+        yield partial_line
+
+
 # convert an XLS or XLSX file to a CSV; input is data contents; output is data contents
 def convert_xls_to_csv(data):
 
@@ -1,19 +1,41 @@
 import os
+import datetime
+import tempfile
+from gevent.threadpool import ThreadPool
+from .storage_manager import StorageManager, CHUNK_SIZE
 
 
-class FileSystemStorageManager():
+# number of threads used to delete files in parallel
+DELETE_THREAD_COUNT = 8
+
+
+class FileSystemStorageManager(StorageManager):
 
     def __init__(self, app_config):
         self.storage_path = app_config['FILE_SYSTEM_STORAGE_PATH']
+        self.delete_pool = None  # created when first needed
 
     # write data to bulk storage
     def write(self, data_path, data):
+        self.write_chunks(data_path, [data])
+
+    # write data provided as a sequence of chunks to bulk storage; the data is written to a temp file that is then renamed,
+    # so readers never see a partially written file
+    def write_chunks(self, data_path, chunks):
         assert not data_path.startswith('/')
         path = self.storage_path + '/' + data_path
         dir_name = os.path.dirname(path)
         if not os.path.exists(dir_name):
-            os.makedirs(dir_name)
-        open(path, 'wb').write(data)
+            os.makedirs(dir_name, exist_ok=True)
+        (fd, temp_path) = tempfile.mkstemp(dir=dir_name, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as output_file:
+                for chunk in chunks:
+                    output_file.write(chunk)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.unlink(temp_path)
 
     # read data from bulk storage
     def read(self, data_path):
@@ -24,6 +46,47 @@ class FileSystemStorageManager():
         else:
             return None
 
+    # read data from bulk storage as a sequence of chunks
+    def read_chunks(self, data_path, chunk_size=CHUNK_SIZE):
+        assert not data_path.startswith('/')
+        path = self.storage_path + '/' + data_path
+        if os.path.exists(path):
+            with open(path, 'rb') as input_file:
+                while True:
+                    chunk = input_file.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+
+    # read part of an object (from start up to but not including end) from bulk storage
+    def read_range(self, data_path, start, end):
+        assert not data_path.startswith('/')
+        path = self.storage_path + '/' + data_path
+        if os.path.exists(path):
+            with open(path, 'rb') as input_file:
+                input_file.seek(start)
+                return input_file.read(max(end - start, 0))
+        else:
+            return None
+
+    # returns the size of an object in bulk storage (or None if not found)
+    def size(self, data_path):
+        assert not data_path.startswith('/')
+        path = self.storage_path + '/' + data_path
+        if os.path.exists(path):
+            return os.path.getsize(path)
+        else:
+            return None
+
+    # returns a binary file object for reading an object in bulk storage (or None if not found)
+    def open_file(self, data_path):
+        assert not data_path.startswith('/')
+        path = self.storage_path + '/' + data_path
+        if os.path.exists(path):
+            return open(path, 'rb')
+        else:
+            return None
+
     # returns true if object exists in bulk storage
     # fix(later): remove this?
     def exists(self, data_path):
@@ -35,3 +98,39 @@ class FileSystemStorageManager():
         assert not data_path.startswith('/')
         path = self.storage_path + '/' + data_path
         os.unlink(path)
+
+    # delete a batch of files in bulk storage (ignoring any that don't exist); the files are removed in parallel by a small
+    # pool of threads, since each unlink may wait on the disk (or a network file system)
+    def delete_many(self, data_paths):
+        if self.delete_pool is None:
+            self.delete_pool = ThreadPool(DELETE_THREAD_COUNT)
+        for data_path in data_paths:
+            assert not data_path.startswith('/')
+        paths = [self.storage_path + '/' + data_path for data_path in data_paths]
+        for _ in self.delete_pool.imap_unordered(_unlink_if_exists, paths):
+            pass
+
+    # list the files in bulk storage (with paths starting with the given prefix); yields (data path, last modified UTC datetime)
+    def list_paths(self, prefix=''):
+        for (dir_name, dir_names, file_names) in os.walk(self.storage_path):
+            if dir_name == self.storage_path and 'segments' in dir_names:
+                dir_names.remove('segments')  # used by SegmentStorageManager (which lists packed objects separately)
+            dir_names.sort()
+            rel_dir_name = os.path.relpath(dir_name, self.storage_path)
+            for file_name in sorted(file_names):
+                data_path = file_name if rel_dir_name == '.' else rel_dir_name + '/' + file_name
+                if file_name.endswith('.tmp') or not data_path.startswith(prefix):
+                    continue
+                try:
+                    mtime = os.path.getmtime(os.path.join(dir_name, file_name))
+                except FileNotFoundError:
+                    continue
+                yield (data_path, datetime.datetime.utcfromtimestamp(mtime))
+
+
+# remove a file, ignoring files that have already been removed
+def _unlink_if_exists(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
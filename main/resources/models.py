@@ -148,6 +148,47 @@ class ResourceRevision(db.Model):
     data = db.Column(db.LargeBinary, nullable=True)
 
 
+# The StorageBlob model holds a reference-counted object in bulk storage, keyed by a digest of its contents
+# (used when CONTENT_ADDRESSED_STORAGE is enabled, so that revisions with the same contents share a single object).
+class StorageBlob(db.Model):
+    __tablename__ = 'storage_blobs'
+    id = db.Column(db.Integer, primary_key=True)
+    digest = db.Column(db.String(64), nullable=False, unique=True, comment='SHA-1 hex digest of the contents')
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, comment='number of revisions using this blob')
+    creation_timestamp = db.Column(db.DateTime, nullable=False)
+
+
+# The RevisionBlob model maps a resource revision to the storage blob holding its data.
+class RevisionBlob(db.Model):
+    __tablename__ = 'revision_blobs'
+    revision_id = db.Column(db.ForeignKey('resource_revisions.id'), primary_key=True)
+    blob_id = db.Column(db.ForeignKey('storage_blobs.id'), nullable=False, index=True)
+
+
+# The FileUpload model tracks a resumable file upload; the file is sent in parts (each stored as a FileUploadPart)
+# and then assembled into a new file revision when the upload is completed.
+class FileUpload(db.Model):
+    __tablename__ = 'file_uploads'
+    id = db.Column(db.String(32), primary_key=True, comment='random ID; also used as a secret for continuing the upload')
+    path = db.Column(db.String, nullable=False, comment='full path of the file being uploaded')
+    size = db.Column(db.BigInteger, comment='expected total size (if known)')
+    received = db.Column(db.BigInteger, nullable=False, comment='number of bytes received so far')
+    creation_timestamp = db.Column(db.DateTime, nullable=False)
+    modification_timestamp = db.Column(db.DateTime, nullable=False)
+
+
+# The FileUploadPart model holds one part of a resumable file upload (data is in bulk storage if available).
+class FileUploadPart(db.Model):
+    __tablename__ = 'file_upload_parts'
+    __table_args__ = (db.UniqueConstraint('upload_id', 'offset'),)  # a part can only be stored once (e.g. if a client retries)
+    id = db.Column(db.Integer, primary_key=True)
+    upload_id = db.Column(db.ForeignKey('file_uploads.id'), nullable=False, index=True)
+    offset = db.Column(db.BigInteger, nullable=False)
+    size = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=True)
+
+
 # The ResourceView model holds per-used preferences for viewing a resource (e.g. folder sorting).
 class ResourceView(db.Model):
     __tablename__ = 'resource_views'
@@ -5,17 +5,23 @@ import json
 import hashlib
 import datetime
 import logging
+import tempfile
+import itertools
+from collections import deque
 
 
 # external imports
+from gevent.threadpool import ThreadPool
 from sqlalchemy import not_
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
 
 # internal imports
-from main.app import db, message_queue, storage_manager
+from main.app import app, db, message_queue, storage_manager, thumbnail_queue
 from main.resources.models import Resource, ResourceRevision, Thumbnail, ControllerStatus, ResourceView
-from main.resources.file_conversion import compute_thumbnail
+from main.resources.storage_manager import CHUNK_SIZE
+from main.resources.blob_storage import add_revision_blob, add_revision_blob_chunks, release_revision_blobs, revision_storage_path
+from main.resources.thumbnails import delete_sprite_sheets
 from main.users.permissions import ACCESS_LEVEL_WRITE, ACCESS_TYPE_ORG_USERS, ACCESS_TYPE_ORG_CONTROLLERS
 
 
@@ -68,6 +74,37 @@ def _create_folders(path):
 # returns the newly created resource record object (or existing resource if already exists)
 # fix(soon): remove this
 def _create_file(file_name, creation_timestamp, modification_timestamp, file_data):
+    resource = _file_resource(file_name, creation_timestamp, modification_timestamp)
+    _update_file_attributes(resource, hashlib.sha1(file_data).hexdigest(), len(file_data))
+    if not resource.id:
+        db.session.add(resource)
+        db.session.commit()
+
+    # write file contents to a resource revision (possibly bulk storage)
+    add_resource_revision(resource, modification_timestamp, file_data)
+    db.session.commit()
+
+    # compute thumbnail for images (in the background); other sizes are computed when first requested
+    if file_name.endswith('.png') or file_name.endswith('.jpg'):  # fix(soon): handle more types, capitalizations
+        thumbnail_queue.add_file_thumbnail(resource.id, resource.last_revision_id, file_data, 120)
+    return resource
+
+
+# create a file (or a new revision of an existing file) from data provided as a sequence of chunks, without holding all of the data
+# in memory; file name should include leading slash; thumbnails (for images) are computed when first requested
+def create_file_from_chunks(file_name, creation_timestamp, modification_timestamp, chunks):
+    resource = _file_resource(file_name, creation_timestamp, modification_timestamp)
+    if not resource.id:
+        db.session.add(resource)
+        db.session.commit()
+    (_, size, digest) = add_resource_revision_chunks(resource, modification_timestamp, chunks)
+    _update_file_attributes(resource, digest, size)
+    db.session.commit()
+    return resource
+
+
+# find or create (but not add/commit) the resource record for a file; file name should include leading slash
+def _file_resource(file_name, creation_timestamp, modification_timestamp):
     last_slash = file_name.rfind('/')
     path = file_name[:last_slash]
     short_file_name = file_name[last_slash+1:]
@@ -76,7 +113,6 @@ def _create_file(file_name, creation_timestamp, modification_timestamp, file_dat
     # check for existing resource with same name
     try:
         resource = Resource.query.filter(Resource.parent_id == folder.id, Resource.name == short_file_name, not_(Resource.deleted)).one()
-        new_resource = False
     except NoResultFound:
 
         # create new resource record
@@ -86,41 +122,23 @@ def _create_file(file_name, creation_timestamp, modification_timestamp, file_dat
         resource.name = short_file_name
         resource.creation_timestamp = creation_timestamp
         resource.type = Resource.FILE
-        new_resource = True
 
     # update or init resource record
     resource.deleted = False
     resource.modification_timestamp = modification_timestamp
+    return resource
+
+
+# store the hash and size of a file's contents in its system attributes
+def _update_file_attributes(resource, digest, size):
     if resource.type != Resource.SEQUENCE:
         if resource.system_attributes:
             system_attributes = json.loads(resource.system_attributes)
         else:
             system_attributes = {}
-        system_attributes['hash'] = hashlib.sha1(file_data).hexdigest()
-        system_attributes['size'] = len(file_data)
+        system_attributes['hash'] = digest
+        system_attributes['size'] = size
         resource.system_attributes = json.dumps(system_attributes)
-    if new_resource:
-        db.session.add(resource)
-        db.session.commit()
-
-    # write file contents to a resource revision (possibly bulk storage)
-    add_resource_revision(resource, modification_timestamp, file_data)
-    db.session.commit()
-
-    # compute thumbnail for images
-    if file_name.endswith('.png') or file_name.endswith('.jpg'):  # fix(soon): handle more types, capitalizations
-        for width in [120]:  # fix(soon): what will be our standard sizes?
-            # fix(later): if this returns something other than requested width, we'll keep missing the cache
-            (thumbnail_contents, thumbnail_width, thumbnail_height) = compute_thumbnail(file_data, width)
-            thumbnail = Thumbnail()
-            thumbnail.resource_id = resource.id
-            thumbnail.width = thumbnail_width
-            thumbnail.height = thumbnail_height
-            thumbnail.format = 'jpg'
-            thumbnail.data = thumbnail_contents
-            db.session.add(thumbnail)
-        db.session.commit()
-    return resource
 
 
 # fix(soon): make leading slash required
@@ -204,19 +222,15 @@ def update_sequence_value(resource, resource_path, timestamp, value, emit_messag
 
     # if too soon since last update, don't store a new value (but do still send out an update message)
     if min_storage_interval == 0 or timestamp >= resource.modification_timestamp + datetime.timedelta(seconds=min_storage_interval):
-        resource_revision = add_resource_revision(resource, timestamp, value.encode())
+        data = value if isinstance(value, bytes) else value.encode()  # image values are already binary (decoded from base64)
+        resource_revision = add_resource_revision(resource, timestamp, data)
         resource.modification_timestamp = timestamp
 
-        # create thumbnails for image sequences
+        # create thumbnails for image sequences; the thumbnail revision is added now (in the same transaction as the image revision)
+        # and its data is filled in by the thumbnail queue in the background
         if data_type == Resource.IMAGE_SEQUENCE:
-            max_width = 240
-            name = 'thumbnail-%d-x' % max_width
-            thumbnail_contents = compute_thumbnail(value, max_width)[0]
-            try:
-                thumbnail_resource = Resource.query.filter(Resource.parent_id == resource.id, Resource.name == name, not_(Resource.deleted)).one()
-            except NoResultFound:
-                thumbnail_resource = create_sequence(resource, name, Resource.IMAGE_SEQUENCE)
-            thumbnail_revision = add_resource_revision(thumbnail_resource, timestamp, thumbnail_contents)
+            thumbnail_revision = add_thumbnail_revision(resource, timestamp, 240)
+            thumbnail_queue.add_sequence_thumbnail(thumbnail_revision.resource_id, thumbnail_revision.id, value, 240)
             if emit_message:
                 message_params['revision_id'] = resource_revision.id
                 message_params['thumbnail_revision_id'] = thumbnail_revision.id
@@ -233,23 +247,118 @@ def update_sequence_value(resource, resource_path, timestamp, value, emit_messag
 
 
 # creates a resource revision record; places the data in the record (if it is small) or bulk storage (if it is large);
-# note that we don't commit resource here (just resource revision); outside code must commit resource
+# note that we don't commit here (the revision is flushed so that it has an ID); outside code must commit
 # data should be binary data (strings should be encoded first)
 def add_resource_revision(resource, timestamp, data):
+    resource_revision = _new_resource_revision(resource, timestamp)
+    store_revision_data(resource, resource_revision, data)
+    resource.last_revision_id = resource_revision.id  # note that we don't commit here; outside code must commit
+    return resource_revision
+
+
+# creates and flushes a resource revision record (without data)
+def _new_resource_revision(resource, timestamp):
     resource_revision = ResourceRevision()
     resource_revision.resource_id = resource.id
     resource_revision.timestamp = timestamp
-    if len(data) < 1000 or not storage_manager:
+    db.session.add(resource_revision)
+    if resource.type == Resource.FILE:  # any thumbnails stored in the database are for the previous revision
+        Thumbnail.query.filter(Thumbnail.resource_id == resource.id).delete()
+    db.session.flush()
+    return resource_revision
+
+
+# creates a resource revision from data provided as a sequence of chunks (e.g. an upload stream) without holding all of the data
+# in memory; the data is hashed as it is written; returns (resource revision, size, SHA-1 hex digest); as with add_resource_revision,
+# outside code must commit
+def add_resource_revision_chunks(resource, timestamp, chunks):
+    chunks = iter(chunks)
+
+    # small data is stored in the revision record (as with add_resource_revision)
+    inline_max_size = app.config['STORAGE_INLINE_MAX_SIZE']
+    head = b''
+    for chunk in chunks:
+        head += chunk
+        if len(head) >= inline_max_size:
+            break
+    if len(head) < inline_max_size or not storage_manager:
+        data = head + b''.join(chunks)
+        return (add_resource_revision(resource, timestamp, data), len(data), hashlib.sha1(data).hexdigest())
+
+    # larger data is streamed to bulk storage
+    resource_revision = _new_resource_revision(resource, timestamp)
+    hasher = hashlib.sha1()
+    size = [0]  # single-element list to allow modification inside generator
+
+    def hashed_chunks():
+        for chunk in itertools.chain([head], chunks):
+            hasher.update(chunk)
+            size[0] += len(chunk)
+            yield chunk
+
+    if app.config['CONTENT_ADDRESSED_STORAGE']:  # we need the digest before writing, so spool the data to a temp file
+        with tempfile.SpooledTemporaryFile(max_size=CHUNK_SIZE) as spool_file:
+            for chunk in hashed_chunks():
+                spool_file.write(chunk)
+
+            def spooled_chunks():
+                spool_file.seek(0)
+                return iter(lambda: spool_file.read(CHUNK_SIZE), b'')
+
+            add_revision_blob_chunks(resource_revision, hasher.hexdigest(), size[0], spooled_chunks)
+    else:
+        storage_manager.write_chunks(resource.storage_path(resource_revision.id), hashed_chunks())
+    resource.last_revision_id = resource_revision.id
+    return (resource_revision, size[0], hasher.hexdigest())
+
+
+# places the data for a (flushed) resource revision in the record (if it is small) or bulk storage (if it is large)
+def store_revision_data(resource, resource_revision, data):
+    if len(data) < app.config['STORAGE_INLINE_MAX_SIZE'] or not storage_manager:
         resource_revision.data = data
-        bulk_storage = False
     else:
-        bulk_storage = True
-    db.session.add(resource_revision)
-    db.session.commit()
-    if bulk_storage:
+        store_bulk_revision_data(resource, resource_revision, data)
+
+
+# places the data for a (flushed) resource revision in bulk storage
+def store_bulk_revision_data(resource, resource_revision, data):
+    if app.config['CONTENT_ADDRESSED_STORAGE']:
+        add_revision_blob(resource_revision, data)  # revisions with the same contents share a single object
+    else:
         storage_manager.write(resource.storage_path(resource_revision.id), data)
-    resource.last_revision_id = resource_revision.id  # note that we don't commit here; outside code must commit
-    return resource_revision
+
+
+# creates an empty revision in the thumbnail sequence of an image sequence (using the same timestamp as the image revision);
+# the thumbnail data should be stored later using store_revision_data; as with add_resource_revision, outside code must commit
+def add_thumbnail_revision(resource, timestamp, max_width):
+    thumbnail_resource_id = thumbnail_sequence_id(resource, max_width)
+    thumbnail_revision = ResourceRevision()
+    thumbnail_revision.resource_id = thumbnail_resource_id
+    thumbnail_revision.timestamp = timestamp
+    db.session.add(thumbnail_revision)
+    db.session.flush()
+    # update the thumbnail sequence without loading it
+    Resource.query.filter(Resource.id == thumbnail_resource_id).update(
+        {'last_revision_id': thumbnail_revision.id, 'modification_timestamp': timestamp}, synchronize_session=False)
+    return thumbnail_revision
+
+
+# get a strong ETag for a revision of a resource; revisions are never modified, so the revision ID identifies the contents
+# (we also include the content hash when we have it, so that the tag changes if a revision's data is ever replaced);
+# returns None if the resource doesn't have any revisions
+def revision_etag(resource, revision_id=None, variant=''):
+    if not revision_id:
+        revision_id = resource.last_revision_id
+    if not revision_id:
+        return None
+    etag = '%d' % revision_id
+    if revision_id == resource.last_revision_id and resource.type != Resource.SEQUENCE and resource.system_attributes:
+        digest = json.loads(resource.system_attributes).get('hash')
+        if digest:
+            etag += '-' + digest[:16]
+    if variant:
+        etag += '-' + variant  # e.g. a converted version of the file
+    return etag
 
 
 # reads the most recent revision/value of a resource;
@@ -272,12 +381,110 @@ def read_resource(resource, revision_id=None, check_timing=False):
         if data is None and storage_manager:
             if check_timing:
                 start_time = time.time()
-            data = storage_manager.read(resource.storage_path(revision_id))
+            data = storage_manager.read(revision_storage_path(resource, revision_id))
             if check_timing:
                 print('storage time: %.4f' % (time.time() - start_time))
     return data
 
 
+# reads a revision/value of a resource as a sequence of chunks, so that large files in bulk storage don't need to be held in memory;
+# yields nothing if the revision isn't found
+def read_resource_chunks(resource, revision_id=None, chunk_size=CHUNK_SIZE):
+    if not revision_id:
+        revision_id = resource.last_revision_id
+    if revision_id:
+        resource_revision = ResourceRevision.query.filter(ResourceRevision.id == revision_id).first()
+        if resource_revision and resource_revision.data is not None:
+            yield resource_revision.data
+        elif storage_manager:
+            for chunk in storage_manager.read_chunks(revision_storage_path(resource, revision_id), chunk_size):
+                yield chunk
+
+
+# reads the current contents of a list of file resources, yielding a (resource, chunks) pair for each one (in the same order);
+# objects in bulk storage are fetched ahead of time by a pool of threads (up to STORAGE_PREFETCH_COUNT objects and
+# STORAGE_PREFETCH_SIZE bytes at a time), so that reading many files is limited by bandwidth rather than per-object latency;
+# files too large to prefetch (or of unknown size) are streamed in chunks when they are reached; the thread pool is shared by all
+# callers in this process (so storage managers must be thread-safe)
+def read_resources_prefetched(resources):
+    prefetch_count = app.config['STORAGE_PREFETCH_COUNT']
+    max_prefetch_bytes = app.config['STORAGE_PREFETCH_SIZE']
+    if not storage_manager or prefetch_count < 1:
+        for resource in resources:
+            yield (resource, read_resource_chunks(resource))
+        return
+    pool = _prefetch_pools.get(prefetch_count)
+    if pool is None:
+        pool = _prefetch_pools[prefetch_count] = ThreadPool(prefetch_count)
+    pending = deque()  # (resource, data or async result or None if streamed, size)
+    prefetch_bytes = 0
+    remaining = iter(resources)
+    next_resource = next(remaining, None)
+    while pending or next_resource is not None:
+
+        # start fetching more objects (without exceeding the limits)
+        while next_resource is not None and len(pending) < prefetch_count:
+            size = json.loads(next_resource.system_attributes).get('size') if next_resource.system_attributes else None
+            if size is None or size > max_prefetch_bytes:
+                pending.append((next_resource, None, 0))
+            elif pending and prefetch_bytes + size > max_prefetch_bytes:
+                break  # wait for some of the pending objects to be used
+            else:
+                revision = ResourceRevision.query.filter(ResourceRevision.id == next_resource.last_revision_id).first()
+                if revision and revision.data is not None:
+                    pending.append((next_resource, bytes(revision.data), size))
+                else:
+                    path = revision_storage_path(next_resource, next_resource.last_revision_id)
+                    pending.append((next_resource, pool.spawn(storage_manager.read, path), size))  # only blocks a pool thread
+                prefetch_bytes += size
+            next_resource = next(remaining, None)
+
+        # provide the next object
+        (resource, data, size) = pending.popleft()
+        if data is None:
+            yield (resource, read_resource_chunks(resource))
+        else:
+            if not isinstance(data, bytes):
+                data = data.get()  # wait for the prefetch to complete
+            prefetch_bytes -= size
+            yield (resource, [data] if data else [])
+
+
+# get the ID of the child sequence that holds thumbnails (of the given max width) for an image sequence (creating it if needed);
+# this isn't cached, since another process could delete or recreate the thumbnail sequence
+def thumbnail_sequence_id(resource, max_width):
+    return find_thumbnail_sequence(resource, max_width).id
+
+
+# thread pools used by read_resources_prefetched, keyed by size (created when first needed)
+_prefetch_pools = {}
+
+
+# find the child sequence that holds thumbnails (of the given max width) for an image sequence; creates it if needed
+def find_thumbnail_sequence(resource, max_width):
+    name = 'thumbnail-%d-x' % max_width
+    try:
+        thumbnail_resource = Resource.query.filter(Resource.parent_id == resource.id, Resource.name == name, not_(Resource.deleted)).one()
+    except NoResultFound:
+        thumbnail_resource = create_sequence(resource, name, Resource.IMAGE_SEQUENCE)
+    return thumbnail_resource
+
+
+# read the full image for a thumbnail revision whose thumbnail hasn't been computed yet (a thumbnail revision has the same
+# timestamp as the corresponding image revision); returns None if not found
+def read_pending_thumbnail(thumbnail_resource, revision_id):
+    thumbnail_revision = ResourceRevision.query.filter(ResourceRevision.id == revision_id).first()
+    if thumbnail_revision:
+        image_revision = (
+            ResourceRevision.query
+            .filter(ResourceRevision.resource_id == thumbnail_resource.parent_id, ResourceRevision.timestamp == thumbnail_revision.timestamp)
+            .first()
+        )
+        if image_revision:
+            return read_resource(thumbnail_resource.parent, image_revision.id)
+    return None
+
+
 # create a new sequence resource; commits it to database and returns resource record
 def create_sequence(parent_resource, name, data_type, max_history=10000, units=None):
     r = Resource()
@@ -382,6 +589,9 @@ def delete_resource(resource, verbose=False):
             print('deleting %d children' % child_count)
     for r in children:
         delete_resource(r, verbose)
+    if resource.type == Resource.SEQUENCE and json.loads(resource.system_attributes or '{}').get('data_type') == Resource.IMAGE_SEQUENCE:
+        delete_sprite_sheets(resource)
+    release_revision_blobs(ResourceRevision.resource_id == resource.id)
     ResourceRevision.query.filter(ResourceRevision.resource_id == resource.id).delete()
     Thumbnail.query.filter(Thumbnail.resource_id == resource.id).delete()
     ResourceView.query.filter(ResourceView.resource_id == resource.id).delete()
@@ -1,8 +1,20 @@
+import datetime
 import boto3
 from botocore.errorfactory import ClientError
+from .storage_manager import StorageManager, CHUNK_SIZE
 
 
-class S3StorageManager():
+# size of each part of a multipart upload (S3 requires at least 5MB for all but the last part); smaller objects are written with a single request
+MULTIPART_PART_SIZE = 8 * 1024 * 1024
+
+
+# maximum number of objects deleted by a single request
+DELETE_BATCH_SIZE = 1000
+
+
+# The S3StorageManager class stores bulk data in an S3 bucket. Requests go through the boto3 client (rather than bucket/object
+# resources), since the client is thread-safe and storage calls may come from thread pools (e.g. prefetching or scrubbing).
+class S3StorageManager(StorageManager):
 
     def __init__(self, app_config):
         if 'S3_ACCESS_KEY' in app_config and app_config['S3_ACCESS_KEY']:
@@ -15,7 +27,7 @@ class S3StorageManager():
             self.s3 = boto3.resource('s3')
         self.bucket_name = app_config['S3_STORAGE_BUCKET']
         self.write_allowed = app_config['PRODUCTION'] or app_config['S3_STORAGE_BUCKET'].endswith('testing')
-        self.bucket = self.s3.Bucket(self.bucket_name)
+        self.client = self.s3.meta.client
         self.verbose = False
 
     # write data to bulk storage
@@ -25,14 +37,81 @@ class S3StorageManager():
             return  # make sure we aren't writing to prod from a test system; should make something more bulletproof than this
         if self.verbose:
             print('writing to bucket: %s, key: %s, data len: %d' % (self.bucket_name, data_path, len(data)))
-        self.bucket.put_object(Body=data, Key=data_path)
+        self.client.put_object(Bucket=self.bucket_name, Key=data_path, Body=data)
+
+    # write data provided as a sequence of chunks to bulk storage; large objects are sent using a multipart upload,
+    # so we only need to hold one part in memory at a time
+    def write_chunks(self, data_path, chunks):
+        if not self.write_allowed:
+            print('write to production bucket not allowed')
+            return
+        client = self.client
+        upload_id = None
+        parts = []
+        buffer = bytearray()
+        try:
+            for chunk in chunks:
+                buffer += chunk
+                if len(buffer) >= MULTIPART_PART_SIZE:
+                    if upload_id is None:
+                        upload_id = client.create_multipart_upload(Bucket=self.bucket_name, Key=data_path)['UploadId']
+                    self._upload_part(client, data_path, upload_id, parts, bytes(buffer))
+                    buffer = bytearray()
+            if upload_id is None:  # small object; write it all at once
+                self.write(data_path, bytes(buffer))
+                return
+            if buffer or not parts:
+                self._upload_part(client, data_path, upload_id, parts, bytes(buffer))
+            client.complete_multipart_upload(Bucket=self.bucket_name, Key=data_path, UploadId=upload_id, MultipartUpload={'Parts': parts})
+        except Exception:
+            if upload_id is not None:  # don't leave partial uploads (which are billed) in the bucket
+                client.abort_multipart_upload(Bucket=self.bucket_name, Key=data_path, UploadId=upload_id)
+            raise
+
+    # upload one part of a multipart upload
+    def _upload_part(self, client, data_path, upload_id, parts, data):
+        part_number = len(parts) + 1
+        if self.verbose:
+            print('writing part %d to bucket: %s, key: %s, data len: %d' % (part_number, self.bucket_name, data_path, len(data)))
+        response = client.upload_part(Bucket=self.bucket_name, Key=data_path, UploadId=upload_id, PartNumber=part_number, Body=data)
+        parts.append({'PartNumber': part_number, 'ETag': response['ETag']})
 
     # read data from bulk storage
     def read(self, data_path):
         if self.verbose:
             print('reading from bucket: %s, key: %s' % (self.bucket_name, data_path))
-        obj = self.bucket.Object(data_path).get()
         try:
+            # raises a ClientError if the object doesn't exist (e.g. pending thumbnail)
+            obj = self.client.get_object(Bucket=self.bucket_name, Key=data_path)
+            return obj['Body'].read()
+        except ClientError as e:
+            if e.response['ResponseMetadata']['HTTPStatusCode'] == 404:
+                return None
+            else:
+                raise e
+
+    # read data from bulk storage as a sequence of chunks (streamed from S3 rather than read in full)
+    def read_chunks(self, data_path, chunk_size=CHUNK_SIZE):
+        if self.verbose:
+            print('reading chunks from bucket: %s, key: %s' % (self.bucket_name, data_path))
+        try:
+            obj = self.client.get_object(Bucket=self.bucket_name, Key=data_path)
+        except ClientError as e:
+            if e.response['ResponseMetadata']['HTTPStatusCode'] == 404:
+                return
+            else:
+                raise e
+        for chunk in obj['Body'].iter_chunks(chunk_size):
+            yield chunk
+
+    # read part of an object (from start up to but not including end) from bulk storage using a ranged GET
+    def read_range(self, data_path, start, end):
+        if end <= start:
+            return b''
+        if self.verbose:
+            print('reading range from bucket: %s, key: %s, range: %d-%d' % (self.bucket_name, data_path, start, end))
+        try:
+            obj = self.client.get_object(Bucket=self.bucket_name, Key=data_path, Range='bytes=%d-%d' % (start, end - 1))
             return obj['Body'].read()
         except ClientError as e:
             if e.response['ResponseMetadata']['HTTPStatusCode'] == 404:
@@ -40,15 +119,43 @@ class S3StorageManager():
             else:
                 raise e
 
-    # returns true if object exists in bulk storage
-    # fix(later): remove or improve this
+    # returns the size of an object in bulk storage (or None if not found)
+    def size(self, data_path):
+        try:
+            return self.client.head_object(Bucket=self.bucket_name, Key=data_path)['ContentLength']
+        except ClientError as e:
+            if e.response['ResponseMetadata']['HTTPStatusCode'] == 404:
+                return None
+            else:
+                raise e
+
+    # returns true if object exists in bulk storage (using a HEAD request)
     def exists(self, data_path):
-        response = self.s3.list_objects_v2(Bucket=self.bucket_name, Prefix=data_path)
-        for obj in response.get('Contents', []):
-            if obj['Key'] == data_path:
-                return True
-        return False
+        return self.size(data_path) is not None
 
-    # fix(soon): implement and use this
+    # delete an object in bulk storage
     def delete(self, data_path):
-        pass
+        self.delete_many([data_path])
+
+    # delete a batch of objects in bulk storage, using one request per 1000 objects (the S3 limit)
+    def delete_many(self, data_paths):
+        if not self.write_allowed:
+            print('delete from production bucket not allowed')
+            return
+        data_paths = list(data_paths)
+        client = self.client
+        for pos in range(0, len(data_paths), DELETE_BATCH_SIZE):
+            keys = data_paths[pos:pos + DELETE_BATCH_SIZE]
+            if self.verbose:
+                print('deleting %d objects from bucket: %s' % (len(keys), self.bucket_name))
+            response = client.delete_objects(Bucket=self.bucket_name, Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+            errors = response.get('Errors', [])
+            if errors:
+                raise IOError('unable to delete %d objects (e.g. %s: %s)' % (len(errors), errors[0]['Key'], errors[0]['Message']))
+
+    # list the objects in bulk storage (with paths starting with the given prefix); yields (data path, last modified UTC datetime)
+    def list_paths(self, prefix=''):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                yield (obj['Key'], obj['LastModified'].astimezone(datetime.timezone.utc).replace(tzinfo=None))
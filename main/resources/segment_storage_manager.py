@@ -0,0 +1,354 @@
+import os
+import json
+import datetime
+import mmap
+import fcntl
+import logging
+import threading
+import itertools
+from contextlib import contextmanager
+import gevent
+from .file_system_storage_manager import FileSystemStorageManager
+from .storage_manager import CHUNK_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+
+# how long to wait (in seconds) between attempts to get the segments lock
+LOCK_RETRY_INTERVAL = 0.01
+
+
+# number of objects copied per lock hold during compaction
+COMPACTION_BATCH_SIZE = 100
+
+
+# The SegmentStorageManager class is a file system storage manager that packs small objects into large append-only segment files
+# (in a segments directory under FILE_SYSTEM_STORAGE_PATH), so that image sequences and other sources of many small revisions
+# don't create millions of individual files. The location of each packed object (segment, offset, length) is recorded in an
+# append-only index log, which each process loads into memory (and re-reads when it sees a path it doesn't know, since other
+# processes may be writing too). Writes and compaction hold an exclusive lock on the segments directory (compaction releases it
+# between batches). Objects larger than STORAGE_SEGMENT_MAX_OBJECT_SIZE (and objects written before segments were enabled) use
+# the regular file layout. As with the regular layout, writes aren't fsynced; if the index log refers to data that didn't reach
+# the disk before a crash (past the end of its segment), the object is treated as missing. Compaction syncs the copied objects
+# before removing the old segments.
+class SegmentStorageManager(FileSystemStorageManager):
+
+    def __init__(self, app_config):
+        super().__init__(app_config)
+        self.segment_path = os.path.join(self.storage_path, 'segments')
+        self.max_segment_size = app_config['STORAGE_SEGMENT_SIZE']
+        self.max_object_size = app_config['STORAGE_SEGMENT_MAX_OBJECT_SIZE']
+        self.index = {}  # data path -> (segment number, offset, length)
+        self.index_file_name = os.path.join(self.segment_path, 'index.log')
+        self.index_inode = None  # used to detect that another process has rewritten the index log (during compaction)
+        self.index_position = 0  # number of bytes of the index log that we have loaded
+        self.index_record_count = 0
+        self.index_lock = threading.RLock()  # guards the in-memory index (storage calls may come from thread pools)
+        self.last_segment = 0
+        if not os.path.exists(self.segment_path):
+            os.makedirs(self.segment_path, exist_ok=True)
+        self.load_index()
+
+    # write data to bulk storage
+    def write(self, data_path, data):
+        if len(data) > self.max_object_size:
+            super().write(data_path, data)
+            self.remove_from_segments(data_path)  # in case a previous version was packed
+        else:
+            self.append(data_path, data)
+
+    # write data provided as a sequence of chunks to bulk storage; small objects are packed into a segment
+    def write_chunks(self, data_path, chunks):
+        chunks = iter(chunks)
+        head = []
+        head_size = 0
+        for chunk in chunks:
+            head.append(chunk)
+            head_size += len(chunk)
+            if head_size > self.max_object_size:
+                super().write_chunks(data_path, itertools.chain(head, chunks))
+                self.remove_from_segments(data_path)
+                return
+        self.append(data_path, b''.join(head))
+
+    # read data from bulk storage
+    def read(self, data_path):
+        location = self.locate(data_path)
+        if location:
+            return self.read_segment(data_path, location, 0, location[2])
+        return super().read(data_path)
+
+    # read data from bulk storage as a sequence of chunks
+    def read_chunks(self, data_path, chunk_size=CHUNK_SIZE):
+        location = self.locate(data_path)
+        if location:
+            data = self.read_segment(data_path, location, 0, location[2]) or b''
+            for pos in range(0, len(data), chunk_size):
+                yield data[pos:pos + chunk_size]
+        else:
+            for chunk in super().read_chunks(data_path, chunk_size):
+                yield chunk
+
+    # read part of an object (from start up to but not including end) from bulk storage
+    def read_range(self, data_path, start, end):
+        location = self.locate(data_path)
+        if location:
+            return self.read_segment(data_path, location, start, end)
+        return super().read_range(data_path, start, end)
+
+    # returns the size of an object in bulk storage (or None if not found)
+    def size(self, data_path):
+        location = self.locate(data_path)
+        if location:
+            return location[2]
+        return super().size(data_path)
+
+    # returns a binary file object for reading an object in bulk storage; packed objects don't have their own files, so we return
+    # None for those (callers then use read_range/read_chunks)
+    def open_file(self, data_path):
+        if self.locate(data_path):
+            return None
+        return super().open_file(data_path)
+
+    # returns true if object exists in bulk storage
+    def exists(self, data_path):
+        return bool(self.locate(data_path)) or super().exists(data_path)
+
+    # delete an object in bulk storage; the space used by packed objects is reclaimed when the segment is compacted
+    def delete(self, data_path):
+        if self.locate(data_path):
+            self.remove_from_segments(data_path)
+        else:
+            super().delete(data_path)
+
+    # delete a batch of objects in bulk storage (ignoring any that don't exist); packed objects are removed with a single lock
+    def delete_many(self, data_paths):
+        self.load_index()
+        packed_paths = {data_path for data_path in data_paths if data_path in self.index}
+        if packed_paths:
+            with self.locked():
+                self.load_index()
+                for data_path in packed_paths:
+                    if data_path in self.index:
+                        self.append_index_record(['delete', data_path])
+        super().delete_many([data_path for data_path in data_paths if data_path not in packed_paths])
+
+    # list the objects in bulk storage (with paths starting with the given prefix); yields (data path, last modified UTC datetime);
+    # we don't record when packed objects were written, so we use the modification time of the segment
+    def list_paths(self, prefix=''):
+        for item in super().list_paths(prefix):
+            yield item
+        self.load_index()
+        segment_times = {}
+        for (data_path, (segment, _, _)) in sorted(self.index.items()):
+            if data_path.startswith(prefix):
+                if segment not in segment_times:
+                    try:
+                        segment_times[segment] = datetime.datetime.utcfromtimestamp(os.path.getmtime(self.segment_file_name(segment)))
+                    except FileNotFoundError:  # compacted by another process
+                        continue
+                yield (data_path, segment_times[segment])
+
+    # copy the live objects out of segments that are at least min_garbage_ratio deleted/overwritten data, remove those segments,
+    # and rewrite the index log without the obsolete records; the objects are copied in batches (of batch_size objects), releasing
+    # the lock in between so that other writers aren't held up; returns (number of segments removed, number of bytes reclaimed)
+    def compact(self, min_garbage_ratio=0.5, batch_size=COMPACTION_BATCH_SIZE):
+        with self.locked():
+            self.load_index()
+            live_sizes = {}
+            for (segment, _, length) in self.index.values():
+                live_sizes[segment] = live_sizes.get(segment, 0) + length
+            segments = []
+            reclaimed = 0
+            for file_name in os.listdir(self.segment_path):
+                if not file_name.endswith('.seg'):
+                    continue
+                segment = int(file_name.split('.')[0])
+                if segment == self.last_segment:
+                    continue  # still being written
+                size = os.path.getsize(self.segment_file_name(segment))
+                live_size = live_sizes.get(segment, 0)
+                if size and float(size - live_size) / size >= min_garbage_ratio:
+                    segments.append(segment)
+                    reclaimed += size - live_size
+
+        # move the live objects to the current segment (new objects are never added to the segments we're removing)
+        written_segments = set()
+        for segment in segments:
+            while True:
+                with self.locked():
+                    self.load_index()
+                    batch = [(data_path, location) for (data_path, location) in self.index.items() if location[0] == segment][:batch_size]
+                    for (data_path, location) in batch:
+                        data = self.read_segment(data_path, location, 0, location[2])
+                        if data is None:  # lost in a crash
+                            self.append_index_record(['delete', data_path])
+                        else:
+                            written_segments.add(self.append_locked(data_path, data))
+                if not batch:
+                    break
+                gevent.sleep(0)  # let other greenlets (e.g. ones waiting for the lock) run between batches
+
+        with self.locked():
+            self.load_index()
+
+            # the copies must be on disk before we remove the old segments
+            if segments:
+                self.sync(written_segments)
+
+            # the index log only needs records for objects that still exist
+            if segments or self.index_record_count > 2 * len(self.index):
+                self.rewrite_index()
+            for segment in segments:
+                os.unlink(self.segment_file_name(segment))
+            if segments:
+                logger.info('compacted %d segments; reclaimed %d bytes', len(segments), reclaimed)
+        return (len(segments), reclaimed)
+
+    # get the file name of a segment
+    def segment_file_name(self, segment):
+        return os.path.join(self.segment_path, '%08d.seg' % segment)
+
+    # get the (segment, offset, length) location of a packed object (or None if not packed)
+    def locate(self, data_path):
+        location = self.index.get(data_path)
+        if location is None:
+            self.load_index()  # another process may have written it
+            location = self.index.get(data_path)
+        return location
+
+    # read part of a packed object (using a memory map of its segment), given the location returned by locate; returns None if
+    # the object has been removed (e.g. by another process) since it was located
+    def read_segment(self, data_path, location, start, end):
+        for retry in (False, True):
+            (segment, offset, length) = location
+            if not length:
+                return b''  # (can't map an empty segment)
+            try:
+                with open(self.segment_file_name(segment), 'rb') as segment_file:
+                    mapped_data = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+                    try:
+                        if len(mapped_data) < offset + length:  # the data didn't reach the disk before a crash
+                            logger.warning('packed object is past the end of its segment: %s', data_path)
+                            return None
+                        return mapped_data[offset + min(start, length):offset + min(end, length)]
+                    finally:
+                        mapped_data.close()
+            except FileNotFoundError:  # segment was compacted by another process (or greenlet); find the new location
+                self.load_index()
+                location = self.index.get(data_path)
+                if retry or location is None:
+                    return None
+        return None
+
+    # add an object to the current segment and record its location in the index log
+    def append(self, data_path, data):
+        with self.locked():
+            self.load_index()  # make sure we know about other processes' writes (including new segments)
+            self.append_locked(data_path, data)
+
+    # add an object to the current segment; the caller must hold the lock; returns the segment number
+    def append_locked(self, data_path, data):
+        segment = max(self.last_segment, 1)
+        file_name = self.segment_file_name(segment)
+        if os.path.exists(file_name) and os.path.getsize(file_name) + len(data) > self.max_segment_size:
+            segment += 1
+            file_name = self.segment_file_name(segment)
+        with open(file_name, 'ab') as segment_file:
+            offset = segment_file.tell()
+            segment_file.write(data)
+        self.append_index_record(['put', data_path, segment, offset, len(data)])
+        return segment
+
+    # remove a packed object from the index (if present)
+    def remove_from_segments(self, data_path):
+        if not self.locate(data_path):
+            return
+        with self.locked():
+            self.load_index()
+            if data_path in self.index:
+                self.append_index_record(['delete', data_path])
+
+    # add a record to the index log and apply it to our in-memory index; the caller must hold the lock
+    def append_index_record(self, record):
+        line = (json.dumps(record) + '\n').encode()
+        with self.index_lock:
+            with open(self.index_file_name, 'ab') as index_file:
+                index_file.write(line)
+            self.apply_index_record(record)
+            self.index_position += len(line)
+
+    # update our in-memory index using a record from the index log
+    def apply_index_record(self, record):
+        if record[0] == 'put':
+            self.index[record[1]] = (record[2], record[3], record[4])
+            self.last_segment = max(self.last_segment, record[2])
+        else:
+            self.index.pop(record[1], None)
+        self.index_record_count += 1
+
+    # load any index log records we haven't seen yet (or the whole log, if it has been rewritten by another process);
+    # returns True if any records were loaded; we check the size of the log first, so that lookups of objects that aren't
+    # packed (large objects, missing thumbnails, etc.) don't need to re-read it
+    def load_index(self):
+        with self.index_lock:
+            try:
+                stat = os.stat(self.index_file_name)
+            except FileNotFoundError:
+                return False
+            if stat.st_ino == self.index_inode and stat.st_size == self.index_position:
+                return False  # nothing new
+            try:
+                index_file = open(self.index_file_name, 'rb')
+            except FileNotFoundError:
+                return False
+            with index_file:
+                inode = os.fstat(index_file.fileno()).st_ino
+                if inode != self.index_inode:
+                    self.index = {}
+                    self.index_inode = inode
+                    self.index_position = 0
+                    self.index_record_count = 0
+                index_file.seek(self.index_position)
+                data = index_file.read()
+            end = data.rfind(b'\n') + 1  # ignore a partially written record (we'll get it next time)
+            for line in data[:end].splitlines():
+                self.apply_index_record(json.loads(line))
+            self.index_position += end
+            return end > 0
+
+    # replace the index log with one that contains a record for each object that still exists; the caller must hold the lock
+    def rewrite_index(self):
+        temp_file_name = self.index_file_name + '.tmp'
+        with open(temp_file_name, 'wb') as temp_file:
+            for (data_path, (segment, offset, length)) in self.index.items():
+                temp_file.write((json.dumps(['put', data_path, segment, offset, length]) + '\n').encode())
+            temp_file.flush()
+            os.fsync(temp_file.fileno())
+        with self.index_lock:
+            os.replace(temp_file_name, self.index_file_name)
+            self.index_inode = None
+            self.load_index()
+
+    # make sure the given segments and the index log are on disk; the caller must hold the lock
+    def sync(self, segments):
+        for file_name in [self.segment_file_name(segment) for segment in segments] + [self.index_file_name]:
+            with open(file_name, 'ab') as output_file:
+                os.fsync(output_file.fileno())
+
+    # hold an exclusive lock on the segments directory (shared with other processes using the same storage path); a blocking
+    # flock would stall every greenlet in this process, so we poll for the lock (sleeping cooperatively) instead
+    @contextmanager
+    def locked(self):
+        with open(os.path.join(self.segment_path, 'lock'), 'a', encoding='utf-8') as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except BlockingIOError:
+                    gevent.sleep(LOCK_RETRY_INTERVAL)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
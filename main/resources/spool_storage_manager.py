@@ -0,0 +1,217 @@
+import os
+import time
+import logging
+import tempfile
+import gevent
+import gevent.queue
+from .storage_manager import StorageManager, CHUNK_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+
+# maximum number of seconds to wait before retrying a failed upload
+MAX_RETRY_DELAY = 5 * 60
+
+
+# The SpoolStorageManager class wraps another storage manager (e.g. S3StorageManager) with a write-behind spool. Writes go to a
+# local spool directory (and are fsynced, so they survive a restart) and background greenlets then upload them to the wrapped
+# storage manager, retrying with backoff if the upload fails. Reads of objects that haven't been uploaded yet are served from
+# the spool. An object is uploaded once its spool file is gone; spool files left by a previous run are uploaded on startup.
+class SpoolStorageManager(StorageManager):
+
+    def __init__(self, storage_manager, app_config):
+        self.storage_manager = storage_manager
+        self.spool_path = app_config['STORAGE_SPOOL_PATH']
+        self.uploader_count = app_config['STORAGE_SPOOL_UPLOADERS']
+        self.uploads = gevent.queue.Queue()  # paths waiting to be uploaded (unbounded, since the data is already on disk)
+        self.queued = set()  # paths in the upload queue; used to avoid queueing duplicates
+        self.uploaded_count = 0
+        self.failed_count = 0
+        if not os.path.exists(self.spool_path):
+            os.makedirs(self.spool_path)
+        self.load_spool()
+
+    # spawn greenlets that upload spooled objects (the number of greenlets limits the number of concurrent uploads)
+    def start(self):
+        for _ in range(self.uploader_count):
+            gevent.spawn(self.process_uploads)
+
+    # write data to the spool; it will be uploaded to bulk storage in the background
+    def write(self, data_path, data):
+        self.write_chunks(data_path, [data])
+
+    # write data provided as a sequence of chunks to the spool; it will be uploaded to bulk storage in the background
+    def write_chunks(self, data_path, chunks):
+        (fd, temp_file_name) = tempfile.mkstemp(dir=self.spool_path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as temp_file:
+                for chunk in chunks:
+                    temp_file.write(chunk)
+                temp_file.flush()
+                os.fsync(temp_file.fileno())  # make sure the data survives a crash before we report the write as done
+            file_name = self.spool_file_name(data_path)
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            os.replace(temp_file_name, file_name)  # atomic, so readers and uploaders never see partial files
+        finally:
+            self.remove_file(temp_file_name)
+        self.enqueue(data_path)
+
+    # read data from the spool or (if already uploaded) from bulk storage
+    def read(self, data_path):
+        try:
+            with open(self.spool_file_name(data_path), 'rb') as spool_file:
+                return spool_file.read()
+        except FileNotFoundError:
+            return self.storage_manager.read(data_path)
+
+    # read data as a sequence of chunks from the spool or (if already uploaded) from bulk storage
+    def read_chunks(self, data_path, chunk_size=CHUNK_SIZE):
+        try:
+            spool_file = open(self.spool_file_name(data_path), 'rb')
+        except FileNotFoundError:
+            spool_file = None
+        if spool_file:
+            with spool_file:
+                for chunk in iter(lambda: spool_file.read(chunk_size), b''):
+                    yield chunk
+        else:
+            for chunk in self.storage_manager.read_chunks(data_path, chunk_size):
+                yield chunk
+
+    # read part of an object (from start up to but not including end) from the spool or (if already uploaded) from bulk storage
+    def read_range(self, data_path, start, end):
+        try:
+            with open(self.spool_file_name(data_path), 'rb') as spool_file:
+                spool_file.seek(start)
+                return spool_file.read(max(end - start, 0))
+        except FileNotFoundError:
+            return self.storage_manager.read_range(data_path, start, end)
+
+    # returns the size of an object in the spool or bulk storage (or None if not found)
+    def size(self, data_path):
+        try:
+            return os.path.getsize(self.spool_file_name(data_path))
+        except FileNotFoundError:
+            return self.storage_manager.size(data_path)
+
+    # returns a binary file object for reading a spooled object (or the underlying storage manager's file object if already uploaded)
+    def open_file(self, data_path):
+        try:
+            return open(self.spool_file_name(data_path), 'rb')
+        except FileNotFoundError:
+            return self.storage_manager.open_file(data_path)
+
+    # returns true if object exists in the spool or bulk storage
+    def exists(self, data_path):
+        return os.path.exists(self.spool_file_name(data_path)) or self.storage_manager.exists(data_path)
+
+    # delete an object from the spool and bulk storage
+    # fix(later): an upload that is in progress could still re-create the object in bulk storage
+    def delete(self, data_path):
+        file_name = self.spool_file_name(data_path)
+        if os.path.exists(file_name):
+            self.remove_file(file_name)
+            if not self.storage_manager.exists(data_path):
+                return  # never uploaded
+        self.storage_manager.delete(data_path)
+
+    # delete a batch of objects from the spool and bulk storage
+    def delete_many(self, data_paths):
+        for data_path in data_paths:
+            self.remove_file(self.spool_file_name(data_path))
+        self.storage_manager.delete_many(data_paths)
+
+    # list the objects in bulk storage (not including objects that are waiting in the spool)
+    def list_paths(self, prefix=''):
+        return self.storage_manager.list_paths(prefix)
+
+    # returns true if an object has been written but not yet uploaded to bulk storage
+    def is_pending(self, data_path):
+        return os.path.exists(self.spool_file_name(data_path))
+
+    # get information about spool usage
+    def stats(self):
+        return {
+            'pending': self.uploads.qsize(),
+            'uploaded': self.uploaded_count,
+            'failed_attempts': self.failed_count,
+        }
+
+    # get the name of the spool file for an object in bulk storage
+    def spool_file_name(self, data_path):
+        assert not data_path.startswith('/') and '..' not in data_path
+        return os.path.join(self.spool_path, data_path)
+
+    # add an object to the upload queue (if not already queued)
+    def enqueue(self, data_path):
+        if data_path not in self.queued:
+            self.queued.add(data_path)
+            self.uploads.put(data_path)
+
+    # this function sits in a loop, uploading spooled objects as they arrive; failed uploads are retried (with increasing
+    # delays) by the same greenlet, so a bulk storage outage doesn't turn into a flood of requests
+    def process_uploads(self):
+        while True:
+            data_path = self.uploads.get()
+            self.queued.discard(data_path)
+            attempt = 0
+            while not self.upload(data_path):
+                attempt += 1
+                gevent.sleep(min(2 ** attempt, MAX_RETRY_DELAY))
+
+    # upload a spooled object to bulk storage and remove it from the spool; returns False if the upload failed
+    def upload(self, data_path):
+        file_name = self.spool_file_name(data_path)
+        try:
+            spool_file = open(file_name, 'rb')
+        except FileNotFoundError:
+            return True  # already uploaded (e.g. by another process sharing the spool) or deleted
+        with spool_file:
+            inode = os.fstat(spool_file.fileno()).st_ino
+            try:
+                self.storage_manager.write_chunks(data_path, iter(lambda: spool_file.read(CHUNK_SIZE), b''))
+            # handle all exceptions because we want to keep the data and try again later
+            # pylint: disable=broad-except
+            except Exception:
+                logger.exception('error uploading spooled object: %s', data_path)
+                self.failed_count += 1
+                return False
+
+        # remove the spool file, unless it was replaced by a newer write while we were uploading (that write will be uploaded next)
+        try:
+            if os.stat(file_name).st_ino == inode:
+                os.unlink(file_name)
+        except FileNotFoundError:
+            pass
+        self.uploaded_count += 1
+        return True
+
+    # remove a file, ignoring files that have already been removed (e.g. by another process)
+    def remove_file(self, file_name):
+        try:
+            os.unlink(file_name)
+        except FileNotFoundError:
+            pass
+
+    # queue any objects left in the spool by a previous run (oldest first); also removes partial files left by processes
+    # that stopped while writing to the spool
+    def load_spool(self):
+        files = []
+        for (dir_name, _, file_names) in os.walk(self.spool_path):
+            for file_name in file_names:
+                path = os.path.join(dir_name, file_name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if dir_name == self.spool_path and file_name.endswith('.tmp'):
+                    if stat.st_mtime < time.time() - 60 * 60:  # if recent, could still be in use by another process
+                        logger.info('removing partial spool file: %s', file_name)
+                        self.remove_file(path)
+                else:
+                    files.append((stat.st_mtime, os.path.relpath(path, self.spool_path)))
+        for (_, data_path) in sorted(files):
+            self.enqueue(data_path)
+        if files:
+            logger.info('%d spooled objects waiting for upload', len(files))
@@ -0,0 +1,69 @@
+from abc import ABC, abstractmethod
+
+
+# default size of the chunks returned by read_chunks
+CHUNK_SIZE = 1024 * 1024
+
+
+# The StorageManager class provides an interface to be implemented by classes that store bulk data (large files/objects).
+# read and list_paths are abstract (the other methods are built on them or are optional), so a storage manager that doesn't
+# implement them fails when it is created rather than later in a background worker.
+class StorageManager(ABC):
+
+    # write data to bulk storage
+    def write(self, data_path, data):
+        pass
+
+    # write data provided as a sequence of chunks (e.g. from an upload stream) to bulk storage; storage managers should override this
+    # if they can write incrementally (so that large objects don't need to be held in memory)
+    def write_chunks(self, data_path, chunks):
+        self.write(data_path, b''.join(chunks))
+
+    # read data from bulk storage; returns None if not found
+    @abstractmethod
+    def read(self, data_path):
+        pass
+
+    # read data from bulk storage as a sequence of chunks (so that large objects don't need to be held in memory);
+    # yields nothing if not found; storage managers should override this if they can read incrementally
+    def read_chunks(self, data_path, chunk_size=CHUNK_SIZE):
+        data = self.read(data_path)
+        if data:
+            for pos in range(0, len(data), chunk_size):
+                yield data[pos:pos + chunk_size]
+
+    # read part of an object (from start up to but not including end) from bulk storage; returns None if not found;
+    # storage managers should override this if they can read part of an object without reading the whole thing
+    def read_range(self, data_path, start, end):
+        data = self.read(data_path)
+        return data[start:end] if data is not None else None
+
+    # returns the size of an object in bulk storage (or None if not found)
+    def size(self, data_path):
+        data = self.read(data_path)
+        return len(data) if data is not None else None
+
+    # returns a binary file object for reading an object in bulk storage, if the storage manager can provide one (e.g. so that
+    # the file can be sent using the server's wsgi.file_wrapper); returns None if not found or not supported
+    def open_file(self, data_path):  # pylint: disable=unused-argument
+        return None
+
+    # returns true if object exists in bulk storage
+    def exists(self, data_path):
+        pass
+
+    # delete an object in bulk storage
+    def delete(self, data_path):
+        pass
+
+    # delete a batch of objects in bulk storage (ignoring any that don't exist); storage managers should override this if they
+    # can delete many objects more efficiently than one at a time
+    def delete_many(self, data_paths):
+        for data_path in data_paths:
+            self.delete(data_path)
+
+    # list the objects in bulk storage (with paths starting with the given prefix); yields (data path, last modified UTC datetime)
+    # without loading the whole listing into memory
+    @abstractmethod
+    def list_paths(self, prefix=''):
+        pass
@@ -0,0 +1,55 @@
+import json
+import datetime
+from sqlalchemy import func
+from main.resources.models import Resource, ResourceRevision
+
+
+# the places a revision's data can be stored
+# (frequently read bulk objects are also kept on local disk by the storage cache, which tracks access recency itself)
+TIER_INLINE = 'inline'  # in the resource_revisions table
+TIER_BULK = 'bulk'  # in bulk storage (file system or S3)
+
+
+# The TieringPolicy class decides which tier should hold a revision's data. New revisions are stored inline if they are smaller than
+# STORAGE_INLINE_MAX_SIZE. Inline revisions older than STORAGE_TIERING_INLINE_MAX_AGE days (and at least STORAGE_TIERING_MIN_SIZE
+# bytes) are moved to bulk storage by the storage tiering worker, so that the database holds mostly recent/small data. Numeric and
+# text sequence values stay inline, since sequence history queries read them directly from the revision records.
+class TieringPolicy(object):
+
+    def __init__(self, app_config):
+        self.inline_max_size = app_config['STORAGE_INLINE_MAX_SIZE']
+        max_age_days = app_config['STORAGE_TIERING_INLINE_MAX_AGE']
+        self.inline_max_age = datetime.timedelta(days=max_age_days) if max_age_days else None
+        self.bulk_min_size = app_config['STORAGE_TIERING_MIN_SIZE']
+
+    # returns True if this policy will ever move existing data
+    def enabled(self):
+        return self.inline_max_age is not None
+
+    # returns the tier that should hold the data of an existing revision
+    def tier(self, resource, resource_revision, now):
+        if resource_revision.data is None:
+            return TIER_BULK
+        if not self.movable(resource):  # (even if it is large, e.g. written when there was no storage manager)
+            return TIER_INLINE
+        size = len(resource_revision.data)
+        if size >= self.inline_max_size:
+            return TIER_BULK
+        if self.inline_max_age and size >= self.bulk_min_size and resource_revision.timestamp < now - self.inline_max_age:
+            return TIER_BULK
+        return TIER_INLINE
+
+    # returns True if a resource's revisions can be moved out of the database
+    def movable(self, resource):
+        if resource.type != Resource.SEQUENCE:
+            return True
+        system_attributes = json.loads(resource.system_attributes) if resource.system_attributes else {}
+        return system_attributes.get('data_type') == Resource.IMAGE_SEQUENCE
+
+    # get SQLAlchemy criteria that select inline revisions that could be moved to bulk storage (the tier method makes the
+    # final decision)
+    def migration_criteria(self, now):
+        criteria = [ResourceRevision.data.isnot(None), func.length(ResourceRevision.data) >= self.bulk_min_size]
+        if self.inline_max_age:
+            criteria.append(ResourceRevision.timestamp < now - self.inline_max_age)
+        return criteria
@@ -0,0 +1,123 @@
+import logging
+import gevent
+import gevent.queue
+from gevent.threadpool import ThreadPool
+from .file_conversion import compute_thumbnail
+
+logger = logging.getLogger(__name__)
+
+
+# The ThumbnailQueue class computes image thumbnails outside of the request/ingest greenlets.
+# Jobs are held in a bounded queue and the image decoding/resizing runs in a small pool of OS threads,
+# so that a large image doesn't block the gevent loop (and every websocket handled by the process).
+class ThumbnailQueue(object):
+
+    def __init__(self, app_config):
+        self.thread_count = app_config['THUMBNAIL_THREADS']
+        self.jobs = gevent.queue.Queue(maxsize=app_config['THUMBNAIL_QUEUE_SIZE'])
+        self.pool = ThreadPool(self.thread_count) if self.thread_count else None  # if no threads, compute thumbnails inline
+        self.queued_file_jobs = set()  # (resource_id, revision_id, width, format); used to avoid queueing duplicate file thumbnail jobs
+
+    # spawn greenlets that take jobs from the queue (one per thread in the pool)
+    def start(self):
+        for _ in range(self.thread_count):
+            gevent.spawn(self.process_jobs)
+
+    # request a thumbnail for a revision of an image file; the result will be stored by the thumbnails module
+    def add_file_thumbnail(self, resource_id, revision_id, image_data, width, thumbnail_format='jpg'):
+        key = (resource_id, revision_id, width, thumbnail_format)
+        if key not in self.queued_file_jobs:
+            if self._add(('file', key, image_data)) and self.pool is not None:
+                self.queued_file_jobs.add(key)
+
+    # request a thumbnail for an image sequence value; the result will be stored in an (already created) revision of the
+    # sequence's thumbnail-[width]-x child sequence; if the queue is full, we compute it now (as part of the caller's transaction),
+    # since nothing else would fill in the revision; outside code must commit
+    def add_sequence_thumbnail(self, thumbnail_resource_id, thumbnail_revision_id, image_data, width):
+        job = ('sequence', (thumbnail_resource_id, thumbnail_revision_id, width, 'jpg'), image_data)
+        if not self._add(job):
+            try:
+                self.run_job(job)
+            # handle all exceptions because a bad image shouldn't stop the image itself from being stored
+            # pylint: disable=broad-except
+            except Exception:
+                logger.exception('error computing sequence thumbnail for resource %d', thumbnail_resource_id)
+
+    # the number of jobs waiting to be processed
+    def pending_count(self):
+        return self.jobs.qsize()
+
+    # add a job to the queue (or run it now if we don't have a thread pool); returns False if the queue is full; when run inline,
+    # sequence thumbnails are stored as part of the caller's (ingest) transaction, so we only commit file thumbnails, which are
+    # requested after the file has been committed
+    def _add(self, job):
+        from main.app import db  # would like to do at top, but creates import loop in __init__
+        if self.pool is None:
+            self.run_job(job)
+            if job[0] == 'file':
+                db.session.commit()
+        else:
+            try:
+                self.jobs.put_nowait(job)
+            except gevent.queue.Full:
+                logger.warning('thumbnail queue full; not queueing %s thumbnail for resource %d', job[0], job[1][0])
+                return False
+        return True
+
+    # this function sits in a loop, running thumbnail jobs as they arrive
+    def process_jobs(self):
+        from main.app import db  # would like to do at top, but creates import loop in __init__
+        while True:
+            job = self.jobs.get()
+            try:
+                self.run_job(job)
+                db.session.commit()
+            # handle all exceptions because we don't want a bad image to stop this greenlet
+            # pylint: disable=broad-except
+            except Exception:
+                logger.exception('error computing %s thumbnail for resource %d', job[0], job[1][0])
+                db.session.rollback()
+            finally:
+                self.queued_file_jobs.discard(job[1])
+                db.session.remove()
+
+    # compute a thumbnail image; returns (thumbnail data, width, height)
+    def compute(self, image_data, width, thumbnail_format='jpg'):
+        from main.resources.thumbnails import THUMBNAIL_FORMATS  # would like to do at top, but creates import loop in __init__
+        return self.apply(compute_thumbnail, (image_data, width, THUMBNAIL_FORMATS[thumbnail_format]))
+
+    # run an image processing function in the thread pool (if any) and return its result
+    def apply(self, func, args):
+        if self.pool is not None:
+            return self.pool.apply(func, args)  # only blocks the current greenlet
+        return func(*args)
+
+    # compute and store the thumbnail for a job; outside code must commit
+    def run_job(self, job):
+        from main.resources.models import Resource  # would like to do at top, but creates import loop in __init__
+        from main.resources.resource_util import store_revision_data  # would like to do at top, but creates import loop in __init__
+        from main.resources.thumbnails import write_thumbnail  # would like to do at top, but creates import loop in __init__
+        (job_type, (resource_id, revision_id, width, thumbnail_format), image_data) = job
+        (thumbnail_contents, _, thumbnail_height) = self.compute(image_data, width, thumbnail_format)
+        resource = Resource.query.filter(Resource.id == resource_id).one()
+        if job_type == 'file':
+            write_thumbnail(resource, revision_id, width, thumbnail_format, thumbnail_contents, thumbnail_height)
+        else:
+            thumbnail_revision = self.wait_for_revision(revision_id)
+            if not thumbnail_revision:
+                logger.warning('thumbnail revision %d of resource %d not found', revision_id, resource_id)
+                return
+            store_revision_data(resource, thumbnail_revision, thumbnail_contents)
+
+    # wait for a thumbnail revision record to be visible (it is committed along with the image revision, which may happen
+    # after the job is queued); returns None if it doesn't appear (e.g. the ingest transaction was rolled back)
+    def wait_for_revision(self, revision_id, max_tries=20):
+        from main.app import db  # would like to do at top, but creates import loop in __init__
+        from main.resources.models import ResourceRevision  # would like to do at top, but creates import loop in __init__
+        for _ in range(max_tries):
+            revision = ResourceRevision.query.filter(ResourceRevision.id == revision_id).first()
+            if revision:
+                return revision
+            db.session.rollback()  # end the transaction so that we can see newly committed records
+            gevent.sleep(0.5)
+        return None
@@ -0,0 +1,165 @@
+# standard python imports
+import re
+import json
+import logging
+
+
+# internal imports
+from main.app import app, db, storage_manager, thumbnail_queue
+from main.util import LRUCache
+from main.resources.models import ResourceRevision, Thumbnail
+from main.resources.file_conversion import compose_sprite_sheet
+from main.resources.blob_storage import revision_storage_path
+
+
+# thumbnail formats we can produce (file extension -> PIL format name)
+THUMBNAIL_FORMATS = {
+    'jpg': 'JPEG',
+    'png': 'PNG',
+}
+
+
+# number of consecutive thumbnails combined into each sprite sheet
+SPRITE_BLOCK_SIZE = 50
+
+
+# matches the file name of a sprite sheet (or its offset map) in bulk storage; the group is the first revision ID
+SPRITE_FILE_NAME = re.compile(r'^\d+_(\d+)\.sprite\.')
+
+
+# recently used thumbnails, keyed by (revision ID, width, format), and sprite sheets, keyed by ('sprite', resource ID, first revision ID,
+# last revision ID, revision count)
+thumbnail_cache = LRUCache(app.config['THUMBNAIL_CACHE_SIZE'])
+
+
+# get the standard thumbnail width to use for a requested width: the smallest configured width that is at least as large as
+# the request (or the largest configured width); this way we only store a small set of sizes for each image
+def snap_thumbnail_width(width):
+    widths = sorted(app.config['THUMBNAIL_WIDTHS'])
+    for standard_width in widths:
+        if standard_width >= width:
+            return standard_width
+    return widths[-1]
+
+
+# get a strong ETag for a thumbnail; the thumbnail contents are fully determined by these values
+def thumbnail_etag(revision_id, width, thumbnail_format):
+    return '%d-%d-%s' % (revision_id, width, thumbnail_format)
+
+
+# get the path of a thumbnail in the bulk storage system (stored next to the full image revision)
+def thumbnail_storage_path(resource, revision_id, width, thumbnail_format):
+    return '%s.%d.%s' % (resource.storage_path(revision_id), width, thumbnail_format)
+
+
+# get a previously computed thumbnail for a revision of an image file; returns None if we don't have it yet
+def read_thumbnail(resource, revision_id, width, thumbnail_format):
+    key = (revision_id, width, thumbnail_format)
+    data = thumbnail_cache.get(key)
+    if data is None:
+        if storage_manager:
+            data = storage_manager.read(thumbnail_storage_path(resource, revision_id, width, thumbnail_format))
+        else:  # without bulk storage, we keep thumbnails (for the current revision only) in the database
+            # fix(later): switch back to .one() query after fix issues with duplicates
+            thumbnail = Thumbnail.query.filter(
+                Thumbnail.resource_id == resource.id, Thumbnail.width == width, Thumbnail.format == thumbnail_format).first()
+            if thumbnail and revision_id == resource.last_revision_id:
+                data = thumbnail.data
+        if data is not None:
+            thumbnail_cache.put(key, data)
+    return data
+
+
+# store a thumbnail for a revision of an image file
+def write_thumbnail(resource, revision_id, width, thumbnail_format, data, height):
+    if storage_manager:
+        storage_manager.write(thumbnail_storage_path(resource, revision_id, width, thumbnail_format), data)
+    elif revision_id == resource.last_revision_id:
+        thumbnail = Thumbnail()
+        thumbnail.resource_id = resource.id
+        thumbnail.width = width  # the requested (standard) width; the image itself may be narrower
+        thumbnail.height = height
+        thumbnail.format = thumbnail_format
+        thumbnail.data = data
+        db.session.add(thumbnail)
+    else:
+        logging.debug('not storing thumbnail for old revision %d of resource %d', revision_id, resource.id)
+    thumbnail_cache.put((revision_id, width, thumbnail_format), data)
+
+
+# split the revisions of a thumbnail sequence into blocks for sprite sheets; revision_ids should be the most recent revisions
+# (newest first) and total_count the number of revisions in the sequence; blocks are aligned on the position of each revision
+# within the whole sequence, so that a block keeps the same revision range (and cached sprite sheet) as new revisions are added;
+# returns a list of [first revision ID, last revision ID] pairs
+def sprite_blocks(revision_ids, total_count):
+    blocks = {}
+    for (index, revision_id) in enumerate(revision_ids):
+        if revision_id:
+            block_index = (total_count - 1 - index) // SPRITE_BLOCK_SIZE
+            (first_rev, last_rev) = blocks.get(block_index, (revision_id, revision_id))
+            blocks[block_index] = (min(first_rev, revision_id), max(last_rev, revision_id))
+    return [list(blocks[block_index]) for block_index in sorted(blocks, reverse=True)]
+
+
+# get the path of a sprite sheet in the bulk storage system (the offset map is stored next to it with a .json extension)
+def sprite_storage_path(resource, first_rev, last_rev, revision_count):
+    return '%s.sprite.%d.%d.jpg' % (resource.storage_path(first_rev), last_rev, revision_count)
+
+
+# delete the stored sprite sheets (and offset maps) of a thumbnail sequence that start before the given revision ID (or all of them);
+# used when old revisions are truncated (so the sheets covering them are out of date) or the sequence is deleted
+def delete_sprite_sheets(resource, before_revision_id=None):
+    if not storage_manager:
+        return
+    prefix = resource.storage_path(0).rsplit('_', 1)[0] + '_'  # (the sheets are stored next to the revisions)
+    data_paths = []
+    for (data_path, _) in storage_manager.list_paths(prefix):
+        match = SPRITE_FILE_NAME.match(data_path.rsplit('/', 1)[-1])
+        if match and (before_revision_id is None or int(match.group(1)) < before_revision_id):
+            data_paths.append(data_path)
+    if data_paths:
+        storage_manager.delete_many(data_paths)
+
+
+# get a sprite sheet combining the thumbnails in a range of revisions of a thumbnail sequence; returns (sprite sheet image data,
+# offset map, complete) where the offset map gives an [x, y, width, height] box for each revision ID (as a string); if some of the
+# thumbnails haven't been computed yet, they are left out and the sprite sheet is not complete (and not cached)
+def read_sprite_sheet(resource, first_rev, last_rev):
+    revisions = (
+        ResourceRevision.query
+        .filter(ResourceRevision.resource_id == resource.id, ResourceRevision.id >= first_rev, ResourceRevision.id <= last_rev)
+        .order_by(ResourceRevision.id)[:SPRITE_BLOCK_SIZE * 2]
+    )
+    key = ('sprite', resource.id, first_rev, last_rev, len(revisions))  # the count changes if old revisions are truncated
+    cached = thumbnail_cache.get(key)
+    if cached:
+        return cached + (True,)
+    path = sprite_storage_path(resource, first_rev, last_rev, len(revisions))
+    if storage_manager:
+        sprite_data = storage_manager.read(path)
+        offset_data = storage_manager.read(path + '.json') if sprite_data else None
+        if offset_data:
+            offsets = json.loads(offset_data)
+            thumbnail_cache.put(key, (sprite_data, offsets), len(sprite_data) + len(offset_data))
+            return (sprite_data, offsets, True)
+
+    # load the thumbnails and combine them
+    revision_ids = []
+    images_data = []
+    for revision in revisions:
+        data = revision.data
+        if data is None and storage_manager:
+            data = storage_manager.read(revision_storage_path(resource, revision.id))
+        if data:
+            revision_ids.append(revision.id)
+            images_data.append(data)
+    (sprite_data, boxes) = thumbnail_queue.apply(compose_sprite_sheet, (images_data,))
+    offsets = {str(revision_id): list(box) for (revision_id, box) in zip(revision_ids, boxes)}
+    complete = len(images_data) == len(revisions)
+    if complete:
+        offset_data = json.dumps(offsets).encode()
+        if storage_manager:
+            storage_manager.write(path, sprite_data)
+            storage_manager.write(path + '.json', offset_data)
+        thumbnail_cache.put(key, (sprite_data, offsets), len(sprite_data) + len(offset_data))
+    return (sprite_data, offsets, complete)
@@ -1,4 +1,5 @@
 # standard python imports
+import os
 import csv
 import time  # fix(clean): remove
 import json
@@ -10,18 +11,21 @@ from io import StringIO
 from flask import render_template, request, abort, Response, send_from_directory, current_app
 from flask_login import current_user
 from jinja2.exceptions import TemplateNotFound
+from werkzeug.wsgi import wrap_file
+from werkzeug.http import is_resource_modified
 from sqlalchemy import func, not_
 from sqlalchemy.orm.exc import NoResultFound, MultipleResultsFound
 
 
 # internal imports
-from main.app import app, db, extensions
-from main.util import ssl_required
+from main.app import app, db, extensions, storage_manager, thumbnail_queue
+from main.util import ssl_required, not_modified_response, set_cache_validators
 from main.resources.models import Resource, ResourceRevision, ResourceView
-from main.resources.models import Thumbnail
-from main.resources.resource_util import read_resource, find_resource, mime_type_from_ext
+from main.resources.resource_util import read_resource, find_resource, mime_type_from_ext, revision_etag
+from main.resources.blob_storage import revision_storage_path
 from main.users.permissions import access_level, ACCESS_LEVEL_READ, ACCESS_LEVEL_WRITE
-from main.resources.file_conversion import process_doc_page, compute_thumbnail
+from main.resources.conversions import read_doc_page_html
+from main.resources.thumbnails import THUMBNAIL_FORMATS, snap_thumbnail_width, thumbnail_etag, read_thumbnail, sprite_blocks
 
 
 # view the server's home page
@@ -276,6 +280,7 @@ def sequence_viewer(resource):
     timestamps = [(rr.timestamp.replace(tzinfo=None) - epoch).total_seconds() for rr in resource_revisions]
     values = [rr.data.decode() for rr in resource_revisions]
     thumbnail_revs = []
+    thumbnail_blocks = []
     full_image_revs = []
     resource_path = resource.path()
     thumbnail_resource_path = ''
@@ -293,6 +298,8 @@ def sequence_viewer(resource):
             )
             thumb_map = {rr.timestamp: rr.id for rr in thumbnail_revisions}
             thumbnail_revs = [thumb_map.get(rr.timestamp) for rr in resource_revisions]  # get thumbnail rev for each sequence rev
+            thumbnail_count = ResourceRevision.query.filter(ResourceRevision.resource_id == thumbnail_resource.id).count()
+            thumbnail_blocks = sprite_blocks([rr.id for rr in thumbnail_revisions], thumbnail_count)
         full_image_revs = [rr.id for rr in resource_revisions]
 
     # generate HTML response
@@ -304,66 +311,152 @@ def sequence_viewer(resource):
         timestamps=json.dumps(timestamps),
         values=json.dumps(values),
         thumbnail_revs=json.dumps(thumbnail_revs),
+        thumbnail_blocks=json.dumps(thumbnail_blocks),
         full_image_revs=json.dumps(full_image_revs),
     )
 
 
 # a viewer for a data file
 def file_viewer(resource, check_timing=False, is_home_page=False):
+    file_ext = resource.name.rsplit('.', 1)[-1]
+    edit = request.args.get('edit', False)
+    is_markdown = resource.name.endswith('.md')  # fix(soon): revisit this
+    if not is_markdown and file_ext not in ('csv', 'txt'):
+        return send_resource_data(resource, mime_type_from_ext(resource.name))
+    if is_markdown and 'edit' not in request.args:
+        file_html = read_doc_page_html(resource, check_timing=check_timing)  # usually cached, so no need to read/parse the source
+        if file_html is None:
+            print('file_viewer: storage not found (resource: %d, path: %s)' % (resource.id, resource.path()))
+            abort(404)
+        allow_edit = access_level(resource.query_permissions()) >= ACCESS_LEVEL_WRITE
+        title = current_app.config['SYSTEM_NAME'] if is_home_page else resource.name  # fix(later): allow specify title for doc page?
+        return render_template(
+            'resources/doc-viewer.html',
+            resource=resource,
+            allow_edit=allow_edit,
+            file_html=file_html,
+            hide_loc_nav=is_home_page,
+            title=title,
+        )
     contents = read_resource(resource, check_timing=check_timing)  # returns binary data; must decode if expecting a string
     if contents is None:
         print('file_viewer: storage not found (resource: %d, path: %s)' % (resource.id, resource.path()))
         abort(404)
-    if resource.name.endswith('.md'):  # fix(soon): revisit this
-        if 'edit' in request.args:
-            return render_template(
-                'resources/text-editor.html',
-                resource=resource,
-                contents=contents.decode(),
-                show_view_button=True,
-            )
-        else:
-            file_html = process_doc_page(contents.decode())
-            allow_edit = access_level(resource.query_permissions()) >= ACCESS_LEVEL_WRITE
-            title = current_app.config['SYSTEM_NAME'] if is_home_page else resource.name  # fix(later): allow specify title for doc page?
-            return render_template(
-                'resources/doc-viewer.html',
-                resource=resource,
-                allow_edit=allow_edit,
-                file_html=file_html,
-                hide_loc_nav=is_home_page,
-                title=title,
-            )
+    if is_markdown:
+        return render_template(
+            'resources/text-editor.html',
+            resource=resource,
+            contents=contents.decode(),
+            show_view_button=True,
+        )
+    elif file_ext == 'csv' and edit is False:
+        reader = csv.reader(StringIO(contents.decode()))
+        data = list(reader)
+        return render_template('resources/table-editor.html', resource=resource, data_json=json.dumps(data))
     else:
-        file_ext = resource.name.rsplit('.', 1)[-1]
-        edit = request.args.get('edit', False)
-        if file_ext == 'csv' and edit is False:
-            reader = csv.reader(StringIO(contents.decode()))
-            data = list(reader)
-            return render_template('resources/table-editor.html', resource=resource, data_json=json.dumps(data))
-        elif file_ext == 'txt' or file_ext == 'csv':
-            return render_template('resources/text-editor.html', resource=resource, contents=contents.decode())
-        return Response(response=contents, status=200, mimetype=mime_type_from_ext(resource.name))
-
-
-# view an thumbnail image for a resource
-def thumbnail_viewer(resource):
-    width = int(request.args.get('width', 100))
-    # fix(later): switch back to .one() query after fix issues with duplicates
-    thumbnails = Thumbnail.query.filter(Thumbnail.resource_id == resource.id, Thumbnail.width == width)
-    if thumbnails.count():
-        thumbnail = thumbnails[0]
-        thumbnail_contents = thumbnail.data
+        return render_template('resources/text-editor.html', resource=resource, contents=contents.decode())
+
+
+# returns True if the request has a Range header with a single range; we only serve single ranges, so a multi-range request
+# gets the whole file (rather than a 416), while a single range beyond the end of the file is unsatisfiable
+def is_single_range_request():
+    return request.range is not None and len(request.range.ranges) == 1
+
+
+# let werkzeug handle conditional and range requests for a response holding the whole file (of the given size)
+def make_conditional_response(response, size):
+    if request.range is not None and not is_single_range_request():
+        response.headers['Accept-Ranges'] = 'bytes'
+        return response.make_conditional(request)  # (werkzeug would reject the multi-range request)
+    return response.make_conditional(request, accept_ranges=True, complete_length=size)
+
+
+# send the current contents of a file resource, supporting HTTP range requests (206 partial content); files in bulk storage
+# are streamed (using the server's wsgi.file_wrapper if the storage manager can provide a local file) or read with ranged reads
+def send_resource_data(resource, mimetype):
+
+    # if the client already has this revision, we don't need to read anything
+    etag = revision_etag(resource)
+    if etag:
+        response = not_modified_response(etag)
+        if response:
+            return response
+
+    revision = ResourceRevision.query.filter(ResourceRevision.id == resource.last_revision_id).first() if resource.last_revision_id else None
+    if not revision:
+        abort(404)
+
+    # small files are stored in the database
+    if revision.data is not None or not storage_manager:
+        if revision.data is None:
+            abort(404)
+        data = bytes(revision.data)
+        response = Response(response=data, status=200, mimetype=mimetype)
+        set_cache_validators(response, etag)
+        return make_conditional_response(response, len(data))
+
+    # if we can get a local file, let werkzeug (and the server) handle sending it
+    path = revision_storage_path(resource, revision.id)
+    data_file = storage_manager.open_file(path)  # pylint: disable=assignment-from-none
+    if data_file:
+        size = os.fstat(data_file.fileno()).st_size
+        response = Response(response=wrap_file(request.environ, data_file), status=200, mimetype=mimetype, direct_passthrough=True)
+        response.headers['Content-Length'] = size
+        set_cache_validators(response, etag)
+        return make_conditional_response(response, size)
+
+    # otherwise read the requested range (or stream the whole file) from the storage manager
+    size = storage_manager.size(path)
+    if size is None:
+        print('send_resource_data: storage not found (resource: %d, path: %s)' % (resource.id, resource.path()))
+        abort(404)
+    use_range = is_single_range_request()
+    if use_range and 'If-Range' in request.headers:  # only send part of the file if the client has the rest of this revision
+        use_range = not is_resource_modified(request.environ, etag=etag, ignore_if_range=False)
+    byte_range = request.range.range_for_length(size) if use_range else None
+    if use_range and not byte_range:
+        abort(416)
+    if byte_range:
+        (start, end) = byte_range
+        response = Response(response=storage_manager.read_range(path, start, end), status=206, mimetype=mimetype)
+        response.headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end - 1, size)
     else:
-        contents = read_resource(resource)
-        # fix(later): if this returns something other than requested width, we'll keep missing the cache
-        (thumbnail_contents, thumbnail_width, thumbnail_height) = compute_thumbnail(contents, width)
-        thumbnail = Thumbnail()
-        thumbnail.resource_id = resource.id
-        thumbnail.width = thumbnail_width
-        thumbnail.height = thumbnail_height
-        thumbnail.format = 'jpg'
-        thumbnail.data = thumbnail_contents
-        db.session.add(thumbnail)
-        db.session.commit()
-    return Response(response=thumbnail_contents, status=200, mimetype='image/jpeg')
+        response = Response(response=storage_manager.read_chunks(path), status=200, mimetype=mimetype)
+        response.headers['Content-Length'] = size
+    response.headers['Accept-Ranges'] = 'bytes'
+    return set_cache_validators(response, etag)
+
+
+# view an thumbnail image for a resource; the requested width is snapped to one of the standard thumbnail widths
+def thumbnail_viewer(resource):
+    try:
+        width = snap_thumbnail_width(int(request.args.get('width', 100)))
+    except ValueError:
+        abort(400)
+    thumbnail_format = request.args.get('format', 'jpg')
+    if thumbnail_format not in THUMBNAIL_FORMATS:
+        abort(400)
+    revision_id = resource.last_revision_id
+    if not revision_id:
+        abort(404)
+
+    # the ETag is derived from the revision, so we can check it before reading anything
+    etag = thumbnail_etag(revision_id, width, thumbnail_format)
+    response = not_modified_response(etag)
+    if response:
+        return response
+
+    # if we have the thumbnail, return it
+    thumbnail_contents = read_thumbnail(resource, revision_id, width, thumbnail_format)
+    if thumbnail_contents is not None:
+        response = Response(response=thumbnail_contents, status=200, mimetype=mime_type_from_ext(thumbnail_format))
+        return set_cache_validators(response, etag)
+
+    # if we don't have a thumbnail yet, request one and serve the original image in the meantime
+    contents = read_resource(resource)
+    if contents is None:
+        abort(404)
+    thumbnail_queue.add_file_thumbnail(resource.id, revision_id, contents, width, thumbnail_format)
+    response = Response(response=contents, status=200, mimetype=mime_type_from_ext(resource.name))
+    response.headers['Cache-Control'] = 'no-store'  # don't let the browser hold on to the full image in place of the thumbnail
+    return response
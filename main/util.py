@@ -1,11 +1,15 @@
 import logging
 import os  # fix(clean): remove?
+import time
 import datetime
+import threading
+from collections import OrderedDict
 from functools import wraps
 from typing import Dict
 
 import flask  # fix(clean): remove?
-from flask import request, redirect, current_app
+from flask import request, redirect, current_app, Response
+from werkzeug.http import is_resource_modified
 
 from .config import init_flask_config
 
@@ -49,6 +53,22 @@ def load_server_config():
     return server_config
 
 
+# set the ETag header of a response; returns the response; we don't send Last-Modified, since modification timestamps can't
+# validate a cached copy (HTTP dates only have one-second precision, and file timestamps are provided by clients)
+def set_cache_validators(response, etag):
+    response.set_etag(etag)
+    return response
+
+
+# returns a 304 (not modified) response if the request's If-None-Match header shows that the client already has this version of
+# the resource; otherwise returns None; call this before reading the resource data, so that unchanged resources don't touch bulk
+# storage at all
+def not_modified_response(etag):
+    if request.method in ('GET', 'HEAD') and not is_resource_modified(request.environ, etag=etag):
+        return set_cache_validators(Response(status=304), etag)
+    return None
+
+
 def prep_logging(app_config: Dict[str, str]):
     """Initialize logging based on the application config.
 
@@ -80,3 +100,111 @@ def prep_logging(app_config: Dict[str, str]):
         file_handler.setLevel(level)
         file_handler.setFormatter(formatter)
         root.addHandler(file_handler)
+
+
+class LRUCache(object):
+    """An in-memory cache that discards the least recently used items once the total size of its values exceeds max_bytes.
+
+    The size of a value is its length unless a size is given when the value is added. A cache with
+    max_bytes of 0 doesn't store anything. If on_evict is given, it is called with the key and value
+    of each evicted item. The cache may be used from multiple threads (e.g. storage thread pools).
+    """
+
+    def __init__(self, max_bytes, on_evict=None):
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+        self.items = OrderedDict()  # key -> (value, size); most recently used items are at the end
+        self.lock = threading.Lock()
+        self.total_size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key):
+        """Return the value for the given key (or None if not in the cache)."""
+        with self.lock:
+            item = self.items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self.items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def peek(self, key):
+        """Return the value for the given key (or None if not in the cache) without counting a lookup or marking it as used."""
+        item = self.items.get(key)
+        return item[0] if item else None
+
+    def put(self, key, value, size=None):
+        """Add/replace a value in the cache, evicting old items if needed."""
+        if size is None:
+            size = len(value)
+        evicted = []
+        with self.lock:
+            self._discard(key)
+            if size > self.max_bytes:
+                return
+            self.items[key] = (value, size)
+            self.total_size += size
+            while self.total_size > self.max_bytes:
+                (evicted_key, (evicted_value, evicted_size)) = self.items.popitem(last=False)
+                self.total_size -= evicted_size
+                self.evictions += 1
+                evicted.append((evicted_key, evicted_value))
+        if self.on_evict:
+            for (evicted_key, evicted_value) in evicted:  # (called without the lock, since this may be slow; e.g. removing files)
+                self.on_evict(evicted_key, evicted_value)
+
+    def discard(self, key):
+        """Remove a value from the cache (if present)."""
+        with self.lock:
+            self._discard(key)
+
+    def _discard(self, key):
+        item = self.items.pop(key, None)
+        if item:
+            self.total_size -= item[1]
+
+    def stats(self):
+        """Return a JSON-ready dictionary of cache statistics."""
+        lookups = self.hits + self.misses
+        return {
+            'items': len(self.items),
+            'bytes': self.total_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+        }
+
+
+class TokenBucket(object):
+    """A rate limiter that allows bursts of up to burst actions and refills at rate actions per second.
+
+    A bucket with a rate of 0 doesn't limit anything.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_time = time.monotonic()
+
+    def take(self):
+        """Use a token for an action; returns the number of seconds to wait before performing the action (0 if no wait)."""
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate  # time until the bucket is back to zero (the token we just used is borrowed)
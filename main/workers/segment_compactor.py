@@ -0,0 +1,30 @@
+import time
+import gevent
+from main.app import storage_manager
+from main.workers.util import worker_log
+
+
+# this worker thread will compact storage segment files (if the storage manager packs objects into segments), so that space used
+# by deleted/overwritten objects is reclaimed
+def segment_compactor():
+    inner_storage_manager = storage_manager
+    while hasattr(inner_storage_manager, 'storage_manager'):  # find the underlying manager (e.g. if wrapped by a cache or spool)
+        inner_storage_manager = inner_storage_manager.storage_manager
+    if not hasattr(inner_storage_manager, 'compact'):
+        return
+    worker_log('segment_compactor', 'starting')
+    while True:
+        start_time = time.time()
+        (segment_count, reclaimed) = inner_storage_manager.compact()
+
+        # display diagnostic
+        if segment_count:
+            worker_log('segment_compactor', 'compacted %d segments (%d bytes) in %.3f seconds' % (segment_count, reclaimed, time.time() - start_time))
+
+        # sleep for an hour
+        gevent.sleep(60 * 60)
+
+
+# if run as top-level script
+if __name__ == '__main__':
+    segment_compactor()
@@ -0,0 +1,97 @@
+import re
+import time
+import datetime
+import itertools
+import gevent
+from main.app import app, db, storage_manager
+from main.resources.models import ResourceRevision, StorageBlob, FileUpload
+from main.workers.util import worker_log
+
+
+# matches the file name part of the bulk storage path of a revision or of an object derived from it (a thumbnail, sprite sheet, or conversion),
+# e.g. 123_4567 or 123_4567.240.jpg
+REVISION_FILE_NAME = re.compile(r'^(\d+)_(\d+)(\.|$)')
+
+
+# returns the subset of the given bulk storage paths that aren't used by any revision, content-addressed blob, or resumable upload;
+# paths that don't match any of our layouts are never considered orphans
+def find_orphans(data_paths):
+    revision_ids = {}  # data path -> revision ID
+    digests = {}  # data path -> blob digest
+    upload_ids = {}  # data path -> upload ID
+    for data_path in data_paths:
+        parts = data_path.split('/')
+        if parts[0] == 'blobs' and len(parts) == 4:
+            digests[data_path] = parts[3]
+        elif parts[0] == 'uploads' and len(parts) == 3:
+            upload_ids[data_path] = parts[1]
+        elif len(parts) == 5:
+            match = REVISION_FILE_NAME.match(parts[4])
+            if match:
+                revision_ids[data_path] = int(match.group(2))
+    live_revision_ids = _existing(ResourceRevision.id, set(revision_ids.values()))
+    live_digests = _existing(StorageBlob.digest, set(digests.values()))
+    live_upload_ids = _existing(FileUpload.id, set(upload_ids.values()))
+    return [
+        data_path for data_path in data_paths if
+        (data_path in revision_ids and revision_ids[data_path] not in live_revision_ids) or
+        (data_path in digests and digests[data_path] not in live_digests) or
+        (data_path in upload_ids and upload_ids[data_path] not in live_upload_ids)
+    ]
+
+
+# returns the subset of the given values that exist in the given database column
+def _existing(column, values):
+    if not values:
+        return set()
+    return {row[0] for row in db.session.query(column).filter(column.in_(values))}
+
+
+# delete bulk storage objects that aren't used by any revision, blob, or upload; the storage listing is streamed and checked in
+# batches; objects modified in the last min_age hours are skipped (they may belong to transactions that haven't committed yet);
+# deletes at most rate objects per second; if dry_run is True, orphans are logged but not deleted; returns (checked, orphan count)
+def collect_storage_garbage(dry_run=True, min_age=24, rate=100, batch_size=1000):
+    min_age_thresh = datetime.datetime.utcnow() - datetime.timedelta(hours=min_age)
+    listing = storage_manager.list_paths()
+    check_count = 0
+    orphan_count = 0
+    while True:
+        batch = list(itertools.islice(listing, batch_size))
+        if not batch:
+            break
+        check_count += len(batch)
+        orphans = find_orphans([data_path for (data_path, modified) in batch if modified < min_age_thresh])
+        db.session.rollback()  # end the read transaction, so we see revisions committed while we work through the listing
+        if orphans:
+            orphan_count += len(orphans)
+            if dry_run:
+                worker_log('storage_gc', 'dry run: would delete %d objects (e.g. %s)' % (len(orphans), orphans[0]))
+            else:
+                storage_manager.delete_many(orphans)
+                gevent.sleep(float(len(orphans)) / rate)  # rate limit
+    return (check_count, orphan_count)
+
+
+# this worker thread will remove bulk storage objects that are no longer used (e.g. data of deleted or truncated revisions)
+def storage_gc():
+    if not storage_manager or not app.config['STORAGE_GC_ENABLED']:
+        return
+    worker_log('storage_gc', 'starting')
+    while True:
+        start_time = time.time()
+        dry_run = app.config['STORAGE_GC_DRY_RUN']
+        (check_count, orphan_count) = collect_storage_garbage(dry_run, app.config['STORAGE_GC_MIN_AGE'], app.config['STORAGE_GC_RATE'])
+        db.session.expunge_all()
+        db.session.close()
+
+        # display diagnostic
+        worker_log('storage_gc', 'checked %d objects; %s %d orphans in %.3f seconds' % (
+            check_count, 'found' if dry_run else 'deleted', orphan_count, time.time() - start_time))
+
+        # sleep for a day
+        gevent.sleep(24 * 60 * 60)
+
+
+# if run as top-level script
+if __name__ == '__main__':
+    storage_gc()
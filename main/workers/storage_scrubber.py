@@ -0,0 +1,130 @@
+import json
+import time
+import hashlib
+import datetime
+import gevent
+from gevent.threadpool import ThreadPool
+from main.app import app, db, storage_manager
+from main.resources.models import Resource, ResourceRevision, StorageBlob, RevisionBlob
+from main.resources.resource_util import find_resource, create_sequence, update_sequence_value, _create_folders
+from main.resources.blob_storage import blob_storage_path
+from main.workers.util import worker_log
+
+
+# the sequence that receives a message for each revision that fails verification (its system attributes also hold the checkpoint)
+REPORT_PATH = '/system/worker/storage_scrub_report'
+
+
+# check that the bulk storage object for a revision exists and (if we know them) has the expected size and SHA-1 digest;
+# returns (error message or None, number of bytes read); this is run in a thread pool, so it must not use the database (and relies
+# on the storage manager being thread-safe; e.g. S3StorageManager only uses the boto3 client, not resources)
+def verify_object(data_path, expected_size, expected_digest):
+    size = storage_manager.size(data_path)  # a HEAD request for S3
+    if size is None:
+        return ('missing', 0)
+    if expected_size is not None and size != expected_size:
+        return ('size is %d; expected %d' % (size, expected_size), 0)
+    if not expected_digest:
+        return (None, 0)
+    hasher = hashlib.sha1()
+    for chunk in storage_manager.read_chunks(data_path):
+        hasher.update(chunk)
+    if hasher.hexdigest() != expected_digest:
+        return ('hash is %s; expected %s' % (hasher.hexdigest(), expected_digest), size)
+    return (None, size)
+
+
+# get (bulk storage path, expected size, expected digest) for each of the given revisions (which must have their data in bulk storage)
+def revision_objects(revisions):
+    revision_ids = [revision.id for revision in revisions]
+    blobs = dict(
+        db.session.query(RevisionBlob.revision_id, StorageBlob)
+        .join(StorageBlob, StorageBlob.id == RevisionBlob.blob_id)
+        .filter(RevisionBlob.revision_id.in_(revision_ids))
+    )
+    resource_ids = {revision.resource_id for revision in revisions}
+    resources = {resource.id: resource for resource in Resource.query.filter(Resource.id.in_(resource_ids))}
+    objects = []
+    for revision in revisions:
+        blob = blobs.get(revision.id)
+        resource = resources[revision.resource_id]
+        if blob:
+            objects.append((blob_storage_path(blob.digest), blob.size, blob.digest))
+        elif resource.last_revision_id == revision.id and resource.type == Resource.FILE and resource.system_attributes:
+            system_attributes = json.loads(resource.system_attributes)  # we only record the hash/size of the current revision
+            objects.append((resource.storage_path(revision.id), system_attributes.get('size'), system_attributes.get('hash')))
+        else:
+            objects.append((resource.storage_path(revision.id), None, None))
+    return objects
+
+
+# verify a batch of bulk-stored revisions with IDs greater than the checkpoint; returns (last revision ID checked (or None if none
+# left), list of (revision, path, error message), number of bytes read)
+def scrub_revisions(checkpoint, pool, batch_size=100, min_age=1):
+    min_age_thresh = datetime.datetime.utcnow() - datetime.timedelta(hours=min_age)  # (newer thumbnails may still be pending)
+    revisions = (
+        ResourceRevision.query
+        .filter(ResourceRevision.id > checkpoint, ResourceRevision.data.is_(None), ResourceRevision.timestamp < min_age_thresh)
+        .order_by(ResourceRevision.id)
+        .limit(batch_size)
+        .all()
+    )
+    if not revisions:
+        return (None, [], 0)
+    objects = revision_objects(revisions)
+    results = pool.imap(lambda obj: verify_object(*obj), objects)  # (same order as objects)
+    failures = []
+    byte_count = 0
+    for (revision, (data_path, _, _), (error, size)) in zip(revisions, objects, results):
+        byte_count += size
+        if error:
+            failures.append((revision, data_path, error))
+    return (revisions[-1].id, failures, byte_count)
+
+
+# find or create the report sequence
+def report_sequence():
+    report_resource = find_resource(REPORT_PATH)
+    if not report_resource:
+        folder = _create_folders(REPORT_PATH.rsplit('/', 1)[0])
+        report_resource = create_sequence(folder, REPORT_PATH.rsplit('/', 1)[1], Resource.TEXT_SEQUENCE)
+    return report_resource
+
+
+# this worker thread will continuously check that bulk-stored revisions exist and match their recorded sizes/hashes;
+# progress is saved (in the report sequence) after each batch, so a restarted worker continues where it left off
+def storage_scrubber():
+    if not storage_manager or not app.config['STORAGE_SCRUB_ENABLED']:
+        return
+    worker_log('storage_scrubber', 'starting')
+    pool = ThreadPool(app.config['STORAGE_SCRUB_THREADS'])
+    max_rate = app.config['STORAGE_SCRUB_RATE']
+    while True:
+        start_time = time.time()
+        report_resource = report_sequence()
+        system_attributes = json.loads(report_resource.system_attributes)
+        checkpoint = system_attributes.get('checkpoint', 0)
+        (last_id, failures, byte_count) = scrub_revisions(checkpoint, pool)
+        for (revision, data_path, error) in failures:
+            message = 'revision %d of resource %d (%s): %s' % (revision.id, revision.resource_id, data_path, error)
+            update_sequence_value(report_resource, REPORT_PATH, datetime.datetime.utcnow(), message)
+        system_attributes['checkpoint'] = last_id or 0
+        report_resource.system_attributes = json.dumps(system_attributes)
+        db.session.commit()
+        db.session.expunge_all()
+        db.session.close()
+
+        # finished a pass; start again tomorrow
+        if last_id is None:
+            worker_log('storage_scrubber', 'finished pass')
+            gevent.sleep(24 * 60 * 60)
+
+        # throttle: limit the rate at which we read data (and sleep briefly between batches regardless)
+        else:
+            elapsed = time.time() - start_time
+            gevent.sleep(max(float(byte_count) / max_rate - elapsed, 1))
+
+
+# if run as top-level script
+if __name__ == '__main__':
+    storage_scrubber()
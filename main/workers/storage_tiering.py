@@ -0,0 +1,64 @@
+import time
+import datetime
+import gevent
+from main.app import app, db, storage_manager
+from main.resources.models import Resource, ResourceRevision
+from main.resources.resource_util import store_bulk_revision_data
+from main.resources.storage_tiering import TieringPolicy, TIER_BULK
+from main.workers.util import worker_log
+
+
+# move revisions to the storage tier chosen by the tiering policy; returns the number of revisions moved
+def migrate_revisions(policy, batch_size=100):
+    now = datetime.datetime.utcnow()
+    move_count = 0
+    last_id = 0
+    resources = {}  # resource ID -> resource
+    while True:
+        revisions = (
+            ResourceRevision.query
+            .filter(ResourceRevision.id > last_id, *policy.migration_criteria(now))
+            .order_by(ResourceRevision.id)
+            .limit(batch_size)
+            .all()
+        )
+        if not revisions:
+            break
+        for revision in revisions:
+            resource = resources.get(revision.resource_id)
+            if not resource:
+                resource = Resource.query.filter(Resource.id == revision.resource_id).one()
+                resources[resource.id] = resource
+            if policy.tier(resource, revision, now) == TIER_BULK:
+                store_bulk_revision_data(resource, revision, bytes(revision.data))  # readers find it here once data is cleared
+                revision.data = None
+                move_count += 1
+        last_id = revisions[-1].id
+        db.session.commit()
+        gevent.sleep(0.1)  # let other work run between batches
+    return move_count
+
+
+# this worker thread will move revision data between storage tiers (e.g. old data from the database to bulk storage)
+def storage_tiering():
+    policy = TieringPolicy(app.config)
+    if not storage_manager or not policy.enabled():
+        return
+    worker_log('storage_tiering', 'starting')
+    while True:
+        start_time = time.time()
+        move_count = migrate_revisions(policy, app.config['STORAGE_TIERING_BATCH_SIZE'])
+        db.session.expunge_all()
+        db.session.close()
+
+        # display diagnostic
+        if move_count:
+            worker_log('storage_tiering', 'moved %d revisions to bulk storage in %.3f seconds' % (move_count, time.time() - start_time))
+
+        # sleep for 6 hours
+        gevent.sleep(6 * 60 * 60)
+
+
+# if run as top-level script
+if __name__ == '__main__':
+    storage_tiering()
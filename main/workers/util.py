@@ -1,4 +1,5 @@
 import datetime
+from main.app import db, message_queue
 from main.resources.resource_util import update_sequence_value, find_resource
 
 
@@ -8,6 +9,8 @@ def worker_log(worker_name, message):
     name = '/system/worker/log'
     log_resource = find_resource(name)
     if log_resource:
-        update_sequence_value(log_resource, name, datetime.datetime.utcnow(), str(worker_name + ': ' + message))  # convert unicode to plain string
+        with message_queue.buffered():  # store the new value and its message with a single commit
+            update_sequence_value(log_resource, name, datetime.datetime.utcnow(), str(worker_name + ': ' + message))
+            db.session.commit()
     else:
         print('worker log (%s) missing' % name)
@@ -1,4 +1,5 @@
 # standard python imports
+import os
 import json
 
 
@@ -6,19 +7,30 @@ import json
 import gevent
 
 
+# an in-memory message queue only works within a single process, so the worker process uses the messages table
+# (the web process checks the table for messages from the worker); this must be set before importing main.app
+os.environ['RHIZO_WORKER_PROCESS'] = 'true'
+
+
 # internal imports
-from main.app import message_queue
-from main.workers.util import worker_log
-from main.workers.controller_watchdog import controller_watchdog
-from main.workers.sequence_truncator import sequence_truncator
-from main.workers.message_deleter import message_deleter
-from main.workers.message_monitor import message_monitor
+# pylint: disable=wrong-import-position
+from main.app import message_queue  # noqa E402
+from main.workers.util import worker_log  # noqa E402
+from main.workers.controller_watchdog import controller_watchdog  # noqa E402
+from main.workers.sequence_truncator import sequence_truncator  # noqa E402
+from main.workers.message_deleter import message_deleter  # noqa E402
+from main.workers.message_monitor import message_monitor  # noqa E402
+from main.workers.segment_compactor import segment_compactor  # noqa E402
+from main.workers.storage_tiering import storage_tiering  # noqa E402
+from main.workers.storage_gc import storage_gc  # noqa E402
+from main.workers.storage_scrubber import storage_scrubber  # noqa E402
 
 
 # import all models
-from main.users import models
-from main.messages import models
-from main.resources import models
+from main.users import models  # noqa E402
+from main.messages import models  # noqa E402
+from main.resources import models  # noqa E402
+# pylint: enable=wrong-import-position
 
 
 # the worker process
@@ -32,6 +44,10 @@ def worker():
     gevent.spawn(sequence_truncator)
     gevent.spawn(message_deleter)
     gevent.spawn(message_monitor)
+    gevent.spawn(segment_compactor)
+    gevent.spawn(storage_tiering)
+    gevent.spawn(storage_gc)
+    gevent.spawn(storage_scrubber)
 
     # loop forever
     while True:
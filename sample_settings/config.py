@@ -25,6 +25,27 @@
 # Address of MQTT server to connect to.
 # MQTT_HOST = ''
 
+# Message queue implementation used to pass messages between server processes and websocket clients.
+# 'basic' polls the messages table; 'notify' uses PostgreSQL LISTEN/NOTIFY to deliver messages immediately
+# (falling back to polling on other databases); 'memory' keeps the most recent MESSAGE_QUEUE_MEMORY_SIZE messages
+# in memory (only for servers running a single web process). With 'memory', messages can also be appended to
+# MESSAGE_QUEUE_LOG_FILE, so that messages not yet sent when the server stops are sent after it restarts.
+# The worker process (run_worker.py) always uses the messages table; with 'memory', the web process polls the
+# table twice a second for worker messages (as 'basic' does). Also note that with 'memory', messages are sent as soon
+# as they are added, even if the request that added them later rolls back its database transaction.
+# MESSAGE_QUEUE = 'basic'
+# MESSAGE_QUEUE_MEMORY_SIZE = 10000
+# MESSAGE_QUEUE_LOG_FILE = ''
+
+# Maximum number of messages waiting to be sent to a websocket client. If a client falls this far behind, older
+# sequence_update messages for the same sequence are dropped; if that isn't enough, the client is disconnected.
+# WEB_SOCKET_SEND_QUEUE_SIZE = 1000
+
+# Inbound rate limit for each websocket client (messages per second, or 0 for no limit). A client may send bursts of up
+# to WEB_SOCKET_RATE_BURST messages at full speed; after that, the server reads its messages at the given rate.
+# WEB_SOCKET_RATE_LIMIT = 200
+# WEB_SOCKET_RATE_BURST = 1000
+
 # format for postgres: 'postgresql://[username]:[password]@[hostname]/[db]'
 # SQLALCHEMY_DATABASE_URI = 'sqlite:///rhizo.db'
 
@@ -50,6 +71,55 @@
 # S3_SECRET_KEY = ''
 # S3_STORAGE_BUCKET = ''
 
+# If STORAGE_CACHE_PATH is set, recently used bulk storage objects are kept in a local disk cache in this directory
+# (up to STORAGE_CACHE_SIZE bytes per server process), so that frequently read files aren't downloaded again and again.
+# STORAGE_CACHE_PATH = ''
+# STORAGE_CACHE_SIZE = 1024 * 1024 * 1024
+
+# If True, large revisions are stored in bulk storage by content digest, so revisions with the same contents
+# (e.g. re-uploads of unchanged files) share a single object. Existing revisions remain readable either way.
+# CONTENT_ADDRESSED_STORAGE = False
+
+# When reading many files from bulk storage (e.g. for zip downloads), fetch up to STORAGE_PREFETCH_COUNT objects
+# (and STORAGE_PREFETCH_SIZE bytes) at a time in background threads. Larger files are streamed instead.
+# STORAGE_PREFETCH_COUNT = 8
+# STORAGE_PREFETCH_SIZE = 64 * 1024 * 1024
+
+# If STORAGE_SEGMENT_SIZE is set (e.g. to 256 * 1024 * 1024), the file system storage manager packs objects up to
+# STORAGE_SEGMENT_MAX_OBJECT_SIZE bytes into segment files of about this size rather than creating a file per object.
+# The worker process compacts segments to reclaim space from deleted objects. Existing files remain readable.
+# STORAGE_SEGMENT_SIZE = 0
+# STORAGE_SEGMENT_MAX_OBJECT_SIZE = 256 * 1024
+
+# If STORAGE_SPOOL_PATH is set, writes to bulk storage go to a local spool directory and are uploaded in the background
+# (by up to STORAGE_SPOOL_UPLOADERS concurrent uploads per server process, retrying on failure). Objects are served from
+# the spool until uploaded. The spool directory should be on durable local disk; anything left there is uploaded on restart.
+# STORAGE_SPOOL_PATH = ''
+# STORAGE_SPOOL_UPLOADERS = 4
+
+# Revisions smaller than STORAGE_INLINE_MAX_SIZE bytes are stored in the database rather than bulk storage. If
+# STORAGE_TIERING_INLINE_MAX_AGE is set (in days), the worker process moves older file and image revisions of at least
+# STORAGE_TIERING_MIN_SIZE bytes out of the database into bulk storage (STORAGE_TIERING_BATCH_SIZE revisions per transaction).
+# STORAGE_INLINE_MAX_SIZE = 1000
+# STORAGE_TIERING_INLINE_MAX_AGE = 0
+# STORAGE_TIERING_MIN_SIZE = 100
+# STORAGE_TIERING_BATCH_SIZE = 100
+
+# If STORAGE_GC_ENABLED is True, the worker process lists bulk storage once a day and removes objects that aren't used by any
+# revision (skipping objects modified in the last STORAGE_GC_MIN_AGE hours and deleting at most STORAGE_GC_RATE objects per second).
+# With STORAGE_GC_DRY_RUN set, orphans are only reported in the worker log; check the log before turning it off.
+# STORAGE_GC_ENABLED = False
+# STORAGE_GC_DRY_RUN = True
+# STORAGE_GC_MIN_AGE = 24
+# STORAGE_GC_RATE = 100
+
+# If STORAGE_SCRUB_ENABLED is True, the worker process continuously checks that bulk-stored revisions exist and match their
+# recorded sizes/hashes (reading at most STORAGE_SCRUB_RATE bytes per second using STORAGE_SCRUB_THREADS threads). Problems are
+# reported in the /system/worker/storage_scrub_report sequence.
+# STORAGE_SCRUB_ENABLED = False
+# STORAGE_SCRUB_RATE = 10 * 1024 * 1024
+# STORAGE_SCRUB_THREADS = 4
+
 # these OUTGOING_EMAIL settings are required if you want to invite people to create accounts
 # OUTGOING_EMAIL_ADDRESS = ''
 # OUTGOING_EMAIL_USER_NAME = ''
@@ -57,9 +127,29 @@
 # OUTGOING_EMAIL_SERVER = ''
 # OUTGOING_EMAIL_PORT = 587
 
+# Number of background threads used to compute image thumbnails, and the max number of thumbnail jobs
+# waiting for those threads. If THUMBNAIL_THREADS is 0, thumbnails are computed inline.
+# THUMBNAIL_THREADS = 2
+# THUMBNAIL_QUEUE_SIZE = 100
+
+# Standard thumbnail widths; requested widths are rounded up to one of these. Thumbnails are stored in bulk
+# storage (if configured) and the most recently used ones are kept in memory, up to THUMBNAIL_CACHE_SIZE bytes.
+# THUMBNAIL_WIDTHS = [60, 120, 240, 480, 960]
+# THUMBNAIL_CACHE_SIZE = 16 * 1024 * 1024
+
+# Converted downloads (e.g. CSV files downloaded as XLS) are stored in bulk storage (if configured) next to the source revision,
+# and the most recently used ones are kept in memory, up to CONVERSION_CACHE_SIZE bytes.
+# CONVERSION_CACHE_SIZE = 16 * 1024 * 1024
+
 # EXTRA_NAV_ITEMS = ''
 # DOC_FILE_PREFIX = ''
 
+# Rendered doc pages (markdown files) are cached in memory by revision, up to DOC_PAGE_CACHE_SIZE bytes.
+# If DOC_PAGE_STORE_RENDERED is set, the rendered HTML is also stored next to the revision in bulk storage,
+# so other server processes (and restarts) don't need to re-render pages.
+# DOC_PAGE_CACHE_SIZE = 4 * 1024 * 1024
+# DOC_PAGE_STORE_RENDERED = False
+
 #
 # Random keys are generated by prep_config.py; override if needed.
 #
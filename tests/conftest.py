@@ -13,6 +13,7 @@ os.environ['RHIZO_SERVER_SETTINGS'] = str(pathlib.Path(__file__).parent) + '/dis
 # pylint: disable=wrong-import-position
 from main.api.messages import MessageList  # noqa E402
 from main.api.resources import ResourceList, ResourceRecord  # noqa E402
+from main.api.uploads import FileUploadList, FileUploadRecord  # noqa E402
 import main.app  # noqa E402
 import main.messages.models  # noqa E402
 from main.resources.models import ControllerStatus, Resource  # noqa E402
@@ -75,6 +76,8 @@ def api(app):
     api.add_resource(MessageList, '/api/v1/messages')
     api.add_resource(ResourceList, '/api/v1/resources')
     api.add_resource(ResourceRecord, '/api/v1/resources/<path:resource_path>')
+    api.add_resource(FileUploadList, '/api/v1/uploads')
+    api.add_resource(FileUploadRecord, '/api/v1/uploads/<string:upload_id>')
 
     return api
 
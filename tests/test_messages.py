@@ -0,0 +1,139 @@
+import datetime
+import json
+
+import gevent
+
+from main.app import db
+from main.messages.message_queue_basic import MessageQueueBasic
+from main.messages.message_queue_memory import MessageQueueMemory
+from main.messages.message_queue_notify import MessageQueueNotify
+from main.messages.models import Message
+from main.messages.socket_receiver import MessageSubscription
+from main.messages.socket_sender import SocketSender, message_payload, message_coalesce_key
+from main.messages.web_socket_connection import WebSocketConnection
+from main.util import TokenBucket
+
+
+class FakeWebSocket:
+    def __init__(self):
+        self.closed = False
+        self.sent = []
+
+    def send(self, message):
+        self.sent.append(message)
+
+    def close(self):
+        self.closed = True
+
+
+def test_message_queue_notify(folder_resource):
+    message_queue = MessageQueueNotify()
+    message_queue.add(folder_resource.id, '/folder', 'first', {'value': 1})
+    message_queue.add(folder_resource.id, '/folder', 'second')
+    messages = message_queue.receive()  # on SQLite, this polls rather than listening for notifications
+    assert [m.type for m in messages] == ['first', 'second']
+
+    # only new messages are returned
+    message_queue.add(folder_resource.id, '/folder', 'third')
+    assert [m.type for m in message_queue.receive()] == ['third']
+
+
+def test_message_queue_memory(tmp_path):
+    config = {'MESSAGE_QUEUE_MEMORY_SIZE': 3, 'MESSAGE_QUEUE_LOG_FILE': str(tmp_path / 'messages.log')}
+    message_queue = MessageQueueMemory(config)
+    for message_type in ('a', 'b'):
+        message_queue.add(1, '/folder', message_type, {'value': message_type})
+    assert [(m.id, m.type, m.parameters) for m in message_queue.receive()] == [(1, 'a', '{"value": "a"}'), (2, 'b', '{"value": "b"}')]
+    for message_type in ('c', 'd', 'e', 'f'):
+        message_queue.add(1, '/folder', message_type)
+    assert [m.type for m in message_queue.receive()] == ['d', 'e', 'f']  # the ring buffer only holds 3 messages
+    message_queue.add(1, '/folder', 'g')
+
+    # after a restart, unsent messages are loaded from the log
+    message_queue = MessageQueueMemory(config)
+    assert [(m.id, m.type) for m in message_queue.receive()] == [(7, 'g')]
+    message_queue.add(1, '/folder', 'h')
+    assert [m.id for m in message_queue.receive()] == [8]
+
+
+def test_message_queue_memory_receives_table_messages(folder_resource):
+    message_queue = MessageQueueMemory({'MESSAGE_QUEUE_MEMORY_SIZE': 10, 'MESSAGE_QUEUE_LOG_FILE': ''})
+    MessageQueueBasic().add(folder_resource.id, '/folder', 'from_worker')  # e.g. added by the worker process
+    message_queue.add(folder_resource.id, '/folder', 'from_web')
+    assert [m.type for m in message_queue.receive()] == ['from_web', 'from_worker']
+
+    # worker messages are received without waiting for a web message (within the table poll interval)
+    MessageQueueBasic().add(folder_resource.id, '/folder', 'from_worker_only')
+    with gevent.Timeout(2):
+        assert [m.type for m in message_queue.receive()] == ['from_worker_only']
+
+
+def test_buffered_messages(folder_resource):
+    message_queue = MessageQueueBasic()
+    message_queue.add_many([{'folder_id': folder_resource.id, 'folder_path': '/folder', 'message_type': t} for t in ('a', 'b')])
+    with message_queue.buffered():
+        message_queue.add(folder_resource.id, '/folder', 'c')
+        message_queue.add(folder_resource.id, '/folder', 'd', {'value': 1})
+        assert len(message_queue.new_messages()) == 2  # buffered messages aren't inserted until the session commits
+        db.session.commit()
+        assert [(m.type, m.parameters) for m in message_queue.new_messages()] == [('c', '{}'), ('d', '{"value": 1}')]
+        message_queue.add(folder_resource.id, '/folder', 'e')
+    assert [m.type for m in message_queue.new_messages()] == ['e']  # remaining messages are inserted at the end of the block
+
+
+def test_socket_sender_routing():
+    socket_sender = SocketSender()
+    (browser, controller) = (WebSocketConnection(FakeWebSocket()), WebSocketConnection(FakeWebSocket()))
+    controller.controller_id = 5
+    for ws_conn in (browser, controller):
+        socket_sender.register(ws_conn)
+    socket_sender.subscribe(browser, MessageSubscription(1, None))
+    socket_sender.subscribe(browser, MessageSubscription(2, 'update'))
+    socket_sender.subscribe(controller, MessageSubscription(1, 'update'))
+    assert socket_sender.subscribers(Message(folder_id=1, type='update')) == {browser, controller}
+    assert socket_sender.subscribers(Message(folder_id=1, type='other')) == {browser}
+    assert socket_sender.subscribers(Message(folder_id=2, type='other')) == set()
+    assert socket_sender.subscribers(Message(folder_id=1, type='update', sender_controller_id=5)) == {browser}  # no bounce
+
+    # unregistering a client removes its routes
+    socket_sender.unregister(browser)
+    assert socket_sender.subscribers(Message(folder_id=1, type='update')) == {controller}
+    assert 2 not in socket_sender.routes
+
+
+def test_message_payload():
+    message = Message(type='update', timestamp=datetime.datetime(2020, 1, 2, 3, 4, 5), parameters='{"value": [1, "x"]}')
+    assert json.loads(message_payload(message)) == {'type': 'update', 'timestamp': '2020-01-02T03:04:05Z', 'parameters': {'value': [1, 'x']}}
+
+
+def test_send_queue(monkeypatch, app):
+    monkeypatch.setitem(app.config, 'WEB_SOCKET_SEND_QUEUE_SIZE', 3)
+    socket_sender = SocketSender()
+    ws_conn = WebSocketConnection(FakeWebSocket())
+    socket_sender.register(ws_conn)
+
+    # when the queue overflows, only the latest update for each sequence is kept
+    for (sequence_id, value) in [(1, 'a'), (2, 'b'), (1, 'c'), (1, 'd')]:
+        message = Message(type='sequence_update', parameters=json.dumps({'id': sequence_id, 'value': value}))
+        assert ws_conn.queue_message(message.parameters, message_coalesce_key(message))
+    assert ws_conn.queue_stats()['dropped'] == 2
+    gevent.sleep(0)  # let the writer greenlet run
+    assert [json.loads(m)['value'] for m in ws_conn.ws.sent] == ['b', 'd']
+    assert ws_conn.queue_stats()['queue_depth'] == 0
+
+    # messages that can't be coalesced make the queue overflow
+    assert all(ws_conn.queue_message('x') for _ in range(3))
+    assert not ws_conn.queue_message('x')
+    socket_sender.disconnect(ws_conn)
+    assert ws_conn.ws.closed
+    assert ws_conn.queue_stats()['dropped'] == 6  # messages cleared by the disconnect are counted too
+    socket_sender.unregister(ws_conn)
+    assert ws_conn.closing
+
+
+def test_token_bucket():
+    rate_limit = TokenBucket(10, 2)
+    assert rate_limit.take() == 0 and rate_limit.take() == 0  # burst
+    assert 0.05 < rate_limit.take() <= 0.1
+    assert 0.15 < rate_limit.take() <= 0.2
+    assert TokenBucket(0, 0).take() == 0
@@ -1,12 +1,18 @@
 import base64
 import random
+import datetime
+import zipfile
 from io import BytesIO
 from typing import Union
 
 from PIL import Image
 import pytest
+import xlrd
+from werkzeug.http import http_date
 
-from main.resources.models import Resource
+from main.resources.models import Resource, ResourceRevision
+from main.resources.conversions import conversion_cache, doc_page_cache, read_doc_page_html
+from main.resources.resource_util import create_sequence, find_resource, update_sequence_value
 
 
 @pytest.mark.usefixtures('api', 'folder_resource')
@@ -57,6 +63,72 @@ class TestResourceOperations:
     def test_file_exists(self):
         assert self.client.get('/api/v1/resources/folder/nonexistentFile?meta=1').status_code == 404
 
+    def test_conditional_get(self):
+        url = '/api/v1/resources/folder/config.txt'
+        file_info = {'data': base64.b64encode(b'setting=1'), 'path': '/folder', 'file': 'config.txt'}
+        assert self.client.post(url, data=file_info).status_code == 200
+        result = self.client.get(url)
+        etag = result.headers['ETag']
+        assert result.data == b'setting=1' and 'Last-Modified' not in result.headers
+        result = self.client.get(url, headers={'If-None-Match': etag})
+        assert result.status_code == 304 and not result.data
+        assert self.client.get(url, headers={'If-None-Match': '"other"'}).status_code == 200
+
+        # a new revision gets a new tag
+        file_info['data'] = base64.b64encode(b'setting=2')
+        assert self.client.put(url, data=file_info).status_code == 200
+        result = self.client.get(url, headers={'If-None-Match': etag})
+        assert result.status_code == 200 and result.data == b'setting=2'
+
+    def test_convert_csv_to_xls(self):
+        url = '/api/v1/resources/folder/report.csv'
+        file_info = {'data': base64.b64encode(b'a,b\r\n1,"x\ny"\r\n'), 'path': '/folder', 'file': 'report.csv'}
+        assert self.client.post(url, data=file_info).status_code == 200
+        hits = conversion_cache.hits
+        for _ in range(2):
+            result = self.client.get(url + '?convert_to=xls&download=1')
+            assert result.status_code == 200
+            assert result.headers['Content-Disposition'] == 'attachment; filename=report.xls'
+            sheet = xlrd.open_workbook(file_contents=result.data).sheet_by_index(0)
+            assert [sheet.row_values(i) for i in range(sheet.nrows)] == [['a', 'b'], ['1', 'x\ny']]
+        assert conversion_cache.hits == hits + 1
+
+    def test_doc_page_cache(self):
+        url = '/api/v1/resources/folder/notes.md'
+        file_info = {'data': base64.b64encode(b'# Notes\n\nversion 1'), 'path': '/folder', 'file': 'notes.md'}
+        assert self.client.post(url, data=file_info).status_code == 200
+        resource = find_resource('/folder/notes.md')
+        hits = doc_page_cache.hits
+        for _ in range(2):
+            assert '<h1>Notes</h1>' in read_doc_page_html(resource)
+        assert doc_page_cache.hits == hits + 1
+
+        # a new revision is rendered again
+        file_info['data'] = base64.b64encode(b'# Notes\n\nversion 2')
+        assert self.client.put(url, data=file_info).status_code == 200
+        assert 'version 2' in read_doc_page_html(find_resource('/folder/notes.md'))
+
+    def test_batch_download(self):
+        url_prefix = '/api/v1/resources'
+        contents = {'a.txt': b'hello', 'b.bin': bytes(random.getrandbits(8) for _ in range(5000))}
+        for (filename, content) in contents.items():
+            file_info = {'data': base64.b64encode(content), 'path': '/folder', 'file': filename}
+            assert self.client.post(f'{url_prefix}/folder/{filename}', data=file_info).status_code == 200
+        ids = [str(self.client.get(f'{url_prefix}/folder/{filename}?meta=1').json['id']) for filename in contents]
+
+        result = self.client.get(f'{url_prefix}/folder?download=1&ids={",".join(ids)}')
+        assert result.status_code == 200
+        zip_file = zipfile.ZipFile(BytesIO(result.data))
+        for (filename, content) in contents.items():
+            assert zip_file.read(filename) == content
+
+        # a file whose data is missing is left empty (and logged) rather than delaying the download to check every file first
+        ResourceRevision.query.filter(ResourceRevision.id == find_resource('/folder/a.txt').last_revision_id).update({'data': None})
+        result = self.client.get(f'{url_prefix}/folder?download=1&ids={",".join(ids)}')
+        assert result.status_code == 200
+        zip_file = zipfile.ZipFile(BytesIO(result.data))
+        assert zip_file.read('a.txt') == b'' and zip_file.read('b.bin') == contents['b.bin']
+
     def test_create_multiple_folder_levels(self):
         resources_url = '/api/v1/resources'
         parent_folder = f'/folder/parent{random.randint(1, 999999)}'
@@ -107,6 +179,24 @@ class TestResourceOperations:
         response_content = self._write_then_read_sequence(sequence_url, str(value).encode())
         assert int(response_content.decode()) == value
 
+    def test_conditional_get_sequence(self):
+        sequence = create_sequence(find_resource('/folder'), 'status', Resource.TEXT_SEQUENCE)
+        url = '/api/v1/resources/folder/status'
+        timestamp = datetime.datetime.utcnow().replace(microsecond=0)
+        update_sequence_value(sequence, '/folder/status', timestamp, 'a', emit_message=False)
+        Resource.query.session.commit()
+        assert self.client.get(url).data == b'a'
+
+        # a second update within the same second isn't hidden by If-Modified-Since (which has one-second precision)
+        update_sequence_value(sequence, '/folder/status', timestamp + datetime.timedelta(seconds=0.5), 'b', emit_message=False)
+        Resource.query.session.commit()
+        result = self.client.get(url, headers={'If-Modified-Since': http_date(timestamp)})
+        assert result.status_code == 200 and result.data == b'b'
+
+    def test_sprite_sheet_requires_image_sequence(self):
+        create_sequence(find_resource('/folder'), 'numbers', Resource.NUMERIC_SEQUENCE)
+        assert self.client.get('/api/v1/resources/folder/numbers?sprite=map&first_rev=1&last_rev=2').status_code == 400
+
     def test_update_float_sequence(self):
         sequence_url = self._create_sequence(Resource.NUMERIC_SEQUENCE)
         value = random.randint(1, 100) + .5
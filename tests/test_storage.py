@@ -0,0 +1,343 @@
+import os
+import time
+import fcntl
+import datetime
+import hashlib
+import json
+
+import gevent
+import pytest
+from gevent.threadpool import ThreadPool
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+
+import main.resources.blob_storage
+import main.resources.resource_util
+import main.resources.views
+import main.workers.sequence_truncator
+import main.workers.storage_gc
+import main.workers.storage_scrubber
+from main.resources.blob_storage import blob_storage_path, delete_unused_blobs
+from main.resources.caching_storage_manager import CachingStorageManager
+from main.resources.file_system_storage_manager import FileSystemStorageManager
+from main.resources.models import Resource, ResourceRevision, StorageBlob
+from main.resources.segment_storage_manager import SegmentStorageManager
+from main.resources.spool_storage_manager import SpoolStorageManager
+from main.resources.storage_tiering import TieringPolicy
+from main.workers.storage_tiering import migrate_revisions
+from main.workers.sequence_truncator import truncate_sequences
+from main.workers.storage_gc import collect_storage_garbage
+from main.workers.storage_scrubber import scrub_revisions
+from main.resources.resource_util import _create_file, create_file_from_chunks, read_resource, read_resources_prefetched, delete_resource
+from main.resources.resource_util import add_resource_revision, create_sequence, find_resource
+from main.resources.views import send_resource_data
+
+# pylint: disable=redefined-outer-name
+
+
+@pytest.fixture
+def storage_manager(tmp_path, monkeypatch):
+    """A file system storage manager in a temporary directory, used by resource_util."""
+    storage_manager = FileSystemStorageManager({'FILE_SYSTEM_STORAGE_PATH': str(tmp_path)})
+    monkeypatch.setattr(main.resources.resource_util, 'storage_manager', storage_manager)
+    monkeypatch.setattr(main.resources.blob_storage, 'storage_manager', storage_manager)
+    monkeypatch.setattr(main.resources.views, 'storage_manager', storage_manager)
+    return storage_manager
+
+
+def test_read_chunks(storage_manager):
+    storage_manager.write('a/b', b'x' * 2500)
+    assert [len(chunk) for chunk in storage_manager.read_chunks('a/b', 1000)] == [1000, 1000, 500]
+    assert list(storage_manager.read_chunks('a/missing')) == []
+
+
+def test_caching_storage_manager(storage_manager, tmp_path):
+    cache_config = {'STORAGE_CACHE_PATH': str(tmp_path / 'cache'), 'STORAGE_CACHE_SIZE': 2500}
+    cache = CachingStorageManager(storage_manager, cache_config)
+    cache.write('a/1', b'1' * 1000)  # populated on write
+    storage_manager.write('a/2', b'2' * 1000)
+    assert cache.read('a/1') == b'1' * 1000
+    assert cache.read('a/2') == b'2' * 1000  # miss; now cached
+    assert b''.join(cache.read_chunks('a/2', 300)) == b'2' * 1000
+    assert cache.stats()['hits'] == 2
+    assert cache.stats()['misses'] == 1
+
+    # adding a third object evicts the least recently used one
+    storage_manager.write('a/3', b'3' * 1000)
+    assert b''.join(cache.read_chunks('a/3')) == b'3' * 1000
+    assert cache.stats()['evictions'] == 1
+    assert 'a/1' not in cache.index
+    assert cache.read('a/1') == b'1' * 1000  # read from the underlying storage manager again
+
+    # the index is loaded from the cache directory on startup
+    cache = CachingStorageManager(storage_manager, cache_config)
+    assert cache.total_size == 2000
+    assert cache.read('a/1') == b'1' * 1000
+    assert cache.stats()['hit_ratio'] == 1.0
+
+
+class FlakyStorageManager(FileSystemStorageManager):
+    """A file system storage manager whose first write fails."""
+
+    def __init__(self, app_config):
+        super().__init__(app_config)
+        self.fail = True
+
+    def write_chunks(self, data_path, chunks):
+        if self.fail:
+            self.fail = False
+            raise IOError('storage unavailable')
+        super().write_chunks(data_path, chunks)
+
+
+def test_spool_storage_manager(tmp_path):
+    backend = FlakyStorageManager({'FILE_SYSTEM_STORAGE_PATH': str(tmp_path / 'storage')})
+    spool_config = {'STORAGE_SPOOL_PATH': str(tmp_path / 'spool'), 'STORAGE_SPOOL_UPLOADERS': 1}
+    spool = SpoolStorageManager(backend, spool_config)
+    spool.write('a/1', b'1' * 1000)
+    assert spool.is_pending('a/1') and not backend.exists('a/1')
+    assert spool.read('a/1') == b'1' * 1000  # served from the spool
+    assert spool.read_range('a/1', 10, 20) == b'1' * 10
+    assert spool.size('a/1') == 1000
+
+    # a failed upload leaves the data in the spool (and is picked up again after a restart)
+    assert not spool.upload('a/1')
+    assert spool.is_pending('a/1')
+    spool = SpoolStorageManager(backend, spool_config)
+    assert spool.stats()['pending'] == 1
+    assert spool.upload(spool.uploads.get())
+    assert not spool.is_pending('a/1')
+    assert backend.read('a/1') == b'1' * 1000
+    assert b''.join(spool.read_chunks('a/1')) == b'1' * 1000
+
+    spool.delete('a/1')
+    assert not spool.exists('a/1')
+
+
+def test_segment_storage_manager(tmp_path):
+    config = {'FILE_SYSTEM_STORAGE_PATH': str(tmp_path), 'STORAGE_SEGMENT_SIZE': 2500, 'STORAGE_SEGMENT_MAX_OBJECT_SIZE': 1000}
+    segments = SegmentStorageManager(config)
+    for i in range(4):
+        segments.write('a/%d' % i, bytes([i]) * 1000)
+    segments.write_chunks('a/large', [b'x' * 800, b'y' * 800])  # too large to pack
+    assert sorted(os.listdir(tmp_path / 'segments')) == ['00000001.seg', '00000002.seg', 'index.log', 'lock']
+    assert (tmp_path / 'a' / 'large').exists()
+    assert segments.read('a/1') == b'\x01' * 1000
+    assert segments.read_range('a/2', 10, 20) == b'\x02' * 10
+    assert b''.join(segments.read_chunks('a/3', 300)) == b'\x03' * 1000
+    assert segments.size('a/0') == 1000 and segments.open_file('a/0') is None
+    assert segments.read('a/large') == b'x' * 800 + b'y' * 800
+
+    # deleted objects are removed from the index (in this process and others) and their space is reclaimed by compaction
+    segments.delete('a/0')
+    segments.delete('a/1')
+    other_process = SegmentStorageManager(config)
+    assert not other_process.exists('a/0') and other_process.read('a/2') == b'\x02' * 1000
+    segments.write('a/4', b'4' * 1000)  # third segment, so the second is no longer the current segment
+    assert segments.compact() == (1, 2000)
+    assert not (tmp_path / 'segments' / '00000001.seg').exists()
+    assert other_process.read('a/2') == b'\x02' * 1000  # finds the new location after compaction
+    assert SegmentStorageManager(config).read('a/3') == b'\x03' * 1000
+
+    # an object whose data didn't reach the disk before a crash is treated as missing
+    segments.write('a/5', b'5' * 10)
+    (segment, offset, _) = segments.locate('a/5')
+    os.truncate(segments.segment_file_name(segment), offset + 5)
+    assert SegmentStorageManager(config).read('a/5') is None
+
+    # waiting for the lock (held by another process) doesn't block other greenlets
+    with open(tmp_path / 'segments' / 'lock', 'a', encoding='utf-8') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        writer = gevent.spawn(segments.write, 'a/6', b'6')
+        gevent.sleep(0.05)
+        assert not writer.ready()
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+    writer.join(1)
+    assert segments.read('a/6') == b'6'
+
+    # live objects are copied in batches
+    segments.delete('a/2')
+    assert segments.compact(batch_size=1) == (1, 1000)
+    assert other_process.read('a/3') == b'\x03' * 1000
+
+    # an object that was removed (along with its segment) after it was located reads as missing
+    assert segments.read_segment('a/removed', (999, 0, 10), 0, 10) is None
+
+
+@pytest.mark.usefixtures('folder_resource')
+def test_read_resources_prefetched(storage_manager, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'STORAGE_PREFETCH_COUNT', 2)
+    monkeypatch.setitem(app.config, 'STORAGE_PREFETCH_SIZE', 10000)
+    now = datetime.datetime.utcnow()
+    contents = [b'small', b'a' * 5000, b'b' * 20000, b'c' * 3000, b'd' * 6000]  # third file is too large to prefetch
+    resources = [_create_file('/folder/file%d' % i, now, now, data) for (i, data) in enumerate(contents)]
+    assert storage_manager.exists(resources[1].storage_path(resources[1].last_revision_id))
+
+    results = [(resource, b''.join(chunks)) for (resource, chunks) in read_resources_prefetched(resources)]
+    assert [resource.id for (resource, _) in results] == [resource.id for resource in resources]
+    assert [data for (_, data) in results] == contents
+
+
+@pytest.mark.usefixtures('folder_resource')
+def test_content_addressed_storage(storage_manager, app, monkeypatch):
+    monkeypatch.setitem(app.config, 'CONTENT_ADDRESSED_STORAGE', True)
+    now = datetime.datetime.utcnow()
+    data = b'x' * 5000
+    first = _create_file('/folder/first', now, now, data)
+    second = _create_file('/folder/second', now, now, data)
+    blob = StorageBlob.query.filter(StorageBlob.size == len(data)).one()
+    assert blob.ref_count == 2
+    blob_path = blob_storage_path(blob.digest)
+    assert storage_manager.exists(blob_path)
+    assert not storage_manager.exists(first.storage_path(first.last_revision_id))
+    assert read_resource(first) == data
+    assert read_resource(second) == data
+
+    delete_resource(first)
+    StorageBlob.query.session.refresh(blob)
+    assert blob.ref_count == 1
+    delete_resource(second)
+    assert delete_unused_blobs() == 1
+    assert not storage_manager.exists(blob_path)
+
+
+@pytest.mark.usefixtures('folder_resource')
+def test_content_addressed_storage_turned_off(storage_manager, app, monkeypatch):
+    monkeypatch.setattr(main.workers.sequence_truncator, 'storage_manager', storage_manager)
+    monkeypatch.setitem(app.config, 'CONTENT_ADDRESSED_STORAGE', True)
+    sequence = create_sequence(find_resource('/folder'), 'values', Resource.TEXT_SEQUENCE, max_history=1)
+    start = datetime.datetime.utcnow()
+    for i in range(3):
+        add_resource_revision(sequence, start + datetime.timedelta(seconds=i), str(i).encode() * 5000)
+    assert StorageBlob.query.count() == 3
+
+    # revisions written with content-addressed storage remain readable after it is turned off
+    monkeypatch.setitem(app.config, 'CONTENT_ADDRESSED_STORAGE', False)
+    assert read_resource(sequence) == b'2' * 5000
+
+    # truncating the sequence releases and deletes the blobs of the old revisions
+    assert truncate_sequences(buffer_size=0, verbose=False) >= 1
+    assert StorageBlob.query.count() == 1
+    assert len(list(storage_manager.list_paths())) == 1
+    assert read_resource(sequence) == b'2' * 5000
+
+
+@pytest.mark.usefixtures('folder_resource')
+@pytest.mark.parametrize('content_addressed', [False, True])
+def test_create_file_from_chunks(storage_manager, app, monkeypatch, content_addressed):
+    monkeypatch.setitem(app.config, 'CONTENT_ADDRESSED_STORAGE', content_addressed)
+    now = datetime.datetime.utcnow()
+    chunks = [b'a' * 700, b'b' * 700, b'c' * 700]
+    resource = create_file_from_chunks('/folder/chunked', now, now, chunks)
+    assert read_resource(resource) == b''.join(chunks)
+    assert json.loads(resource.system_attributes) == {'hash': hashlib.sha1(b''.join(chunks)).hexdigest(), 'size': 2100}
+    assert storage_manager.exists(resource.storage_path(resource.last_revision_id)) != content_addressed
+
+
+@pytest.mark.usefixtures('folder_resource')
+def test_migrate_revisions(storage_manager):
+    policy = TieringPolicy({'STORAGE_INLINE_MAX_SIZE': 1000, 'STORAGE_TIERING_INLINE_MAX_AGE': 30, 'STORAGE_TIERING_MIN_SIZE': 100})
+    now = datetime.datetime.utcnow()
+    old = now - datetime.timedelta(days=60)
+    old_file = _create_file('/folder/old', old, old, b'o' * 500)
+    tiny_file = _create_file('/folder/tiny', old, old, b't' * 50)
+    new_file = _create_file('/folder/new', now, now, b'n' * 500)
+    sequence = create_sequence(find_resource('/folder'), 'notes', Resource.TEXT_SEQUENCE)
+    long_value = ResourceRevision(resource_id=sequence.id, timestamp=old, data=b'v' * 2000)  # e.g. stored without a storage manager
+    ResourceRevision.query.session.add(long_value)
+    ResourceRevision.query.session.flush()
+    assert migrate_revisions(policy, batch_size=1) == 1
+    assert bytes(long_value.data) == b'v' * 2000  # text sequence values stay inline, however large
+    assert storage_manager.read(old_file.storage_path(old_file.last_revision_id)) == b'o' * 500
+    assert read_resource(old_file) == b'o' * 500
+    assert read_resource(tiny_file) == b't' * 50 and read_resource(new_file) == b'n' * 500
+    assert not storage_manager.exists(new_file.storage_path(new_file.last_revision_id))
+
+
+@pytest.mark.usefixtures('folder_resource')
+def test_collect_storage_garbage(storage_manager, tmp_path, monkeypatch):
+    monkeypatch.setattr(main.workers.storage_gc, 'storage_manager', storage_manager)
+    now = datetime.datetime.utcnow()
+    kept = _create_file('/folder/kept', now, now, b'k' * 5000)
+    removed = _create_file('/folder/removed', now, now, b'r' * 5000)
+    removed_path = removed.storage_path(removed.last_revision_id)
+    storage_manager.write(removed_path + '.120.jpg', b'thumbnail')
+    storage_manager.write('uploads/abc/0', b'part of an abandoned upload')
+    storage_manager.write('other/file', b'not ours')
+    ResourceRevision.query.filter(ResourceRevision.resource_id == removed.id).delete()
+    ResourceRevision.query.session.commit()
+    assert collect_storage_garbage(min_age=1) == (5, 0)  # everything is too new
+
+    old_time = time.time() - 2 * 60 * 60
+    for (dir_name, _, file_names) in os.walk(tmp_path):
+        for file_name in file_names:
+            os.utime(os.path.join(dir_name, file_name), (old_time, old_time))
+    assert collect_storage_garbage(min_age=1) == (5, 3)  # dry run
+    assert storage_manager.exists(removed_path)
+    assert collect_storage_garbage(dry_run=False, min_age=1, rate=1000, batch_size=2) == (5, 3)
+    assert [data_path for (data_path, _) in storage_manager.list_paths()] == [kept.storage_path(kept.last_revision_id), 'other/file']
+
+
+@pytest.mark.usefixtures('folder_resource')
+def test_scrub_revisions(storage_manager, monkeypatch):
+    monkeypatch.setattr(main.workers.storage_scrubber, 'storage_manager', storage_manager)
+    old = datetime.datetime.utcnow() - datetime.timedelta(days=1)
+    good = _create_file('/folder/good', old, old, b'g' * 5000)
+    corrupt = _create_file('/folder/corrupt', old, old, b'c' * 5000)
+    missing = _create_file('/folder/missing', old, old, b'm' * 5000)
+    storage_manager.write(corrupt.storage_path(corrupt.last_revision_id), b'x' * 5000)
+    storage_manager.delete(missing.storage_path(missing.last_revision_id))
+
+    checkpoint = good.last_revision_id - 1
+    (last_id, failures, byte_count) = scrub_revisions(checkpoint, ThreadPool(2))
+    assert last_id == missing.last_revision_id
+    assert [(revision.id, error.split(';')[0]) for (revision, _, error) in failures] == [
+        (corrupt.last_revision_id, 'hash is ' + hashlib.sha1(b'x' * 5000).hexdigest()),
+        (missing.last_revision_id, 'missing'),
+    ]
+    assert byte_count == 10000
+    assert scrub_revisions(last_id, ThreadPool(2)) == (None, [], 0)
+
+
+class RangeOnlyStorageManager(FileSystemStorageManager):
+    """A storage manager that doesn't provide local files (like S3StorageManager), so that ranged reads are used."""
+
+    def open_file(self, data_path):
+        return None
+
+
+@pytest.mark.usefixtures('folder_resource')
+@pytest.mark.parametrize('storage_class', [FileSystemStorageManager, RangeOnlyStorageManager])
+def test_send_resource_data_range(storage_class, app, tmp_path, monkeypatch):
+    storage_manager = storage_class({'FILE_SYSTEM_STORAGE_PATH': str(tmp_path)})
+    monkeypatch.setattr(main.resources.resource_util, 'storage_manager', storage_manager)
+    monkeypatch.setattr(main.resources.views, 'storage_manager', storage_manager)
+    now = datetime.datetime.utcnow()
+    data = bytes(range(256)) * 20
+    small_data = b'0123456789'
+    resource = _create_file('/folder/large.bin', now, now, data)
+    small_resource = _create_file('/folder/small.bin', now, now, small_data)
+
+    for (r, expected) in [(resource, data), (small_resource, small_data)]:
+        with app.test_request_context(headers={'Range': 'bytes=2-5'}):
+            response = send_resource_data(r, 'application/octet-stream')
+            response.direct_passthrough = False
+            assert response.status_code == 206
+            assert response.get_data() == expected[2:6]
+            assert response.headers['Content-Range'] == 'bytes 2-5/%d' % len(expected)
+        with app.test_request_context():
+            response = send_resource_data(r, 'application/octet-stream')
+            response.direct_passthrough = False
+            assert response.status_code == 200
+            assert response.get_data() == expected
+
+        # a multi-range request gets the whole file
+        with app.test_request_context(headers={'Range': 'bytes=0-1,4-5'}):
+            response = send_resource_data(r, 'application/octet-stream')
+            response.direct_passthrough = False
+            assert response.status_code == 200
+            assert response.get_data() == expected
+
+    # a single range past the end is unsatisfiable
+    with app.test_request_context(headers={'Range': 'bytes=%d-' % len(data)}):
+        with pytest.raises(RequestedRangeNotSatisfiable):
+            send_resource_data(resource, 'application/octet-stream')
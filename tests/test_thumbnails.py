@@ -0,0 +1,111 @@
+import datetime
+from io import BytesIO
+
+import gevent.queue
+from PIL import Image
+
+from main.app import thumbnail_queue
+from main.resources.file_conversion import compose_sprite_sheet
+from main.resources.models import Resource
+from main.resources.resource_util import create_sequence, update_sequence_value, read_resource, read_pending_thumbnail, \
+    thumbnail_sequence_id
+import main.resources.thumbnails
+from main.resources.file_system_storage_manager import FileSystemStorageManager
+from main.resources.thumbnails import SPRITE_BLOCK_SIZE, snap_thumbnail_width, sprite_blocks, sprite_storage_path, delete_sprite_sheets
+from main.util import LRUCache
+
+
+def test_snap_thumbnail_width(app, monkeypatch):
+    monkeypatch.setitem(app.config, 'THUMBNAIL_WIDTHS', [60, 120, 240])
+    assert snap_thumbnail_width(10) == 60
+    assert snap_thumbnail_width(120) == 120
+    assert snap_thumbnail_width(121) == 240
+    assert snap_thumbnail_width(5000) == 240
+
+
+def test_lru_cache_eviction():
+    cache = LRUCache(10)
+    cache.put('a', b'1234')
+    cache.put('b', b'1234')
+    assert cache.get('a') == b'1234'  # now 'b' is the least recently used item
+    cache.put('c', b'1234')
+    assert cache.get('b') is None
+    assert cache.get('a') == b'1234'
+    assert cache.get('c') == b'1234'
+    assert cache.total_size == 8
+    assert cache.evictions == 1
+
+
+def test_lru_cache_rejects_large_values():
+    cache = LRUCache(10)
+    cache.put('a', b'x' * 11)
+    assert cache.get('a') is None
+    assert cache.total_size == 0
+
+
+def test_pending_sequence_thumbnail(db_session, folder_resource):
+    sequence = create_sequence(folder_resource, 'images', Resource.IMAGE_SEQUENCE)
+    mem_file = BytesIO()
+    Image.new('RGB', (320, 240)).save(mem_file, 'JPEG')
+    contents = mem_file.getvalue()
+    timestamp = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)  # after the min storage interval
+    update_sequence_value(sequence, '/folder/images', timestamp, contents, emit_message=False)
+    db_session.commit()
+
+    # the thumbnail revision is created with the image revision; its data is filled in later by the thumbnail queue
+    thumbnail_sequence = Resource.query.filter(Resource.id == thumbnail_sequence_id(sequence, 240)).one()
+    assert thumbnail_sequence.name == 'thumbnail-240-x'
+    assert thumbnail_sequence.last_revision_id
+    assert read_resource(thumbnail_sequence) is None
+    assert read_pending_thumbnail(thumbnail_sequence, thumbnail_sequence.last_revision_id) == contents
+
+
+def test_sequence_thumbnail_with_full_queue(db_session, folder_resource, monkeypatch):
+    monkeypatch.setattr(thumbnail_queue, 'jobs', gevent.queue.Queue(maxsize=1))
+    thumbnail_queue.jobs.put_nowait(None)
+    sequence = create_sequence(folder_resource, 'images', Resource.IMAGE_SEQUENCE)
+    mem_file = BytesIO()
+    Image.new('RGB', (320, 240)).save(mem_file, 'JPEG')
+    timestamp = datetime.datetime.utcnow() + datetime.timedelta(minutes=1)
+    update_sequence_value(sequence, '/folder/images', timestamp, mem_file.getvalue(), emit_message=False)
+    db_session.commit()
+
+    # if the thumbnail can't be queued, it is computed right away rather than leaving the revision empty
+    thumbnail_sequence = Resource.query.filter(Resource.id == thumbnail_sequence_id(sequence, 240)).one()
+    assert Image.open(BytesIO(read_resource(thumbnail_sequence))).size == (240, 180)
+
+
+def test_sprite_blocks():
+    revision_ids = list(range(200, 100, -1))  # newest first
+    blocks = sprite_blocks(revision_ids, SPRITE_BLOCK_SIZE * 2 + 10)  # oldest 10 revisions not included
+    assert blocks == [[191, 200], [141, 190], [101, 140]]
+    assert sprite_blocks([None, 5, 4], 3) == [[4, 5]]  # skip revisions without thumbnails
+
+
+def test_compose_sprite_sheet():
+    images_data = []
+    for size in [(40, 30), (60, 20)]:
+        mem_file = BytesIO()
+        Image.new('RGB', size).save(mem_file, 'JPEG')
+        images_data.append(mem_file.getvalue())
+    (sprite_data, boxes) = compose_sprite_sheet(images_data)
+    assert boxes == [(0, 0, 40, 30), (0, 30, 60, 20)]
+    assert Image.open(BytesIO(sprite_data)).size == (60, 50)
+
+
+def test_delete_sprite_sheets(folder_resource, tmp_path, monkeypatch):
+    storage_manager = FileSystemStorageManager({'FILE_SYSTEM_STORAGE_PATH': str(tmp_path)})
+    monkeypatch.setattr(main.resources.thumbnails, 'storage_manager', storage_manager)
+    sequence = create_sequence(folder_resource, 'thumbnails', Resource.IMAGE_SEQUENCE)
+    for (first_rev, last_rev) in [(10, 59), (60, 109)]:
+        path = sprite_storage_path(sequence, first_rev, last_rev, 50)
+        storage_manager.write(path, b'sprite')
+        storage_manager.write(path + '.json', b'{}')
+    storage_manager.write(sequence.storage_path(10), b'thumbnail')
+
+    # sheets starting before the first remaining revision are removed; revisions are left alone
+    delete_sprite_sheets(sequence, 60)
+    assert not storage_manager.exists(sprite_storage_path(sequence, 10, 59, 50) + '.json')
+    assert storage_manager.exists(sprite_storage_path(sequence, 60, 109, 50))
+    delete_sprite_sheets(sequence)
+    assert [data_path for (data_path, _) in storage_manager.list_paths()] == [sequence.storage_path(10)]
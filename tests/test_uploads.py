@@ -0,0 +1,41 @@
+import random
+from io import BytesIO
+
+import pytest
+
+
+@pytest.mark.usefixtures('api', 'folder_resource')
+class TestUploads:
+    @pytest.fixture(autouse=True)
+    def setup(self, client):
+        # pylint: disable=attribute-defined-outside-init
+        self.client = client
+
+    def test_streamed_file_upload(self):
+        content = bytes(random.getrandbits(8) for _ in range(5000))
+        file_info = {'path': '/folder', 'type': 20, 'file': (BytesIO(content), 'streamed.bin')}
+        assert self.client.post('/api/v1/resources', data=file_info, content_type='multipart/form-data').status_code == 200
+        assert self.client.get('/api/v1/resources/folder/streamed.bin').data == content
+        assert self.client.get('/api/v1/resources/folder/streamed.bin?meta=1').json['system_attributes']['size'] == len(content)
+
+    def test_resumable_upload(self):
+        content = bytes(random.getrandbits(8) for _ in range(3000))
+        result = self.client.post('/api/v1/uploads', data={'path': '/folder/resumed.bin', 'size': len(content)})
+        assert result.status_code == 200
+        upload_url = '/api/v1/uploads/' + result.json['id']
+
+        assert self.client.put(upload_url + '?offset=0', data=content[:1000]).json['offset'] == 1000
+        result = self.client.put(upload_url + '?offset=0', data=content[:1000])  # retry of a part we already have
+        assert result.status_code == 409
+        assert result.json['offset'] == 1000
+        assert self.client.put(upload_url + '?offset=abc', data=content[1000:]).status_code == 400
+        assert self.client.post(upload_url).status_code == 400  # not complete yet
+        assert self.client.put(upload_url + '?offset=1000', data=content[1000:]).json['offset'] == len(content)
+        assert self.client.get(upload_url).json['offset'] == len(content)
+
+        assert self.client.post(upload_url).status_code == 200
+        assert self.client.get('/api/v1/resources/folder/resumed.bin').data == content
+        assert self.client.get(upload_url).status_code == 404
+
+    def test_upload_requires_folder(self):
+        assert self.client.post('/api/v1/uploads', data={'path': '/missing/file.bin'}).status_code == 400